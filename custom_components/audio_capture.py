@@ -0,0 +1,1007 @@
+"""
+Owns the microphone and shares it with every voice component.
+
+A single capture thread reads the PCM device and writes into a fixed-size
+ring buffer. hotword_snowboy, stt_snowboy and stt_speech_recognition read
+from it through independent readers, so handing over from the hotword to
+the command no longer closes one ALSA stream and opens another.
+
+The source can be replaced by a WAV file or by synthetic audio, which makes
+the whole chain usable on a machine without audio hardware.
+
+Keyword detectors can put a VoiceGate (webrtcvad) in front of their models,
+so silence and background noise are not scored at all.
+
+An optional FrontEnd (NumPy) conditions the audio once in the capture
+thread, before any reader sees it: resampling from the device rate, high-pass,
+automatic gain control and clipping protection. Detectors and decoders then
+all get the same 16 kHz, levelled audio instead of each resampling and
+scaling it on its own.
+"""
+import asyncio
+import audioop
+import collections
+import contextlib
+import logging
+import math
+import struct
+import threading
+import time
+import wave
+
+import voluptuous as vol
+
+from homeassistant.const import EVENT_HOMEASSISTANT_STOP
+from homeassistant.helpers import config_validation as cv
+
+from custom_components import audio_devices, startup
+
+_LOGGER = logging.getLogger(__name__)
+
+REQUIREMENTS = ['PyAudio>=0.2.8', 'webrtcvad==2.0.10', 'numpy>=1.13.0']
+
+DOMAIN = 'audio_capture'
+
+# ------
+# Config
+# ------
+
+# 'microphone' or the path of a WAV file to replay instead of the device
+CONF_SOURCE = 'source'
+
+# PyAudio input device index (defaults to the system default input)
+CONF_DEVICE_INDEX = 'device_index'
+
+# Input device by (part of) its name, which survives devices being renumbered
+CONF_DEVICE_NAME = 'device_name'
+
+# File keeping the probed device, rate and period, relative to the config
+# directory ('' probes nothing and opens device_index at device_sample_rate)
+CONF_PROFILE = 'profile'
+
+# Capture sample rate, must match what the detectors expect
+CONF_SAMPLE_RATE = 'sample_rate'
+
+# Rate the microphone is opened at (defaults to sample_rate); the front end resamples it
+CONF_DEVICE_SAMPLE_RATE = 'device_sample_rate'
+
+# Frames read from the device at a time
+CONF_FRAMES_PER_BUFFER = 'frames_per_buffer'
+
+# Seconds of audio kept in the ring buffer
+CONF_BUFFER_SECONDS = 'buffer_seconds'
+
+# Seconds of audio before the hotword handed to the speech recognizer
+CONF_PRE_ROLL = 'pre_roll'
+
+# Energy threshold handed to recognizers, as a multiple of the noise floor
+CONF_NOISE_RATIO = 'noise_ratio'
+
+# Seconds the noise floor takes to follow a louder room (quieter is 10x faster)
+CONF_NOISE_ADAPT_TIME = 'noise_adapt_time'
+
+# Skip keyword models on audio webrtcvad does not take for speech
+CONF_VAD = 'vad'
+
+# webrtcvad aggressiveness, from 0 (lets most audio through) to 3
+CONF_VAD_AGGRESSIVENESS = 'vad_aggressiveness'
+
+# Seconds the gate stays open after the last speech frame
+CONF_VAD_HANGOVER = 'vad_hangover'
+
+# Seconds of audio before the first speech frame also fed when the gate opens
+CONF_VAD_PRE_ROLL = 'vad_pre_roll'
+
+# Condition the audio (high-pass, AGC, limiter) before any reader sees it
+CONF_FRONT_END = 'front_end'
+
+# High-pass cutoff in Hz, 0 disables it
+CONF_HIGH_PASS = 'high_pass'
+
+# Automatic gain control
+CONF_AGC = 'agc'
+
+# RMS level the AGC aims at, as a fraction of full scale
+CONF_AGC_TARGET = 'agc_target'
+
+# Highest gain the AGC applies
+CONF_MAX_GAIN = 'max_gain'
+
+# Peak level, as a fraction of full scale, the limiter keeps the audio under
+CONF_LIMIT = 'limit'
+
+# ----------------------
+# Configuration defaults
+# ----------------------
+
+SOURCE_MICROPHONE = 'microphone'
+
+DEFAULT_SOURCE = SOURCE_MICROPHONE
+DEFAULT_PROFILE = '.audio_capture_profile.json'
+DEFAULT_SAMPLE_RATE = 16000
+DEFAULT_FRAMES_PER_BUFFER = 1024
+DEFAULT_BUFFER_SECONDS = 10.0
+DEFAULT_PRE_ROLL = 0.25
+DEFAULT_NOISE_RATIO = 1.5
+DEFAULT_NOISE_ADAPT_TIME = 5.0
+DEFAULT_VAD = False
+DEFAULT_VAD_AGGRESSIVENESS = 2
+DEFAULT_VAD_HANGOVER = 0.5
+DEFAULT_VAD_PRE_ROLL = 0.3
+DEFAULT_FRONT_END = False
+DEFAULT_HIGH_PASS = 100.0
+DEFAULT_AGC = True
+DEFAULT_AGC_TARGET = 0.1
+DEFAULT_MAX_GAIN = 8.0
+DEFAULT_LIMIT = 0.9
+
+SAMPLE_WIDTH = 2
+CHANNELS = 1
+
+CONFIG_SCHEMA = vol.Schema({
+    vol.Optional(DOMAIN, default={}): vol.Schema({
+        vol.Optional(CONF_SOURCE, DEFAULT_SOURCE): cv.string,
+        vol.Optional(CONF_DEVICE_INDEX): int,
+        vol.Optional(CONF_DEVICE_NAME): cv.string,
+        vol.Optional(CONF_PROFILE, DEFAULT_PROFILE): cv.string,
+        vol.Optional(CONF_SAMPLE_RATE, DEFAULT_SAMPLE_RATE): int,
+        vol.Optional(CONF_DEVICE_SAMPLE_RATE): int,
+        vol.Optional(CONF_FRAMES_PER_BUFFER, DEFAULT_FRAMES_PER_BUFFER): int,
+        vol.Optional(CONF_BUFFER_SECONDS, DEFAULT_BUFFER_SECONDS): vol.Coerce(float),
+        vol.Optional(CONF_PRE_ROLL, DEFAULT_PRE_ROLL): vol.Coerce(float),
+        vol.Optional(CONF_NOISE_RATIO, DEFAULT_NOISE_RATIO): vol.Coerce(float),
+        vol.Optional(CONF_NOISE_ADAPT_TIME, DEFAULT_NOISE_ADAPT_TIME): vol.Coerce(float),
+        vol.Optional(CONF_VAD, DEFAULT_VAD): cv.boolean,
+        vol.Optional(CONF_VAD_AGGRESSIVENESS, DEFAULT_VAD_AGGRESSIVENESS): vol.All(int, vol.Range(min=0, max=3)),
+        vol.Optional(CONF_VAD_HANGOVER, DEFAULT_VAD_HANGOVER): vol.Coerce(float),
+        vol.Optional(CONF_VAD_PRE_ROLL, DEFAULT_VAD_PRE_ROLL): vol.Coerce(float),
+        vol.Optional(CONF_FRONT_END, DEFAULT_FRONT_END): cv.boolean,
+        vol.Optional(CONF_HIGH_PASS, DEFAULT_HIGH_PASS): vol.All(vol.Coerce(float), vol.Range(min=0)),
+        vol.Optional(CONF_AGC, DEFAULT_AGC): cv.boolean,
+        vol.Optional(CONF_AGC_TARGET, DEFAULT_AGC_TARGET): vol.All(vol.Coerce(float), vol.Range(min=0.001, max=1)),
+        vol.Optional(CONF_MAX_GAIN, DEFAULT_MAX_GAIN): vol.All(vol.Coerce(float), vol.Range(min=1)),
+        vol.Optional(CONF_LIMIT, DEFAULT_LIMIT): vol.All(vol.Coerce(float), vol.Range(min=0.1, max=1))
+    })
+}, extra=vol.ALLOW_EXTRA)
+
+# -----
+# Marks
+# -----
+
+# Position of the last hotword detection in the capture stream
+MARK_HOTWORD = 'hotword'
+
+# Position where the last cue (beep) played by cue_player ended
+MARK_PLAYBACK = 'playback'
+
+# Marks older than this (seconds) are ignored by command readers
+MARK_MAX_AGE = 3.0
+
+
+# -----------------------------------------------------------------------------
+# SOURCES
+
+class PyAudioSource(object):
+    """
+    Reads 16 bit mono PCM from a PortAudio input device. With profiles
+    (audio_devices.DeviceProfiles) the device, rate and period come from the
+    saved profile, probed on the first open; sample_rate may change then.
+    """
+
+    sample_width = SAMPLE_WIDTH
+    channels = CHANNELS
+
+    def __init__(self, sample_rate=DEFAULT_SAMPLE_RATE, device_index=None,
+                 frames_per_buffer=DEFAULT_FRAMES_PER_BUFFER, profiles=None):
+        self.sample_rate = sample_rate
+        self.device_index = device_index
+        self.frames_per_buffer = frames_per_buffer
+        self.profiles = profiles
+        self._audio = None
+        self._stream = None
+
+    def open(self):
+        import pyaudio
+        self._audio = pyaudio.PyAudio()
+        if self.profiles is None:
+            self._open_stream()
+            return
+        devices = audio_devices.PyAudioDevices(self._audio)
+        profile = self.profiles.resolve(devices)
+        self._use(profile)
+        try:
+            self._open_stream()
+        except (IOError, OSError):
+            # Listed and supported, but does not open (busy, gone meanwhile): try the others
+            _LOGGER.warning('AUDIO_CAPTURE: %s FAILED TO OPEN, PROBING THE OTHER DEVICES' % profile.device_name)
+            self._use(self.profiles.reprobe(devices, profile))
+            self._open_stream()
+
+    def _use(self, profile):
+        self.device_index = profile.device_index
+        self.sample_rate = profile.sample_rate
+        self.frames_per_buffer = profile.frames_per_buffer
+
+    def _open_stream(self):
+        self._stream = self._audio.open(
+            format=self._audio.get_format_from_width(self.sample_width),
+            channels=self.channels, rate=self.sample_rate, input=True,
+            input_device_index=self.device_index,
+            frames_per_buffer=self.frames_per_buffer)
+
+    def read(self, frames):
+        return self._stream.read(frames, exception_on_overflow=False)
+
+    def close(self):
+        if self._stream is not None:
+            self._stream.stop_stream()
+            self._stream.close()
+            self._stream = None
+        if self._audio is not None:
+            self._audio.terminate()
+            self._audio = None
+
+
+class WaveFileSource(object):
+    """
+    Replays a 16 bit mono WAV file as if it came from a microphone. With
+    realtime=False the file is delivered as fast as it can be consumed.
+    """
+
+    sample_width = SAMPLE_WIDTH
+    channels = CHANNELS
+
+    def __init__(self, path, realtime=True, loop=False):
+        self.path = path
+        self.realtime = realtime
+        self.loop = loop
+        with wave.open(path, 'rb') as wav:
+            assert wav.getsampwidth() == self.sample_width, '%s is not 16 bit' % path
+            assert wav.getnchannels() == self.channels, '%s is not mono' % path
+            self.sample_rate = wav.getframerate()
+        self._wav = None
+        self._next_read = None
+
+    def open(self):
+        self._wav = wave.open(self.path, 'rb')
+        self._next_read = time.monotonic()
+
+    def read(self, frames):
+        data = self._wav.readframes(frames)
+        if not data and self.loop:
+            self._wav.rewind()
+            data = self._wav.readframes(frames)
+        if self.realtime and data:
+            # Pace by an absolute schedule so delays do not accumulate
+            self._next_read += len(data) / float(self.sample_width * self.sample_rate)
+            delay = self._next_read - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        return data
+
+    def close(self):
+        if self._wav is not None:
+            self._wav.close()
+            self._wav = None
+
+
+class SyntheticSource(object):
+    """
+    Generates a sine tone (or silence with amplitude 0) for tests. Stops
+    after duration seconds, or never when duration is None.
+    """
+
+    sample_width = SAMPLE_WIDTH
+    channels = CHANNELS
+
+    def __init__(self, sample_rate=DEFAULT_SAMPLE_RATE, frequency=440.0,
+                 amplitude=0.0, duration=None, realtime=True):
+        self.sample_rate = sample_rate
+        self.frequency = frequency
+        self.amplitude = amplitude
+        self.duration = duration
+        self.realtime = realtime
+        self._generated = 0
+        self._next_read = None
+
+    def open(self):
+        self._generated = 0
+        self._next_read = time.monotonic()
+
+    def read(self, frames):
+        if self.duration is not None:
+            frames = min(frames, int(self.duration * self.sample_rate) - self._generated)
+            if frames <= 0:
+                return b''
+        peak = self.amplitude * 32767
+        step = 2 * math.pi * self.frequency / self.sample_rate
+        start = self._generated
+        samples = [int(peak * math.sin(step * (start + i))) for i in range(frames)]
+        self._generated += frames
+        if self.realtime:
+            self._next_read += frames / float(self.sample_rate)
+            delay = self._next_read - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        return struct.pack('<%dh' % frames, *samples)
+
+    def close(self):
+        pass
+
+
+# -----------------------------------------------------------------------------
+# NOISE ESTIMATOR
+
+class NoiseEstimator(object):
+    """
+    Follows the room noise floor from the capture stream, so recognizers can
+    start with a ready energy threshold instead of calibrating first.
+
+    The floor is an asymmetric exponential average of the chunk RMS: it falls
+    quickly when the room gets quieter and rises slowly when it gets louder,
+    so short bursts of speech barely move it. Updates are suspended while a
+    command is being recorded.
+    """
+
+    # Below this many seconds of observed audio the estimate is not trusted
+    WARMUP_SECONDS = 1.0
+
+    # speech_recognition never goes below this threshold either
+    MIN_THRESHOLD = 50.0
+
+    def __init__(self, ratio=DEFAULT_NOISE_RATIO, adapt_time=DEFAULT_NOISE_ADAPT_TIME):
+        self.ratio = ratio
+        self.rise_time = adapt_time
+        self.fall_time = adapt_time / 10.0
+        self.noise_floor = None
+        self.observed = 0.0
+        self.updated_at = None
+        self._suspended = 0
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self.noise_floor is not None and self.observed >= self.WARMUP_SECONDS
+
+    @property
+    def energy_threshold(self):
+        if self.noise_floor is None:
+            return None
+        return max(self.MIN_THRESHOLD, self.noise_floor * self.ratio)
+
+    def update(self, data, sample_width, seconds):
+        if self._suspended:
+            return
+        energy = audioop.rms(data, sample_width)
+        with self._lock:
+            if self.noise_floor is None:
+                self.noise_floor = float(energy)
+            else:
+                time_constant = self.rise_time if energy > self.noise_floor else self.fall_time
+                alpha = 1.0 - math.exp(-seconds / time_constant)
+                self.noise_floor += alpha * (energy - self.noise_floor)
+            self.observed += seconds
+            self.updated_at = time.monotonic()
+
+    @contextlib.contextmanager
+    def suspended(self):
+        """Stops adapting while a command is spoken."""
+        with self._lock:
+            self._suspended += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._suspended -= 1
+
+
+# -----------------------------------------------------------------------------
+# VOICE ACTIVITY GATE
+
+class VoiceGate(object):
+    """
+    Decides, chunk by chunk, whether a keyword detector needs to see the
+    audio at all. Chunks are split in 30 ms webrtcvad frames; the gate opens
+    on the first speech frame and closes hangover seconds after the last
+    one. While closed, the last pre_roll seconds are kept and fed together
+    with the chunk that opens the gate, so word onsets are not clipped.
+
+    With aggressiveness None every chunk goes through, without webrtcvad.
+    """
+
+    FRAME_SECONDS = 0.03
+
+    def __init__(self, capture, aggressiveness=None, hangover=DEFAULT_VAD_HANGOVER,
+                 pre_roll=DEFAULT_VAD_PRE_ROLL):
+        self.enabled = aggressiveness is not None
+        # Chunks offered and chunks handed to the detector
+        self.chunks = 0
+        self.passed = 0
+        self._vad = None
+        if self.enabled:
+            import webrtcvad
+            self._vad = webrtcvad.Vad(aggressiveness)
+        self._sample_rate = capture.sample_rate
+        self._frame_bytes = capture.seconds_to_bytes(self.FRAME_SECONDS)
+        self._hangover_bytes = capture.seconds_to_bytes(hangover)
+        self._pre_roll_bytes = capture.seconds_to_bytes(pre_roll)
+        self._pending = b''
+        self._held = collections.deque()
+        self._held_bytes = 0
+        self._open_for = 0
+
+    @property
+    def is_open(self):
+        return self._open_for > 0
+
+    def reset(self):
+        """Closes the gate and forgets held audio, e.g. after skipping ahead."""
+        self._pending = b''
+        self._held.clear()
+        self._held_bytes = 0
+        self._open_for = 0
+
+    def process(self, data):
+        """Returns the audio the detector should see for this chunk, or None."""
+        self.chunks += 1
+        if not self.enabled:
+            self.passed += 1
+            return data
+        if self._contains_speech(data):
+            self._open_for = self._hangover_bytes
+        elif self._open_for > 0:
+            # Hangover: the tail of a word is often too quiet for the VAD
+            self._open_for -= len(data)
+        else:
+            self._hold(bytes(data))
+            return None
+        self.passed += 1
+        if self._held:
+            # Only ever filled while closed: this chunk opens the gate
+            self._held.append(bytes(data))
+            data = b''.join(self._held)
+            self._held.clear()
+            self._held_bytes = 0
+        return data
+
+    def _contains_speech(self, data):
+        audio = self._pending + bytes(data) if self._pending else bytes(data)
+        end = len(audio) - len(audio) % self._frame_bytes
+        self._pending = audio[end:]
+        for start in range(0, end, self._frame_bytes):
+            if self._vad.is_speech(audio[start:start + self._frame_bytes], self._sample_rate):
+                return True
+        return False
+
+    def _hold(self, data):
+        self._held.append(data)
+        self._held_bytes += len(data)
+        while self._held and self._held_bytes - len(self._held[0]) >= self._pre_roll_bytes:
+            self._held_bytes -= len(self._held.popleft())
+
+
+# -----------------------------------------------------------------------------
+# FRONT END
+
+class FrontEnd(object):
+    """
+    Conditions the audio once, in the capture thread, before it reaches the
+    ring buffer. Works on whole blocks of 16 bit mono frames with NumPy, in
+    buffers allocated once by open(); nothing is allocated per block.
+
+      resample   input_rate to sample_rate with a windowed sinc. Blocks are a
+                 whole number of resampling periods (3 frames at 48 kHz for 1
+                 at 16 kHz, 441 at 44.1 kHz for 160), so every block uses the
+                 same kernels, one per output frame, computed once
+      high-pass  the signal minus two cascaded moving averages of itself
+                 (DC, handling noise and rumble), linear phase
+      agc        block gain towards agc_target RMS, at most max_gain, ramped
+                 across the block; held while the block is quieter than
+                 AGC_FLOOR, so silence is not pumped up
+      limiter    the gain of a block is lowered so its peak stays under limit
+
+    Every stage but resampling can be turned off; with equal rates and all
+    stages off the front end is not needed at all.
+    """
+
+    # Sinc zero crossings on each side of the resampling kernels
+    RESAMPLE_ZEROS = 8
+
+    # Resampling passband, as a fraction of the lower of the two Nyquist frequencies
+    RESAMPLE_PASSBAND = 0.9
+
+    # Moving average length, in periods of the cutoff, for a -3 dB high-pass cutoff
+    HIGH_PASS_SPAN = 0.573
+
+    # RMS, as a fraction of full scale, under which the AGC holds its gain
+    AGC_FLOOR = 0.003
+
+    # Lowest gain the AGC applies to loud audio
+    AGC_MIN_GAIN = 0.25
+
+    # Seconds the AGC takes to lower (attack) and raise (release) its gain
+    AGC_ATTACK = 0.05
+    AGC_RELEASE = 2.0
+
+    FULL_SCALE = 32767.0
+
+    def __init__(self, input_rate, sample_rate=DEFAULT_SAMPLE_RATE, frames_per_buffer=DEFAULT_FRAMES_PER_BUFFER,
+                 high_pass=DEFAULT_HIGH_PASS, agc=DEFAULT_AGC, agc_target=DEFAULT_AGC_TARGET,
+                 max_gain=DEFAULT_MAX_GAIN, limit=DEFAULT_LIMIT):
+        self.input_rate = input_rate
+        self.sample_rate = sample_rate
+        self.high_pass = high_pass
+        self.agc = agc
+        self.agc_target = agc_target
+        self.max_gain = max_gain
+        self.limit = limit
+        self.frames_per_buffer = frames_per_buffer
+        common = math.gcd(input_rate, sample_rate)
+        self._up = sample_rate // common
+        self._down = input_rate // common
+        # Frames read from the source and written to the ring buffer per block
+        self.input_frames, self.output_frames = self.blocks(input_rate, sample_rate, frames_per_buffer)
+        block_seconds = self.output_frames / float(sample_rate)
+        self._attack = 1.0 - math.exp(-block_seconds / self.AGC_ATTACK)
+        self._release = 1.0 - math.exp(-block_seconds / self.AGC_RELEASE)
+        self.gain = 1.0
+        self.stats = {
+            'blocks': 0,
+            'limited': 0
+        }
+        self._np = None
+
+    @staticmethod
+    def blocks(input_rate, sample_rate, frames_per_buffer):
+        """Input and output frames of a block: a whole number of resampling periods, about frames_per_buffer out."""
+        common = math.gcd(input_rate, sample_rate)
+        periods = max(1, int(round(frames_per_buffer * common / float(sample_rate))))
+        return periods * input_rate // common, periods * sample_rate // common
+
+    @property
+    def resamples(self):
+        return self._up != self._down
+
+    def for_input_rate(self, input_rate):
+        """The same front end, resampling from input_rate instead."""
+        return FrontEnd(input_rate, self.sample_rate, self.frames_per_buffer, self.high_pass, self.agc,
+                        self.agc_target, self.max_gain, self.limit)
+
+    def open(self):
+        """Imports NumPy, allocates the buffers and computes the kernels. Also resets the filters."""
+        import numpy as np
+        self._np = np
+        frames = self.output_frames
+        self.gain = 1.0
+
+        if self.resamples:
+            # Kernels in input frames: cutoff (cycles per frame) and half width
+            cutoff = 0.5 * self.RESAMPLE_PASSBAND * min(self.input_rate, self.sample_rate) / self.input_rate
+            half = int(math.ceil(self.RESAMPLE_ZEROS / (2 * cutoff)))
+            # Output frame n is at input frame n * down / up, read half frames late
+            position = half + np.arange(frames) * self._down / float(self._up)
+            first = np.floor(position).astype(np.int64) - half + 1
+            self._taps = first[:, None] + np.arange(2 * half)[None, :]
+            distance = self._taps - position[:, None]
+            kernels = 2 * cutoff * np.sinc(2 * cutoff * distance) * (0.5 + 0.5 * np.cos(np.pi * distance / half))
+            kernels /= kernels.sum(axis=1)[:, None]
+            self._kernels = kernels.astype(np.float32)
+            self._history = np.zeros(2 * half + self.input_frames, np.float32)
+            self._keep = 2 * half
+            self._gathered = np.empty(self._taps.shape, np.float32)
+        self._resampled = np.zeros(frames, np.float64)
+
+        if self.high_pass:
+            span = max(2, int(round(self.HIGH_PASS_SPAN * self.sample_rate / self.high_pass)))
+            self._span = span
+            self._signal = np.zeros(2 * span - 2 + frames, np.float64)
+            self._sums = np.zeros(len(self._signal) + 1, np.float64)
+            self._average = np.empty(span - 1 + frames, np.float64)
+            self._average_sums = np.zeros(len(self._average) + 1, np.float64)
+        self._filtered = np.zeros(frames, np.float64)
+
+        self._ramp = np.arange(1, frames + 1, dtype=np.float64) / frames
+        self._gains = np.empty(frames, np.float64)
+        self._output = np.zeros(frames, np.int16)
+        self._output_bytes = memoryview(self._output).cast('B')
+
+    def process(self, data):
+        """
+        Conditions one block read from the source (input_frames frames, fewer
+        at the end of a file). Returns a memoryview over an internal buffer,
+        valid until the next call.
+        """
+        np = self._np
+        samples = np.frombuffer(data, np.int16)
+        received = len(samples)
+        frames = self.output_frames
+        if received < self.input_frames:
+            frames = min(frames, int(math.ceil(received * self._up / float(self._down))))
+        self.stats['blocks'] += 1
+
+        x = self._resampled
+        if self.resamples:
+            history = self._history
+            history[:self._keep] = history[self.input_frames:]
+            history[self._keep:self._keep + received] = samples
+            history[self._keep + received:] = 0
+            np.take(history, self._taps, out=self._gathered)
+            np.multiply(self._gathered, self._kernels, out=self._gathered)
+            np.sum(self._gathered, axis=1, out=x)
+        else:
+            x[:received] = samples
+            x[received:] = 0
+
+        y = self._filtered
+        if self.high_pass:
+            span = self._span
+            signal = self._signal
+            signal[:2 * span - 2] = signal[self.output_frames:]
+            signal[2 * span - 2:] = x
+            np.cumsum(signal, out=self._sums[1:])
+            np.subtract(self._sums[span:], self._sums[:-span], out=self._average)
+            np.cumsum(self._average, out=self._average_sums[1:])
+            np.subtract(self._average_sums[span:], self._average_sums[:-span], out=y)
+            y /= span * span
+            # Both averages are centred span - 1 frames back
+            np.subtract(signal[span - 1:span - 1 + self.output_frames], y, out=y)
+        else:
+            y[:] = x
+
+        start = end = self.gain
+        if self.agc:
+            level = math.sqrt(float(np.dot(y, y)) / len(y)) / self.FULL_SCALE
+            if level > self.AGC_FLOOR:
+                wanted = min(self.max_gain, max(self.AGC_MIN_GAIN, self.agc_target / level))
+                end += (wanted - start) * (self._attack if wanted < start else self._release)
+        peak = max(float(y.max()), -float(y.min()))
+        if peak * max(start, end) > self.limit * self.FULL_SCALE:
+            ceiling = self.limit * self.FULL_SCALE / peak
+            start, end = min(start, ceiling), min(end, ceiling)
+            self.stats['limited'] += 1
+        self.gain = end
+        if start != 1.0 or end != 1.0:
+            np.multiply(self._ramp, end - start, out=self._gains)
+            self._gains += start
+            y *= self._gains
+
+        np.rint(y, out=y)
+        np.clip(y, -self.FULL_SCALE - 1, self.FULL_SCALE, out=y)
+        self._output[:] = y
+        return self._output_bytes[:frames * SAMPLE_WIDTH]
+
+
+# -----------------------------------------------------------------------------
+# RING BUFFER
+
+class AudioCapture(object):
+    """
+    Single producer, many consumers ring buffer of PCM audio.
+
+    The buffer is stored twice, back to back, so that any window up to the
+    buffer size is contiguous in memory: readers get memoryview slices of
+    it without copying. A view stays valid until the writer laps it, i.e.
+    for buffer_seconds after the audio was captured.
+    """
+
+    def __init__(self, source, frames_per_buffer=DEFAULT_FRAMES_PER_BUFFER,
+                 buffer_seconds=DEFAULT_BUFFER_SECONDS, pre_roll=DEFAULT_PRE_ROLL,
+                 noise=None, vad=None, front_end=None):
+        self.source = source
+        self.pre_roll = pre_roll
+        self.noise = noise or NoiseEstimator()
+        # VoiceGate keyword arguments, or None to let keyword detectors see everything
+        self.vad = vad
+        # Readers see the audio at the front end rate, whatever the source rate
+        self.front_end = front_end
+        self.sample_rate = source.sample_rate if front_end is None else front_end.sample_rate
+        self.sample_width = source.sample_width
+        self.channels = source.channels
+        self.frame_bytes = self.sample_width * self.channels
+        chunks = max(2, int(math.ceil(buffer_seconds * self.sample_rate / frames_per_buffer)))
+        # Any whole number of frames: blocks written may straddle the end
+        self.capacity = chunks * frames_per_buffer * self.frame_bytes
+
+        self._frames_per_buffer = frames_per_buffer
+        self._fit_front_end()
+        self._buffer = bytearray(2 * self.capacity)
+        self._view = memoryview(self._buffer)
+        self._written = 0
+        self._marks = {}
+        self._condition = threading.Condition()
+        self._start_lock = threading.Lock()
+        self._running = False
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._running
+
+    @property
+    def position(self):
+        """Absolute number of bytes captured since start."""
+        return self._written
+
+    def seconds_to_bytes(self, seconds):
+        return int(seconds * self.sample_rate) * self.frame_bytes
+
+    def bytes_to_seconds(self, size):
+        return size / float(self.frame_bytes * self.sample_rate)
+
+    def start(self):
+        """Opens the source and starts the capture thread, unless already started. Blocking."""
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            self.source.open()
+            self._fit_front_end()
+            if self.front_end is not None:
+                self.front_end.open()
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name=DOMAIN, daemon=True)
+            self._thread.start()
+
+    def _fit_front_end(self):
+        """Resamples from the rate the source opened at, which a device profile may have changed."""
+        rate = self.source.sample_rate
+        if self.front_end is None and rate != self.sample_rate:
+            self.front_end = FrontEnd(rate, self.sample_rate, self._frames_per_buffer,
+                                      high_pass=0, agc=False, limit=1.0)
+        elif self.front_end is not None and self.front_end.input_rate != rate:
+            self.front_end = self.front_end.for_input_rate(rate)
+        if self.front_end is None:
+            self.chunk_bytes = self._frames_per_buffer * self.frame_bytes
+            self._read_frames = self._frames_per_buffer
+        else:
+            self.chunk_bytes = self.front_end.output_frames * self.frame_bytes
+            self._read_frames = self.front_end.input_frames
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=1.0)
+            self._thread = None
+
+    def mark(self, name, position=None):
+        """Remembers a stream position (defaults to the current one) under name."""
+        self._marks[name] = self._written if position is None else position
+
+    def pop_mark(self, name, max_age=None):
+        """Forgets and returns a mark, or None if missing or older than max_age seconds."""
+        position = self._marks.pop(name, None)
+        if position is None or max_age is None:
+            return position
+        if self._written - position > self.seconds_to_bytes(max_age):
+            return None
+        return position
+
+    def reader(self, pre_roll=0.0, since=None):
+        """
+        Returns a reader starting pre_roll seconds before since (an absolute
+        position, defaults to now), clamped to the audio still buffered.
+        """
+        with self._condition:
+            start = self._written if since is None else min(since, self._written)
+            start -= self.seconds_to_bytes(pre_roll)
+            start = max(start, self._written - self.capacity, 0)
+            start -= start % self.frame_bytes
+            return CaptureReader(self, start)
+
+    def command_reader(self):
+        """
+        Reader for a spoken command: starts pre_roll seconds before the last
+        hotword detection if there was a recent one, otherwise now. A cue
+        played since then is skipped: it is not part of the command.
+        """
+        since = self.pop_mark(MARK_HOTWORD, MARK_MAX_AGE)
+        played = self.pop_mark(MARK_PLAYBACK, MARK_MAX_AGE)
+        if since is None:
+            return self.reader()
+        reader = self.reader(self.pre_roll, since)
+        if played is not None and played > reader.position:
+            return self.reader(since=played)
+        return reader
+
+    def session(self, timeout=None):
+        """New listening session, see Session. Its deadline starts with start()."""
+        return Session(self, timeout)
+
+    def voice_gate(self):
+        """New VoiceGate for one detector, configured as the capture was."""
+        return VoiceGate(self, **(self.vad or {}))
+
+    def view(self, position, size):
+        """Zero-copy view of size bytes starting at an absolute position."""
+        offset = position % self.capacity
+        return self._view[offset:offset + size]
+
+    def wait(self, position, timeout=None, session=None):
+        """
+        Blocks until position bytes were captured. Returns False on timeout,
+        on stop, or when the session is cancelled or past its deadline.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if session is not None and session.deadline is not None:
+            deadline = session.deadline if deadline is None else min(deadline, session.deadline)
+        with self._condition:
+            while self._running and self._written < position:
+                if session is not None and session.cancelled:
+                    return False
+                if deadline is None:
+                    self._condition.wait()
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            return self._written >= position
+
+    def _run(self):
+        try:
+            while self._running:
+                data = self.source.read(self._read_frames)
+                if not data:
+                    _LOGGER.info("AUDIO_CAPTURE: SOURCE EXHAUSTED")
+                    break
+                if self.front_end is not None:
+                    data = self.front_end.process(data)
+                self._write(data)
+                self.noise.update(data, self.sample_width, self.bytes_to_seconds(len(data)))
+        except Exception:
+            _LOGGER.exception("AUDIO_CAPTURE: CAPTURE FAILED")
+        finally:
+            self.source.close()
+            with self._condition:
+                self._running = False
+                self._condition.notify_all()
+
+    def _write(self, data):
+        size = len(data)
+        offset = self._written % self.capacity
+        first = min(size, self.capacity - offset)
+        for base in (0, self.capacity):
+            self._buffer[base + offset:base + offset + first] = data[:first]
+            if first < size:
+                self._buffer[base:base + size - first] = data[first:]
+        with self._condition:
+            self._written += size
+            self._condition.notify_all()
+
+
+class Session(object):
+    """
+    A listening session: an optional monotonic deadline and a cancel flag.
+    Readers waiting on behalf of a session sleep on the capture condition and
+    wake only when audio arrives, the deadline passes or it is cancelled;
+    nothing polls.
+    """
+
+    def __init__(self, capture, timeout=None):
+        self.capture = capture
+        self.timeout = timeout
+        self.deadline = None
+        self._cancelled = False
+
+    def start(self):
+        if self.timeout is not None:
+            self.deadline = time.monotonic() + self.timeout
+        return self
+
+    def cancel(self):
+        with self.capture._condition:
+            self._cancelled = True
+            self.capture._condition.notify_all()
+
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+    @property
+    def expired(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+
+class CaptureReader(object):
+    """Independent cursor over the capture ring buffer."""
+
+    def __init__(self, capture, position):
+        self.capture = capture
+        self.position = position
+        self.overruns = 0
+
+    @property
+    def available(self):
+        return self.capture.position - self.position
+
+    def read(self, size, timeout=None, session=None):
+        """
+        Returns a memoryview of exactly size bytes, waiting for them if
+        needed, or None on timeout, when the capture has stopped or when the
+        session ends.
+        """
+        if not self.capture.wait(self.position + size, timeout, session):
+            return None
+        oldest = self.capture.position - self.capture.capacity
+        if self.position < oldest:
+            # Fell behind the writer: skip the audio that was overwritten
+            self.overruns += 1
+            _LOGGER.warning("AUDIO_CAPTURE: READER OVERRUN, SKIPPING %.2f s"
+                            % self.capture.bytes_to_seconds(oldest - self.position))
+            self.position = oldest
+        data = self.capture.view(self.position, size)
+        self.position += size
+        return data
+
+    def skip_to_end(self):
+        self.position = self.capture.position
+
+
+# -----------------------------------------------------------------------------
+
+@asyncio.coroutine
+def async_setup(hass, config):
+    started = time.monotonic()
+    conf = config.get(DOMAIN, {})
+    source_name = conf.get(CONF_SOURCE, DEFAULT_SOURCE)
+    sample_rate = conf.get(CONF_SAMPLE_RATE, DEFAULT_SAMPLE_RATE)
+    frames_per_buffer = conf.get(CONF_FRAMES_PER_BUFFER, DEFAULT_FRAMES_PER_BUFFER)
+    buffer_seconds = conf.get(CONF_BUFFER_SECONDS, DEFAULT_BUFFER_SECONDS)
+
+    source = None
+    if source_name == SOURCE_MICROPHONE:
+        input_rate = conf.get(CONF_DEVICE_SAMPLE_RATE, sample_rate)
+    else:
+        source = WaveFileSource(source_name, realtime=True, loop=True)
+        input_rate = source.sample_rate
+
+    front_end = None
+    if conf.get(CONF_FRONT_END, DEFAULT_FRONT_END):
+        front_end = FrontEnd(input_rate, sample_rate, frames_per_buffer,
+                             conf.get(CONF_HIGH_PASS, DEFAULT_HIGH_PASS), conf.get(CONF_AGC, DEFAULT_AGC),
+                             conf.get(CONF_AGC_TARGET, DEFAULT_AGC_TARGET), conf.get(CONF_MAX_GAIN, DEFAULT_MAX_GAIN),
+                             conf.get(CONF_LIMIT, DEFAULT_LIMIT))
+    elif input_rate != sample_rate:
+        # Resampling only
+        front_end = FrontEnd(input_rate, sample_rate, frames_per_buffer, high_pass=0, agc=False, limit=1.0)
+    if source is None:
+        profiles = None
+        if conf.get(CONF_PROFILE, DEFAULT_PROFILE):
+            # Probed on the first open, after homeassistant_start; the rate
+            # picked then may differ from input_rate, the capture adapts
+            device_rate = conf.get(CONF_DEVICE_SAMPLE_RATE)
+            profiles = audio_devices.DeviceProfiles(
+                hass.config.path(conf.get(CONF_PROFILE, DEFAULT_PROFILE)), sample_rate,
+                lambda rate: FrontEnd.blocks(rate, sample_rate, frames_per_buffer)[0],
+                conf.get(CONF_DEVICE_INDEX), conf.get(CONF_DEVICE_NAME),
+                None if device_rate is None else [device_rate])
+        source = PyAudioSource(input_rate, conf.get(CONF_DEVICE_INDEX),
+                               frames_per_buffer if front_end is None else front_end.input_frames, profiles)
+
+    noise = NoiseEstimator(conf.get(CONF_NOISE_RATIO, DEFAULT_NOISE_RATIO),
+                           conf.get(CONF_NOISE_ADAPT_TIME, DEFAULT_NOISE_ADAPT_TIME))
+    vad = None
+    if conf.get(CONF_VAD, DEFAULT_VAD):
+        vad = {
+            'aggressiveness': conf.get(CONF_VAD_AGGRESSIVENESS, DEFAULT_VAD_AGGRESSIVENESS),
+            'hangover': conf.get(CONF_VAD_HANGOVER, DEFAULT_VAD_HANGOVER),
+            'pre_roll': conf.get(CONF_VAD_PRE_ROLL, DEFAULT_VAD_PRE_ROLL)
+        }
+    capture = AudioCapture(source, frames_per_buffer, buffer_seconds,
+                           conf.get(CONF_PRE_ROLL, DEFAULT_PRE_ROLL), noise, vad, front_end)
+    # The device is opened after homeassistant_start, or by the first
+    # component that reads from it (every reader calls start())
+    startup.get(hass).lazy(DOMAIN, capture.start)
+    hass.data[DOMAIN] = capture
+
+    @asyncio.coroutine
+    def async_terminate(event):
+        yield from hass.async_add_job(capture.stop)
+
+    hass.bus.async_listen(EVENT_HOMEASSISTANT_STOP, async_terminate)
+    _LOGGER.info('AUDIO_CAPTURE SET UP: %s at %d Hz (read at %d Hz), %.1f s buffer, vad %s, front end %s'
+                 % (source_name, sample_rate, input_rate, capture.bytes_to_seconds(capture.capacity), vad,
+                    front_end is not None))
+    startup.get(hass).setup_done(DOMAIN, started)
+    return True
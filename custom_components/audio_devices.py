@@ -0,0 +1,249 @@
+"""
+Input device profile of audio_capture (not a Home Assistant component by
+itself).
+
+Finding a device that records 16 bit mono at a given rate means asking
+PortAudio about each device and rate, and every question opens the ALSA
+device: with a USB microphone that is a screen of "Unknown PCM cards.pcm.rear"
+and friends and a noticeable delay. DeviceProfiles asks once, prefers the
+rate the detectors want (no resampling at all), then rates the front end
+resamples from cheaply, and saves the answer (device, rate, channels,
+period) in a JSON file. Later startups open that device directly.
+
+A saved device that has moved to another index is found again by name;
+one that is gone, or fails to open, is probed again and the file rewritten.
+
+Devices are listed through PyAudioDevices, or FakeDevices to try all of
+this without audio hardware.
+"""
+import collections
+import json
+import logging
+import os
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+# 16 bit mono is what every reader of the capture expects
+CHANNELS = 1
+
+# Rates tried after the wanted one: integer multiples first, they resample cheapest
+FALLBACK_RATES = [48000, 32000, 44100, 22050, 96000]
+
+Device = collections.namedtuple('Device', ['index', 'name', 'max_input_channels', 'default_sample_rate'])
+
+Profile = collections.namedtuple('Profile', ['device_index', 'device_name', 'sample_rate', 'channels',
+                                             'frames_per_buffer'])
+
+
+class DeviceProfileError(Exception):
+    pass
+
+
+# -----------------------------------------------------------------------------
+# DEVICE LISTS
+
+class PyAudioDevices(object):
+    """Devices of a PyAudio instance. supports() opens the device to find out."""
+
+    def __init__(self, audio):
+        self._audio = audio
+
+    def list(self):
+        devices = []
+        for index in range(self._audio.get_device_count()):
+            device = self.get(index)
+            if device is not None:
+                devices.append(device)
+        return devices
+
+    def get(self, index):
+        try:
+            info = self._audio.get_device_info_by_index(index)
+        except (IOError, OSError, ValueError):
+            return None
+        return Device(index, info['name'], int(info['maxInputChannels']), int(info['defaultSampleRate']))
+
+    def default_index(self):
+        try:
+            return self._audio.get_default_input_device_info()['index']
+        except (IOError, OSError):
+            return None
+
+    def supports(self, index, sample_rate, channels):
+        import pyaudio
+        try:
+            return self._audio.is_format_supported(sample_rate, input_device=index, input_channels=channels,
+                                                   input_format=pyaudio.paInt16)
+        except ValueError:
+            return False
+
+
+class FakeDevices(object):
+    """
+    A device list for tests: devices are Device tuples, supported is a set
+    of (device name, sample rate, channels). Counts the formats probed.
+    """
+
+    def __init__(self, devices, supported, default_index=None):
+        self.devices = list(devices)
+        self.supported = set(supported)
+        self.default = default_index
+        self.probes = 0
+
+    def list(self):
+        return list(self.devices)
+
+    def get(self, index):
+        for device in self.devices:
+            if device.index == index:
+                return device
+        return None
+
+    def default_index(self):
+        return self.default
+
+    def supports(self, index, sample_rate, channels):
+        self.probes += 1
+        device = self.get(index)
+        return device is not None and (device.name, sample_rate, channels) in self.supported
+
+
+# -----------------------------------------------------------------------------
+# PROFILES
+
+class DeviceProfiles(object):
+    """
+    Picks the input device, rate and period once and keeps them in path.
+
+    sample_rate is the rate the detectors want; period(rate) gives the
+    frames to read at a time from a device running at rate. device_index
+    and device_name (part of the name, case insensitive) restrict the
+    choice, rates replaces the rates tried. A profile saved for another
+    choice of these is ignored.
+    """
+
+    def __init__(self, path, sample_rate, period, device_index=None, device_name=None, rates=None):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.period = period
+        self.device_index = device_index
+        self.device_name = device_name
+        self.rates = rates
+        self.stats = {
+            'probes': 0,
+            'probe_seconds': None,
+            'source': None
+        }
+
+    @property
+    def request(self):
+        """What the profile was asked for: a saved profile is only used for the same request."""
+        return {
+            'sample_rate': self.sample_rate,
+            'device_index': self.device_index,
+            'device_name': self.device_name,
+            'rates': self.rates
+        }
+
+    def resolve(self, devices):
+        """The saved profile if its device is still there, otherwise a new one, saved."""
+        profile = self.load()
+        if profile is not None:
+            found = self._find(devices, profile)
+            if found is not None:
+                # frames_per_buffer may have been configured differently since
+                found = found._replace(frames_per_buffer=self.period(found.sample_rate))
+                self.stats['source'] = 'saved'
+                if found != profile:
+                    if found.device_index != profile.device_index:
+                        self.stats['source'] = 'moved'
+                        _LOGGER.warning('AUDIO_CAPTURE: %s MOVED FROM DEVICE %d TO %d'
+                                        % (profile.device_name, profile.device_index, found.device_index))
+                    self.save(found)
+                return found
+            _LOGGER.warning('AUDIO_CAPTURE: DEVICE %s IS GONE, PROBING AGAIN' % profile.device_name)
+        return self.reprobe(devices)
+
+    def reprobe(self, devices, failed=None):
+        """Probes and saves a new profile, skipping the device of failed (a profile that did not open)."""
+        profile = self.probe(devices, failed)
+        self.stats['source'] = 'probed'
+        self.save(profile)
+        return profile
+
+    def probe(self, devices, failed=None):
+        """First device and rate that records 16 bit mono, not considering the failed profile's device."""
+        started = time.monotonic()
+        probes = 0
+        try:
+            for device in self._candidates(devices):
+                if failed is not None and device.name == failed.device_name:
+                    continue
+                for rate in self._rates(device):
+                    probes += 1
+                    if devices.supports(device.index, rate, CHANNELS):
+                        profile = Profile(device.index, device.name, rate, CHANNELS, self.period(rate))
+                        _LOGGER.info('AUDIO_CAPTURE: PROBED %s, %d FORMATS' % (profile, probes))
+                        return profile
+        finally:
+            self.stats['probes'] += probes
+            self.stats['probe_seconds'] = time.monotonic() - started
+        raise DeviceProfileError('No input device records 16 bit mono (%s)' % self.request)
+
+    def load(self):
+        """The saved profile, or None if missing, unreadable or saved for another request."""
+        try:
+            with open(self.path) as profile_file:
+                saved = json.load(profile_file)
+            if saved.get('request') != self.request:
+                return None
+            return Profile(**saved['profile'])
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as error:
+            _LOGGER.warning('AUDIO_CAPTURE: IGNORING DEVICE PROFILE %s: %s' % (self.path, error))
+            return None
+
+    def save(self, profile):
+        temporary = '%s.tmp' % self.path
+        with open(temporary, 'w') as profile_file:
+            json.dump({
+                'request': self.request,
+                'profile': profile._asdict(),
+                'saved_at': time.time()
+            }, profile_file, indent=2)
+        os.replace(temporary, self.path)
+
+    def forget(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def _find(self, devices, profile):
+        device = devices.get(profile.device_index)
+        if device is not None and device.name == profile.device_name and device.max_input_channels:
+            return profile
+        for device in devices.list():
+            if device.name == profile.device_name and device.max_input_channels:
+                return profile._replace(device_index=device.index)
+        return None
+
+    def _candidates(self, devices):
+        inputs = [device for device in devices.list() if device.max_input_channels >= CHANNELS]
+        if self.device_index is not None:
+            return [device for device in inputs if device.index == self.device_index]
+        if self.device_name is not None:
+            return [device for device in inputs if self.device_name.lower() in device.name.lower()]
+        default = devices.default_index()
+        return sorted(inputs, key=lambda device: device.index != default)
+
+    def _rates(self, device):
+        if self.rates:
+            return list(self.rates)
+        rates = [self.sample_rate]
+        for rate in FALLBACK_RATES + [device.default_sample_rate]:
+            if rate not in rates:
+                rates.append(rate)
+        return rates
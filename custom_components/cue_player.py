@@ -0,0 +1,313 @@
+"""
+Short audio cues (beeps) played from memory.
+
+The WAVs in the cue directory (data/etc/wav) are read once at startup and
+played through an output stream that stays open, instead of asking the
+VLC media_player to spawn a process and decode the file for every beep.
+
+cue_player.play returns when the cue has been heard, output latency
+included, so the next step of an automation (e.g. stt_speech_recognition.listen)
+starts right after the beep. The end of the cue is also marked in the
+audio_capture stream, so the recorded command does not start with it.
+
+The sink can be a WAV file or nothing at all (null), which makes the cues
+usable on a machine without audio hardware.
+"""
+import asyncio
+import collections
+import logging
+import os
+import queue
+import threading
+import time
+import wave
+
+import voluptuous as vol
+from homeassistant.const import EVENT_HOMEASSISTANT_STOP
+from homeassistant.helpers import config_validation as cv
+
+from custom_components import audio_capture, loop_bridge, startup, voice_metrics
+
+_LOGGER = logging.getLogger(__name__)
+
+REQUIREMENTS = ['PyAudio>=0.2.8']
+
+DOMAIN = 'cue_player'
+DEPENDENCIES = [audio_capture.DOMAIN]
+
+# ------
+# Config
+# ------
+
+# Directory with the cues, one WAV per cue named after the file
+CONF_DIRECTORY = 'directory'
+
+# 'speaker', 'null' or the path of a WAV file receiving every cue played
+CONF_SINK = 'sink'
+
+# PyAudio output device index (defaults to the system default output)
+CONF_DEVICE_INDEX = 'device_index'
+
+# ----------------------
+# Configuration defaults
+# ----------------------
+
+DEFAULT_DIRECTORY = 'data/etc/wav'
+SINK_SPEAKER = 'speaker'
+SINK_NULL = 'null'
+DEFAULT_SINK = SINK_SPEAKER
+
+CONFIG_SCHEMA = vol.Schema({
+    DOMAIN: vol.Schema({
+        vol.Optional(CONF_DIRECTORY, DEFAULT_DIRECTORY): cv.string,
+        vol.Optional(CONF_SINK, DEFAULT_SINK): cv.string,
+        vol.Optional(CONF_DEVICE_INDEX): int
+    })
+}, extra=vol.ALLOW_EXTRA)
+
+# --------
+# Services
+# --------
+
+SERVICE_PLAY = 'play'
+
+# ----------------
+# Calls attributes
+# ----------------
+
+ATTR_CUE = 'cue'
+
+# Fired when a cue has been heard
+EVENT_CUE_PLAYED = 'cue_played'
+
+
+# -----------------------------------------------------------------------------
+# CUES
+
+Cue = collections.namedtuple('Cue', ['sample_rate', 'sample_width', 'channels', 'frames'])
+
+
+def cue_format(cue):
+    return cue.sample_rate, cue.sample_width, cue.channels
+
+
+def cue_seconds(cue):
+    return len(cue.frames) / float(cue.sample_rate * cue.sample_width * cue.channels)
+
+
+def load_cues(directory):
+    """name -> Cue for every WAV in directory."""
+    cues = collections.OrderedDict()
+    for file_name in sorted(os.listdir(directory)):
+        if not file_name.lower().endswith('.wav'):
+            continue
+        try:
+            with wave.open(os.path.join(directory, file_name), 'rb') as wav:
+                cues[os.path.splitext(file_name)[0]] = Cue(
+                    wav.getframerate(), wav.getsampwidth(), wav.getnchannels(), wav.readframes(wav.getnframes()))
+        except (OSError, wave.Error, EOFError) as error:
+            _LOGGER.warning('CUE_PLAYER: SKIPPING %s: %s' % (file_name, error))
+    return cues
+
+
+# -----------------------------------------------------------------------------
+# SINKS
+
+class SpeakerSink(object):
+    """PyAudio output stream, opened once and kept open between cues."""
+
+    def __init__(self, device_index=None):
+        self.device_index = device_index
+        self._audio = None
+        self._stream = None
+        self._format = None
+
+    def open(self, cue):
+        """Opens the stream for the format of cue, if not open for it already."""
+        if self._stream is not None and cue_format(cue) == self._format:
+            return
+        self.close()
+        import pyaudio
+        self._audio = pyaudio.PyAudio()
+        self._stream = self._audio.open(
+            format=self._audio.get_format_from_width(cue.sample_width), channels=cue.channels,
+            rate=cue.sample_rate, output=True, output_device_index=self.device_index)
+        self._format = cue_format(cue)
+
+    def play(self, cue):
+        """Returns once the cue has been heard."""
+        self.open(cue)
+        self._stream.write(cue.frames)
+        # write() returns when the last frames are queued, not played
+        time.sleep(self._stream.get_output_latency())
+
+    def close(self):
+        if self._stream is not None:
+            self._stream.stop_stream()
+            self._stream.close()
+            self._stream = None
+        if self._audio is not None:
+            self._audio.terminate()
+            self._audio = None
+
+
+class NullSink(object):
+    """Plays nothing, in real time unless told otherwise."""
+
+    def __init__(self, realtime=True):
+        self.realtime = realtime
+
+    def open(self, cue):
+        pass
+
+    def play(self, cue):
+        if self.realtime:
+            time.sleep(cue_seconds(cue))
+
+    def close(self):
+        pass
+
+
+class WaveFileSink(NullSink):
+    """Appends every cue played to a WAV file. Cues in another format than the first one are skipped."""
+
+    def __init__(self, path, realtime=True):
+        super().__init__(realtime)
+        self.path = path
+        self._wav = None
+        self._format = None
+
+    def open(self, cue):
+        if self._wav is None:
+            self._wav = wave.open(self.path, 'wb')
+            self._wav.setframerate(cue.sample_rate)
+            self._wav.setsampwidth(cue.sample_width)
+            self._wav.setnchannels(cue.channels)
+            self._format = cue_format(cue)
+
+    def play(self, cue):
+        self.open(cue)
+        if cue_format(cue) != self._format:
+            _LOGGER.warning('CUE_PLAYER: %s EXPECTS %s, CUE IS %s' % (self.path, self._format, cue_format(cue)))
+            return
+        self._wav.writeframes(cue.frames)
+        super().play(cue)
+
+    def close(self):
+        if self._wav is not None:
+            self._wav.close()
+            self._wav = None
+
+
+# -----------------------------------------------------------------------------
+# PLAYER
+
+class CuePlayer(object):
+    """Plays cues one after the other in its own thread."""
+
+    def __init__(self, cues, sink, capture=None):
+        self.cues = cues
+        self.sink = sink
+        # Told where each cue ended, so command readers skip it
+        self.capture = capture
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=DOMAIN, daemon=True)
+        self.stats = {
+            'played': 0,
+            'last_delay': None
+        }
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._queue.put(None)
+        self._thread.join(timeout=5.0)
+
+    def play(self, name, done=None):
+        """Queues a cue; done() is called from the player once it has been heard. False if unknown."""
+        cue = self.cues.get(name)
+        if cue is None:
+            return False
+        self._queue.put((cue, time.monotonic(), done))
+        return True
+
+    def _run(self):
+        if self.cues:
+            # Open the output now, not on the first beep
+            try:
+                self.sink.open(next(iter(self.cues.values())))
+            except Exception:
+                _LOGGER.exception('CUE_PLAYER: COULD NOT OPEN THE OUTPUT')
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            cue, queued_at, done = item
+            self.stats['last_delay'] = time.monotonic() - queued_at
+            try:
+                self.sink.play(cue)
+                self.stats['played'] += 1
+            except Exception:
+                _LOGGER.exception('CUE_PLAYER: PLAYBACK FAILED')
+            if self.capture is not None:
+                self.capture.mark(audio_capture.MARK_PLAYBACK)
+            if done is not None:
+                done()
+        self.sink.close()
+
+
+# -----------------------------------------------------------------------------
+
+def build_sink(sink, device_index=None):
+    if sink == SINK_SPEAKER:
+        return SpeakerSink(device_index)
+    if sink == SINK_NULL:
+        return NullSink()
+    return WaveFileSink(sink)
+
+
+@asyncio.coroutine
+def async_setup(hass, config):
+    started = time.monotonic()
+    conf = config.get(DOMAIN, {})
+    directory = hass.config.path(conf.get(CONF_DIRECTORY, DEFAULT_DIRECTORY))
+    sink_name = conf.get(CONF_SINK, DEFAULT_SINK)
+    if sink_name not in (SINK_SPEAKER, SINK_NULL):
+        sink_name = hass.config.path(sink_name)
+
+    assert os.path.isdir(directory), 'Cue directory does not exist: %s' % directory
+    cues = yield from hass.async_add_job(load_cues, directory)
+    player = CuePlayer(cues, build_sink(sink_name, conf.get(CONF_DEVICE_INDEX)), hass.data[audio_capture.DOMAIN])
+    player.start()
+    hass.data[DOMAIN] = player
+    bridge = loop_bridge.get(hass)
+
+    @asyncio.coroutine
+    def play(call):
+        name = call.data[ATTR_CUE]
+        correlation_id = voice_metrics.correlation_id(hass, call.data)
+        played = asyncio.Event()
+        if not player.play(name, lambda: bridge.call(played.set)):
+            _LOGGER.warning('CUE_PLAYER: UNKNOWN CUE %s, KNOWN: %s' % (name, ', '.join(cues)))
+            return
+        # Returns after the cue, so the next step of an automation follows it
+        yield from played.wait()
+        voice_metrics.mark(hass, correlation_id, EVENT_CUE_PLAYED)
+        hass.bus.async_fire(EVENT_CUE_PLAYED, {
+            ATTR_CUE: name,
+            voice_metrics.ATTR_CORRELATION_ID: correlation_id
+        })
+
+    @asyncio.coroutine
+    def async_terminate(event):
+        yield from hass.async_add_job(player.stop)
+
+    hass.services.async_register(DOMAIN, SERVICE_PLAY, play, schema=vol.Schema({
+        vol.Required(ATTR_CUE): cv.string,
+        vol.Optional(voice_metrics.ATTR_CORRELATION_ID): cv.string
+    }))
+    hass.bus.async_listen(EVENT_HOMEASSISTANT_STOP, async_terminate)
+    _LOGGER.info('CUE_PLAYER STARTED: %s to %s' % (', '.join(cues), sink_name))
+    startup.get(hass).setup_done(DOMAIN, started)
+    return True
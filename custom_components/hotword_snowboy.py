@@ -21,16 +21,21 @@ import logging
 import os
 import asyncio
 import threading
+import time
 
 import voluptuous as vol
 
 from homeassistant.const import CONF_NAME, EVENT_HOMEASSISTANT_STOP
 from homeassistant.helpers import intent, config_validation as cv
 
+from custom_components import audio_capture, loop_bridge, startup, voice_metrics
+
 _LOGGER = logging.getLogger(__name__)
 
 REQUIREMENTS = ['snowboy']
 
+DEPENDENCIES = [audio_capture.DOMAIN]
+
 DOMAIN = 'hotword_snowboy'
 
 # ------
@@ -47,6 +52,9 @@ CONF_SENSITIVITY = 'sensitivity'
 # Amount of audio gain when recording (defaults to 1.0)
 CONF_AUDIO_GAIN = 'audio_gain'
 
+# Keep firing events after a detection without waiting for listen (defaults to False)
+CONF_AUTO_REARM = 'auto_rearm'
+
 # ----------------------
 # Configuration defaults
 # ----------------------
@@ -54,6 +62,7 @@ CONF_AUDIO_GAIN = 'audio_gain'
 DEFAULT_NAME = 'hotword_snowboy'
 DEFAULT_SENSITIVITY = 0.5
 DEFAULT_AUDIO_GAIN = 1.0
+DEFAULT_AUTO_REARM = False
 
 CONFIG_SCHEMA = vol.Schema({
     DOMAIN: vol.Schema({
@@ -61,7 +70,8 @@ CONFIG_SCHEMA = vol.Schema({
 
         vol.Required(CONF_MODEL): cv.string,
         vol.Optional(CONF_SENSITIVITY, DEFAULT_SENSITIVITY): float,
-        vol.Optional(CONF_AUDIO_GAIN, DEFAULT_AUDIO_GAIN): float
+        vol.Optional(CONF_AUDIO_GAIN, DEFAULT_AUDIO_GAIN): float,
+        vol.Optional(CONF_AUTO_REARM, DEFAULT_AUTO_REARM): cv.boolean
     })
 }, extra=vol.ALLOW_EXTRA)
 
@@ -69,92 +79,225 @@ CONFIG_SCHEMA = vol.Schema({
 # Services
 # --------
 
+# Arms the resident detector: the next detection fires an event
 SERVICE_LISTEN = 'listen'
 
+# Disarms the resident detector: detections are ignored
+SERVICE_DISARM = 'disarm'
+
 # Represents the hotword detector
 OBJECT_SNOWBOY = '%s.decoder' % DOMAIN
 
 # Not doing anything
 STATE_IDLE = 'idle'
 
+# Loading the model and opening the microphone
+STATE_LOADING = 'loading'
+
 # Listening for the hotword
 STATE_LISTENING = 'listening'
 
 # Fired when the hotword is detected
 EVENT_HOTWORD_DETECTED = 'hotword_detected'
+# Unix time the hotword was detected, in the event data
+ATTR_DETECTED_AT = 'detected_at'
+
+# Seconds of audio before arm() that are still searched for the hotword
+REARM_PRE_ROLL = 0.5
+
+state_attrs = {
+    'friendly_name': 'Hotword',
+    'icon': 'mdi:microphone'
+}
+
+
+# -----------------------------------------------------------------------------
+# RESIDENT DETECTOR
+
+class ResidentDetector(object):
+    """
+    Keeps one snowboy detector, with its model loaded, alive for the whole
+    Home Assistant run, fed from the shared audio capture. Arming and
+    disarming only flip a flag, so there is no dead window between a
+    detection and the next listen call.
+
+    Nothing polls: while armed the thread sleeps until the next chunk of
+    audio, and while disarmed it sleeps until arm() or stop() without
+    processing any audio. With the audio_capture vad on, chunks without
+    speech are not run through the model either.
+    """
+
+    def __init__(self, capture, model, sensitivity, audio_gain, on_detected, auto_rearm=False):
+        self.capture = capture
+        self.model = model
+        self.sensitivity = sensitivity
+        self.audio_gain = audio_gain
+        self.auto_rearm = auto_rearm
+        self.load_time = None
+        # Chunks read; the thread wakes exactly once for each
+        self.chunks = 0
+        self.gate = capture.voice_gate()
+        self._on_detected = on_detected
+        # Called by the component with the correlation id of every command
+        # detected, in the detector thread (voice_assistant)
+        self.listeners = []
+        self._armed = threading.Event()
+        self._wake = threading.Condition()
+        self._session = capture.session()
+        self._terminated = False
+        self._detector = None
+        self._reader = None
+        self._thread = None
+
+    @property
+    def armed(self):
+        return self._armed.is_set()
+
+    def start(self, reader=None):
+        """
+        Loads the model once and starts following the capture, from now
+        unless another reader is given. Starts the capture if needed. Blocking.
+        """
+        from snowboy import snowboydecoder, snowboydetect
+
+        self.capture.start()
+        started = time.monotonic()
+        self._detector = snowboydetect.SnowboyDetect(
+            resource_filename=snowboydecoder.RESOURCE_FILE.encode(),
+            model_str=self.model.encode())
+        self._detector.SetAudioGain(self.audio_gain)
+        self._detector.SetSensitivity(str(self.sensitivity).encode())
+        assert self._detector.SampleRate() == self.capture.sample_rate, \
+            'Snowboy expects audio at %d Hz' % self._detector.SampleRate()
+        self.load_time = time.monotonic() - started
+        _LOGGER.info("HOTWORD_SNOWBOY: DETECTOR LOADED IN %.1f ms" % (1000 * self.load_time))
+
+        self._reader = reader or self.capture.reader()
+        self._thread = threading.Thread(target=self._run, name=DOMAIN, daemon=True)
+        self._thread.start()
+
+    def arm(self):
+        with self._wake:
+            self._armed.set()
+            self._wake.notify_all()
+
+    def disarm(self):
+        self._armed.clear()
+
+    def stop(self):
+        with self._wake:
+            self._terminated = True
+            self._armed.clear()
+            self._wake.notify_all()
+        self._session.cancel()
+        self.join(timeout=1.0)
+
+    def join(self, timeout=None):
+        """Waits for the detector thread, which ends when a finite source does."""
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._terminated:
+            if not self._armed.is_set():
+                self._sleep_until_armed()
+                continue
+            data = self._reader.read(self.capture.chunk_bytes, session=self._session)
+            if data is None:
+                if not self.capture.running or self._session.cancelled:
+                    break
+                continue
+            self.chunks += 1
+            data = self.gate.process(data)
+            if data is not None and self._detector.RunDetection(bytes(data)) > 0:
+                self._detected()
+
+    def _sleep_until_armed(self):
+        with self._wake:
+            while not self._armed.is_set() and not self._terminated:
+                self._wake.wait()
+        # Skip the audio heard while disarmed, keeping a little before arm()
+        self._reader = self.capture.reader(REARM_PRE_ROLL)
+        self.gate.reset()
+        self._detector.Reset()
+
+    def _detected(self):
+        if not self._armed.is_set():
+            return
+        if not self.auto_rearm:
+            self._armed.clear()
+        # Where the hotword ended in the stream, even if this reader lags
+        self.capture.mark(audio_capture.MARK_HOTWORD, self._reader.position)
+        self._on_detected()
 
 
 # -----------------------------------------------------------------------------
 
 @asyncio.coroutine
 def async_setup(hass, config):
+    started = time.monotonic()
     name = config[DOMAIN].get(CONF_NAME, DEFAULT_NAME)
     model = os.path.expanduser(config[DOMAIN].get(CONF_MODEL))
     sensitivity = config[DOMAIN].get(CONF_SENSITIVITY, DEFAULT_SENSITIVITY)
     audio_gain = config[DOMAIN].get(CONF_AUDIO_GAIN, DEFAULT_AUDIO_GAIN)
-
-    assert os.path.exists(model), 'Model does not exist'
-    detector = None
-    terminated = False
-    detected_event = threading.Event()
-
-    state_attrs = {
-        'friendly_name': 'Hotword',
-        'icon': 'mdi:microphone'
-    }
+    auto_rearm = config[DOMAIN].get(CONF_AUTO_REARM, DEFAULT_AUTO_REARM)
+
+    bridge = loop_bridge.get(hass)
+
+    def hotword_detected():
+        # Runs in the detector thread
+        if not detector.armed:
+            bridge.set_state(OBJECT_SNOWBOY, STATE_IDLE, state_attrs)
+        # A new voice command starts here
+        correlation_id = voice_metrics.new_correlation_id()
+        voice_metrics.mark(hass, correlation_id, EVENT_HOTWORD_DETECTED)
+        _LOGGER.warning("HOTWORD_SNOWBOY: KEYWORD DETECTED (%s)" % correlation_id)
+
+        # Fire detected event
+        bridge.fire(EVENT_HOTWORD_DETECTED, {
+            'name': name,       # name of the component
+            'model': model,     # model used
+            ATTR_DETECTED_AT: time.time(),
+            voice_metrics.ATTR_CORRELATION_ID: correlation_id
+        })
+        for listener in detector.listeners:
+            listener(correlation_id)
+
+    capture = hass.data[audio_capture.DOMAIN]
+    detector = ResidentDetector(capture, model, sensitivity, audio_gain, hotword_detected, auto_rearm)
+    hass.data[DOMAIN] = detector
 
     @asyncio.coroutine
     def async_listen(call):
-        nonlocal detected_event, terminated
-        from snowboy import snowboydecoder
-
-        interrupted = False
-
-        def interrupt_callback():
-            nonlocal interrupted, terminated
-            return interrupted or terminated
-
-        def detect():
-            detector = snowboydecoder.HotwordDetector(
-                model, sensitivity=sensitivity, audio_gain=audio_gain)
-
-            detector.start(lambda: detected_event.set(),
-                           interrupt_check=interrupt_callback,
-                           sleep_time=0.03)
-
-            detector.terminate()
-
-        # Run detector in a separate thread
-        detected_event.clear()
-        thread = threading.Thread(target=detect, daemon=True)
+        started = time.monotonic()
+        detector.arm()
         hass.states.async_set(OBJECT_SNOWBOY, STATE_LISTENING, state_attrs)
+        _LOGGER.info("HOTWORD_SNOWBOY: ARMED IN %.3f ms (DETECTOR LOAD TIME %.1f ms)" % (
+            1000 * (time.monotonic() - started), 1000 * (detector.load_time or 0)))
 
-        thread.start()
-        yield from asyncio.get_event_loop().run_in_executor(None, detected_event.wait)
-        interrupted = True
-
-        if not terminated:
-            hass.states.async_set(OBJECT_SNOWBOY, STATE_IDLE, state_attrs)
-            _LOGGER.warning("HOTWORD_SNOWBOY: KEYWORD DETECTED")
-
-            # Fire detected event
-            hass.bus.async_fire(EVENT_HOTWORD_DETECTED, {
-                'name': name,       # name of the component
-                'model': model      # model used
-            })
-
+    @asyncio.coroutine
+    def async_disarm(call):
+        detector.disarm()
+        hass.states.async_set(OBJECT_SNOWBOY, STATE_IDLE, state_attrs)
+
+    # The model is loaded after homeassistant_start; arming before only sets the flag
+    def load():
+        assert os.path.exists(model), 'Model does not exist'
+        detector.start()
+        bridge.set_state(OBJECT_SNOWBOY, STATE_LISTENING if detector.armed else STATE_IDLE, state_attrs)
+
+    hass.states.async_set(OBJECT_SNOWBOY, STATE_LOADING, state_attrs)
+    startup.get(hass).lazy(DOMAIN, load)
     hass.services.async_register(DOMAIN, SERVICE_LISTEN, async_listen)
-    hass.states.async_set(OBJECT_SNOWBOY, STATE_IDLE, state_attrs)
+    hass.services.async_register(DOMAIN, SERVICE_DISARM, async_disarm)
 
     # Make sure snowboy terminates property when home assistant stops
     @asyncio.coroutine
     def async_terminate(event):
-        nonlocal terminated
-        terminated = True
-        detected_event.set()
+        yield from hass.async_add_job(detector.stop)
 
     hass.bus.async_listen(EVENT_HOMEASSISTANT_STOP, async_terminate)
 
     _LOGGER.info('Started')
-
-    return True
\ No newline at end of file
+    startup.get(hass).setup_done(DOMAIN, started)
+    return True
@@ -2,12 +2,20 @@
 Requires:
 pip install paho-mqtt
 """
+import collections
+import itertools
 import logging
+import math
+import os
+import string
+import threading
+import time
 import voluptuous as vol
 import asyncio
 from homeassistant.const import EVENT_HOMEASSISTANT_STOP
 from homeassistant.helpers import config_validation as cv
-import paho.mqtt.client as mqtt
+
+from custom_components import jsgf, startup, voice_metrics
 
 REQUIREMENTS = ['paho-mqtt']
 _LOGGER = logging.getLogger(__name__)
@@ -21,13 +29,35 @@ DOMAIN = 'intent_table'
 CONFIG_PHRASE_LIST = 'prhase_list'
 CONFIG_TOPIC_LIST = 'topic_list'
 CONFIG_PAYLOAD_LIST = 'payload_list'
+# JSGF grammar whose sentences are commands, e.g. the pocketsphinx one
+CONFIG_GRAMMAR = 'grammar'
+# Grammar rule -> topic and payload templates, filled with the rules matched
+CONFIG_INTENTS = 'intents'
+CONFIG_TOPIC = 'topic'
+CONFIG_PAYLOAD = 'payload'
+# Lowest score (0 to 1) for a near miss to be taken as the closest phrase
+CONFIG_FUZZY_THRESHOLD = 'fuzzy_threshold'
 CONFIG_MQTT_BROKER = 'mqtt_broker'
 CONFIG_MQTT_PORT = 'mqtt_port'
 CONFIG_MQTT_COMMAND_NOT_FOUND_TOPIC = 'mqtt_topic_command_not_found'
 CONFIG_MQTT_SUCCESS_TOPIC = 'mqtt_success_topic'
+CONFIG_MQTT_QOS = 'mqtt_qos'
+CONFIG_MQTT_QUEUE_SIZE = 'mqtt_queue_size'
+# Status topics kept in the state cache (MQTT filter)
+CONFIG_STATE_TOPIC = 'state_topic'
+# Seconds a cached state answers status queries; 0 turns the cache off
+CONFIG_STATE_MAX_AGE = 'state_max_age'
+# Where cached states are published, as the devices answer a query
+CONFIG_STATE_ANSWER_TOPIC = 'state_answer_topic'
+# Grammar rule (slot) a command without one takes from the room it was spoken in
+CONFIG_ROOM_SLOT = 'room_slot'
 
 ATTR_TEXT = 'text'
 
+# Voice pipeline stages recorded by voice_metrics
+STAGE_PUBLISHED = 'intent_published'
+STAGE_NOT_FOUND = 'intent_not_found'
+
 # --------
 # Services
 # --------
@@ -41,8 +71,21 @@ SERVICE_PARSE = 'parse'
 DEFAULT_PHRASE_LIST = []
 DEFAULT_TOPIC_LIST = []
 DEFAULT_PAYLOAD_LIST = []
+DEFAULT_FUZZY_THRESHOLD = 0.7
 DEFAULT_MQTT_BROKER = 'localhost'
 DEFAULT_MQTT_PORT = 1883
+DEFAULT_MQTT_KEEPALIVE = 60
+DEFAULT_MQTT_QOS = 0
+DEFAULT_MQTT_QUEUE_SIZE = 100
+# paho.mqtt.client.MQTT_ERR_SUCCESS, paho being imported with the first publisher
+MQTT_ERR_SUCCESS = 0
+DEFAULT_STATE_TOPIC = 'hass/+/+/+/status'
+DEFAULT_STATE_MAX_AGE = 300
+DEFAULT_STATE_ANSWER_TOPIC = 'hass/ask_state'
+DEFAULT_ROOM_SLOT = 'local'
+
+# Payload of the intents asking a device for its state
+STATUS_PAYLOAD = 'STATUS'
 
 DEFAULT_MQTT_COMMAND_NOT_FOUND_TOPIC = 'hass/unknown_command'
 DEFAULT_MQTT_SUCCESS_TOPIC = 'hass/successful_command'
@@ -51,73 +94,618 @@ DEFAULT_SUCCESS_COMMAND = 'success'
 
 CONFIG_SCHEMA = vol.Schema({
     DOMAIN: vol.Schema({
-        vol.Required(CONFIG_PHRASE_LIST, DEFAULT_PHRASE_LIST): cv.ensure_list_csv,
-        vol.Required(CONFIG_TOPIC_LIST, DEFAULT_TOPIC_LIST): cv.ensure_list_csv,
-        vol.Required(CONFIG_PAYLOAD_LIST, DEFAULT_PAYLOAD_LIST): cv.ensure_list_csv,
+        vol.Optional(CONFIG_PHRASE_LIST, DEFAULT_PHRASE_LIST): cv.ensure_list_csv,
+        vol.Optional(CONFIG_TOPIC_LIST, DEFAULT_TOPIC_LIST): cv.ensure_list_csv,
+        vol.Optional(CONFIG_PAYLOAD_LIST, DEFAULT_PAYLOAD_LIST): cv.ensure_list_csv,
+        vol.Optional(CONFIG_GRAMMAR): cv.string,
+        vol.Optional(CONFIG_INTENTS, {}): {cv.string: vol.Schema({
+            vol.Required(CONFIG_TOPIC): cv.string,
+            vol.Required(CONFIG_PAYLOAD): cv.string
+        })},
+        vol.Optional(CONFIG_FUZZY_THRESHOLD, DEFAULT_FUZZY_THRESHOLD): vol.All(
+            vol.Coerce(float), vol.Range(min=0, max=1)),
         vol.Optional(CONFIG_MQTT_BROKER, DEFAULT_MQTT_BROKER): cv.string,
         vol.Optional(CONFIG_MQTT_PORT, DEFAULT_MQTT_PORT): int,
-        vol.Optional(CONFIG_MQTT_SUCCESS_TOPIC, DEFAULT_MQTT_SUCCESS_TOPIC): cv.string
+        vol.Optional(CONFIG_MQTT_SUCCESS_TOPIC, DEFAULT_MQTT_SUCCESS_TOPIC): cv.string,
+        vol.Optional(CONFIG_MQTT_QOS, DEFAULT_MQTT_QOS): vol.All(int, vol.In([0, 1, 2])),
+        vol.Optional(CONFIG_MQTT_QUEUE_SIZE, DEFAULT_MQTT_QUEUE_SIZE): vol.All(int, vol.Range(min=1)),
+        vol.Optional(CONFIG_STATE_TOPIC, DEFAULT_STATE_TOPIC): cv.string,
+        vol.Optional(CONFIG_STATE_MAX_AGE, DEFAULT_STATE_MAX_AGE): vol.All(vol.Coerce(float), vol.Range(min=0)),
+        vol.Optional(CONFIG_STATE_ANSWER_TOPIC, DEFAULT_STATE_ANSWER_TOPIC): cv.string,
+        vol.Optional(CONFIG_ROOM_SLOT, DEFAULT_ROOM_SLOT): cv.string
     })
 }, extra=vol.ALLOW_EXTRA)
 
 
+# -----------------------------------------------------------------------------
+# MQTT PUBLISHER
+
+class MqttPublisher(object):
+    """
+    Long-lived MQTT connection shared by every call of the component.
+
+    The paho network loop runs in its own thread and reconnects by itself, so
+    publish() never touches the network from the caller's thread. While the
+    broker is unreachable, messages wait in a bounded queue; once it is full,
+    new messages are refused (publish returns False) instead of piling up.
+    """
+
+    def __init__(self, broker, port, keepalive=DEFAULT_MQTT_KEEPALIVE,
+                 qos=DEFAULT_MQTT_QOS, queue_size=DEFAULT_MQTT_QUEUE_SIZE,
+                 client_id=None):
+        self.broker = broker
+        self.port = port
+        self.keepalive = keepalive
+        self.qos = qos
+        self.queue_size = queue_size
+
+        # Guards the outbound queue. Never held by the paho callbacks that
+        # run while paho holds its own message mutex (on_publish).
+        self._lock = threading.Lock()
+        # Guards the unacknowledged message bookkeeping only.
+        self._ack_lock = threading.Lock()
+        self._connected = False
+        self._pending = collections.deque()
+        self._inflight = {}
+        self._early_acks = set()
+        self._subscriptions = []
+        self.stats = {
+            'published': 0,
+            'acknowledged': 0,
+            'dropped': 0,
+            'reconnections': 0,
+            'last_ack_latency': None
+        }
+
+        import paho.mqtt.client as mqtt
+        self._client = mqtt.Client(client_id=client_id or '')
+        self._client.on_connect = self._on_connect
+        self._client.on_disconnect = self._on_disconnect
+        self._client.on_publish = self._on_publish
+        self._client.reconnect_delay_set(min_delay=1, max_delay=30)
+
+    @property
+    def connected(self):
+        return self._connected
+
+    @property
+    def client(self):
+        return self._client
+
+    @property
+    def backlog(self):
+        """Messages queued or sent and not yet acknowledged."""
+        return len(self._pending) + len(self._inflight)
+
+    def start(self):
+        """Starts connecting in the background. Never blocks on the broker."""
+        self._client.connect_async(self.broker, self.port, self.keepalive)
+        self._client.loop_start()
+
+    def stop(self, timeout=2.0):
+        """Waits up to timeout seconds for queued messages, then disconnects."""
+        deadline = time.monotonic() + timeout
+        while self._connected and self.backlog and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self._client.disconnect()
+        self._client.loop_stop()
+
+    def publish(self, topic, payload, qos=None, retain=False):
+        """
+        Non-blocking publish. Returns False when the message was refused
+        because the broker is down or slow and the outbound queue is full.
+        """
+        message = (topic, payload, self.qos if qos is None else qos, retain)
+        with self._lock:
+            if self.backlog >= self.queue_size:
+                self.stats['dropped'] += 1
+                _LOGGER.warning("INTENT_TABLE: MQTT QUEUE FULL, DROPPING %s ON TOPIC %s" % (payload, topic))
+                return False
+            if not self._connected or self._pending or not self._send(message):
+                self._pending.append(message)
+        return True
+
+    def subscribe(self, topic, callback):
+        """
+        Calls callback(topic, payload) from the network thread for every
+        message on topic (an MQTT filter), across reconnections.
+        """
+        self._client.message_callback_add(
+            topic, lambda client, userdata, message: callback(message.topic, message.payload))
+        with self._lock:
+            self._subscriptions.append(topic)
+            if self._connected:
+                self._client.subscribe(topic, self.qos)
+
+    def _send(self, message):
+        # Called with self._lock held. Returns False if paho refused it.
+        topic, payload, qos, retain = message
+        sent_at = time.monotonic()
+        info = self._client.publish(topic, payload, qos=qos, retain=retain)
+        if info.rc != MQTT_ERR_SUCCESS:
+            return False
+        self.stats['published'] += 1
+        with self._ack_lock:
+            if info.mid in self._early_acks:
+                # The network thread was faster than us
+                self._early_acks.discard(info.mid)
+                self._acknowledge(sent_at)
+            else:
+                self._inflight[info.mid] = sent_at
+        return True
+
+    def _acknowledge(self, sent_at):
+        self.stats['acknowledged'] += 1
+        self.stats['last_ack_latency'] = time.monotonic() - sent_at
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            _LOGGER.warning("INTENT_TABLE: MQTT CONNECTION REFUSED (rc=%d)" % rc)
+            return
+        _LOGGER.info("INTENT_TABLE: MQTT CLIENT CONNECTED ON %s:%d" % (self.broker, self.port))
+        with self._lock:
+            self._connected = True
+            # The broker forgets subscriptions with the session
+            for topic in self._subscriptions:
+                self._client.subscribe(topic, self.qos)
+            while self._pending:
+                if not self._send(self._pending[0]):
+                    break
+                self._pending.popleft()
+
+    def _on_disconnect(self, client, userdata, rc):
+        with self._lock:
+            self._connected = False
+        with self._ack_lock:
+            # QoS 0 messages not yet written will never be acknowledged
+            self._inflight.clear()
+            self._early_acks.clear()
+        if rc != 0:
+            self.stats['reconnections'] += 1
+            _LOGGER.warning("INTENT_TABLE: MQTT CONNECTION LOST (rc=%d), RECONNECTING" % rc)
+
+    def _on_publish(self, client, userdata, mid):
+        with self._ack_lock:
+            sent_at = self._inflight.pop(mid, None)
+            if sent_at is None:
+                self._early_acks.add(mid)
+            else:
+                self._acknowledge(sent_at)
+
+
+# -----------------------------------------------------------------------------
+# STATE CACHE
+
+def status_topic(command_topic):
+    """hass/switch/sala/luz1/set -> hass/switch/sala/luz1/status"""
+    base = command_topic[:-len('/set')] if command_topic.endswith('/set') else command_topic
+    return '%s/status' % base
+
+
+class StateCache(object):
+    """
+    Latest state of each device, from the status topics the switches publish
+    (retained, so the broker sends them all when the cache subscribes).
+
+    route() answers status queries from it: while the state of the device was
+    received less than max_age seconds ago, the query is published straight
+    to the answer topic instead of going to the device and back.
+    """
+
+    def __init__(self, max_age, answer_topic=DEFAULT_STATE_ANSWER_TOPIC):
+        self.max_age = max_age
+        self.answer_topic = answer_topic
+        # topic -> (payload, monotonic time received); replaced, never mutated
+        self._states = {}
+        self.stats = {
+            'hits': 0,
+            'stale': 0,
+            'misses': 0
+        }
+
+    def __len__(self):
+        return len(self._states)
+
+    def update(self, topic, payload):
+        """Called from the MQTT network thread."""
+        if isinstance(payload, bytes):
+            payload = payload.decode('utf-8', 'replace')
+        if payload:
+            self._states[topic] = (payload, time.monotonic())
+        else:
+            # An empty retained message clears the topic
+            self._states.pop(topic, None)
+
+    def get(self, topic):
+        """The state published on topic, or None if unknown or stale."""
+        state = self._states.get(topic)
+        if state is None:
+            self.stats['misses'] += 1
+            return None
+        payload, received = state
+        if time.monotonic() - received > self.max_age:
+            self.stats['stale'] += 1
+            return None
+        self.stats['hits'] += 1
+        return payload
+
+    def route(self, topic, payload):
+        """(topic, payload, cached) to publish for a command."""
+        if payload == STATUS_PAYLOAD:
+            state = self.get(status_topic(topic))
+            if state is not None:
+                return self.answer_topic, state, True
+        return topic, payload, False
+
+
+# -----------------------------------------------------------------------------
+# FUZZY INDEX
+
+# Grammar sentences indexed for near misses; the rest are only parsed exactly
+MAX_FUZZY_SENTENCES = 50000
+# A near miss this close to two different commands is not resolved
+FUZZY_AMBIGUITY_MARGIN = 0.05
+FUZZY_RUNNERS_UP = 4
+NGRAM = 3
+# Words less alike than this (trigram Dice) do not count as the same word
+WORD_SIMILARITY = 0.5
+# Words in more than this share of the phrases are skipped when counting
+COMMON_WORD_SHARE = 0.5
+
+
+def ngrams(word):
+    padded = ' %s ' % word
+    return frozenset(padded[i:i + NGRAM] for i in range(len(padded) - NGRAM + 1))
+
+
+def dice(common, first, second):
+    return 2.0 * common / (first + second) if first + second else 0.0
+
+
+class FuzzyIndex(object):
+    """
+    Finds the known phrase closest to a misrecognized one.
+
+    Words are compared by their character trigrams, so 'acender' is most of
+    'ascender', and phrases by their sets of words: the score is the Dice
+    coefficient of the two sets, each query word counting as much as its
+    closest word in the phrase. An extra or dropped article only costs the
+    difference in length.
+
+    Two inverted indexes keep lookups away from most phrases: trigram ->
+    vocabulary words, to find the words close to each query word, and word
+    -> phrases. Only phrases with enough of those words to reach the
+    threshold are scored, and they are counted without reading the posting
+    lists of words found in most phrases, like the verbs.
+    """
+
+    def __init__(self, phrases):
+        self.phrases = []
+        self._words = []
+        self._postings = collections.defaultdict(list)
+        self._grams = {}
+        self._vocabulary = collections.defaultdict(list)
+        for phrase in collections.OrderedDict.fromkeys(' '.join(p.split()) for p in phrases):
+            words = tuple(collections.OrderedDict.fromkeys(phrase.split()))
+            for word in words:
+                if word not in self._grams:
+                    self._grams[word] = ngrams(word)
+                    for gram in self._grams[word]:
+                        self._vocabulary[gram].append(word)
+                self._postings[word].append(len(self.phrases))
+            self.phrases.append(phrase)
+            self._words.append(words)
+        self.candidates = 0
+
+    def __len__(self):
+        return len(self.phrases)
+
+    def similar(self, word):
+        """{vocabulary word: similarity} of the words close to word."""
+        if word in self._grams:
+            return {word: 1.0}
+        grams = ngrams(word)
+        counts = collections.Counter(itertools.chain.from_iterable(self._vocabulary.get(g, ()) for g in grams))
+        similar = {}
+        for other, common in counts.items():
+            similarity = dice(common, len(grams), len(self._grams[other]))
+            if similarity >= WORD_SIMILARITY:
+                similar[other] = similarity
+        return similar
+
+    def search(self, phrase, threshold, limit=2, accept=None):
+        """
+        Up to limit (score, phrase) pairs at or above threshold, best first.
+        With accept, only the phrases it returns True for are scored.
+        """
+        words = list(collections.OrderedDict.fromkeys(phrase.split()))
+        if not words:
+            return []
+        similar = [self.similar(word) for word in words]
+        # A score >= threshold needs a sum of word similarities (each <= 1)
+        # of at least threshold * len(words) / (2 - threshold), so at least
+        # `needed` query words must have a close word in the phrase
+        needed = max(1, int(math.ceil(threshold * len(words) / (2 - threshold) - 1e-9)))
+        sizes = sorted((sum(len(self._postings[w]) for w in close), n) for n, close in enumerate(similar))
+        common = len(self.phrases) * COMMON_WORD_SHARE
+        skipped = min(needed - 1, sum(1 for size, _ in sizes if size > common))
+        counts = collections.Counter()
+        for _, n in sizes[:len(sizes) - skipped]:
+            counts.update(set(itertools.chain.from_iterable(self._postings[w] for w in similar[n])))
+        candidates = [index for index, count in counts.items()
+                      if count >= needed - skipped and (accept is None or accept(self.phrases[index]))]
+        self.candidates += len(candidates)
+
+        found = []
+        for index in candidates:
+            phrase_words = self._words[index]
+            total = sum(max([close.get(word, 0.0) for word in phrase_words]) for close in similar)
+            score = 2.0 * total / (len(words) + len(phrase_words))
+            if score >= threshold:
+                found.append((score, self.phrases[index]))
+        found.sort(key=lambda match: (-match[0], match[1]))
+        return found[:limit]
+
+
+# -----------------------------------------------------------------------------
+# INTENT TABLE
+
+class IntentTable(object):
+    """
+    Maps recognized phrases to the MQTT topic and payload of their command.
+
+    Phrases listed one by one are looked up first. Then the phrase is parsed
+    with the grammar, if there is one: the outermost rule with templates
+    decides the command, and its templates are filled with what each rule
+    matched, e.g. 'hass/switch/{local}/luz1/set' and '{acao}'. Nothing is
+    enumerated, so adding a room to <local> costs one word. Slots the
+    sentence left out are taken from defaults, e.g. {'local': 'cozinha'}
+    for a command spoken in the kitchen.
+
+    With a fuzzy threshold, match() also takes near misses: the listed
+    phrases and the grammar sentences (up to MAX_FUZZY_SENTENCES) are indexed
+    once, and a phrase that is not a command resolves to its closest one.
+    Sentences that leave a slot to defaults are only candidates when the
+    defaults have it, and never when the phrase has a word they have nothing
+    close to: 'ligar luz sla' names a room, just not one that was heard.
+    """
+
+    def __init__(self, phrases, topics, payloads, grammar=None, templates=None, fuzzy_threshold=None):
+        assert len(topics) == len(phrases), 'Assign exactly one topic for each phrase'
+        assert len(topics) == len(payloads), 'Assign exactly one payload for each topic'
+        self.intents = dict(zip(phrases, zip(topics, payloads)))
+        # rule -> (topic template, payload template)
+        self.templates = dict(templates or {})
+        self.automaton = None
+        if grammar is not None:
+            unknown = set(self.templates) - set(grammar.rules)
+            assert not unknown, 'Intents for rules not in the grammar: %s' % ', '.join(sorted(unknown))
+            self.automaton = grammar.compile()
+        # rule -> names of the slots its templates are filled with
+        self._fields = {rule: frozenset(field for template in templates
+                                        for _, field, _, _ in string.Formatter().parse(template) if field)
+                        for rule, templates in self.templates.items()}
+        self.fuzzy_threshold = fuzzy_threshold
+        self.fuzzy = None
+        # Indexed sentence -> slots it leaves to defaults, for those that leave any
+        self._needs = {}
+        if fuzzy_threshold is not None:
+            self.fuzzy = FuzzyIndex(self._fuzzy_phrases())
+            for phrase in self.fuzzy.phrases:
+                _, rule, slots = self._parse(phrase)
+                if rule is not None and self._fields[rule] - set(slots):
+                    self._needs[phrase] = self._fields[rule] - set(slots)
+
+    def _fuzzy_phrases(self):
+        for phrase in self.intents:
+            yield phrase
+        if self.automaton is None:
+            return
+        for count, tokens in enumerate(self.automaton.sentences()):
+            if count == MAX_FUZZY_SENTENCES:
+                _LOGGER.warning("INTENT_TABLE: ONLY THE FIRST %d GRAMMAR SENTENCES ARE INDEXED FOR NEAR MISSES"
+                                % MAX_FUZZY_SENTENCES)
+                return
+            yield ' '.join(tokens)
+
+    def __len__(self):
+        return len(self.intents) + len(self.templates)
+
+    def _parse(self, phrase):
+        """(listed intent, rule with templates, slots) of the phrase; None for what it is not."""
+        intent = self.intents.get(phrase)
+        if intent is not None or self.automaton is None:
+            return intent, None, None
+        slots = self.automaton.parse(phrase.split())
+        if not slots:
+            return None, None, None
+        rules = [rule for rule in self.templates if rule in slots]
+        if not rules:
+            return None, None, None
+        # Outer rules match more words than the rules nested in them
+        return None, max(sorted(rules), key=lambda r: len(slots[r].split())), slots
+
+    def _resolve(self, phrase, defaults=None, quiet=False):
+        """(intent, whether the phrase is a command): a command without intent lacks a slot."""
+        intent, rule, slots = self._parse(phrase)
+        if rule is None:
+            return intent, intent is not None
+        topic, payload = self.templates[rule]
+        if defaults:
+            slots = dict(defaults, **slots)
+        try:
+            return (topic.format(**slots), payload.format(**slots)), True
+        except (KeyError, IndexError) as error:
+            if not quiet:
+                _LOGGER.warning("INTENT_TABLE: TEMPLATE OF <%s> NEEDS MISSING SLOT %s" % (rule, error))
+            return None, True
+
+    def lookup(self, phrase, defaults=None):
+        """(topic, payload) of the command, or None if the phrase is unknown."""
+        return self._resolve(phrase, defaults)[0]
+
+    def match(self, phrase, defaults=None):
+        """
+        (intent, matched phrase, score): the exact command if there is one,
+        with score 1, else the closest phrase above the fuzzy threshold.
+        (None, None, 0.0) when nothing is close enough, when two different
+        commands are about as close, or when the phrase is a command whose
+        template needs a slot neither it nor the defaults have.
+        """
+        intent, command = self._resolve(phrase, defaults)
+        if intent is not None:
+            return intent, phrase, 1.0
+        if command or self.fuzzy is None:
+            return None, None, 0.0
+        available = set(defaults or ())
+        similar = [self.fuzzy.similar(word) for word in phrase.split()]
+
+        def accept(candidate):
+            needs = self._needs.get(candidate)
+            if needs is None:
+                return True
+            # A word the candidate has nothing close to may be the slot it leaves out
+            words = candidate.split()
+            return needs <= available and all(any(word in close for word in words) for close in similar)
+
+        # Runners-up just under the threshold still make the best one ambiguous
+        matches = [(score, candidate, self._resolve(candidate, defaults, quiet=True)[0])
+                   for score, candidate in self.fuzzy.search(
+                       phrase, max(0.0, self.fuzzy_threshold - FUZZY_AMBIGUITY_MARGIN),
+                       limit=FUZZY_RUNNERS_UP + 1, accept=accept)]
+        if not matches or matches[0][0] < self.fuzzy_threshold:
+            return None, None, 0.0
+        score, candidate, intent = matches[0]
+        for other_score, other, other_intent in matches[1:]:
+            if other_intent != intent and score - other_score < FUZZY_AMBIGUITY_MARGIN:
+                _LOGGER.warning("INTENT_TABLE: '%s' IS AS CLOSE TO '%s' (%.2f) AS TO '%s' (%.2f)"
+                                % (phrase, candidate, score, other, other_score))
+                return None, None, 0.0
+        return intent, candidate, score
+
+
+# -----------------------------------------------------------------------------
+# HANDLER
+
+class IntentHandler(object):
+    """
+    Publishes the intent of a spoken phrase, or the phrase on the not found
+    topic. Shared by the parse service, voice_assistant and satellite, which
+    call it directly from their own threads.
+    """
+
+    def __init__(self, hass, table, publisher, states, success_topic, notfound_topic,
+                 room_slot=DEFAULT_ROOM_SLOT):
+        self.hass = hass
+        self.table = table
+        self.publisher = publisher
+        self.states = states
+        self.success_topic = success_topic
+        self.notfound_topic = notfound_topic
+        self.room_slot = room_slot
+
+    def handle(self, spoken_phrase, correlation_id, room=None):
+        """
+        True if an intent was published. A command that names no room (e.g.
+        'ligar luz') goes to room, the room it was spoken in. Safe from any thread.
+        """
+        _LOGGER.info('INTENT_TABLE RECEIVED DATA: %s (ROOM %s)' % (spoken_phrase, room))
+        defaults = {self.room_slot: room} if room else None
+        intent, matched_phrase, score = self.table.match(spoken_phrase, defaults)
+        if intent is None:
+            _LOGGER.warning("INTENT NOT FOUND: %s" % spoken_phrase)
+            _LOGGER.warning("PUBLISHING : %s ON TOPIC %s" % (spoken_phrase, self.notfound_topic))
+            self.publisher.publish(self.notfound_topic, spoken_phrase)
+            voice_metrics.mark(self.hass, correlation_id, STAGE_NOT_FOUND)
+            return False
+
+        topic, payload = intent
+        if self.states is not None:
+            topic, payload, cached = self.states.route(topic, payload)
+            if cached:
+                _LOGGER.info("STATE OF %s ANSWERED FROM CACHE: %s" % (intent[0], payload))
+        if matched_phrase == spoken_phrase:
+            _LOGGER.info("INTENT FOUND: %s" % spoken_phrase)
+        else:
+            _LOGGER.warning("INTENT FOUND BY NEAR MISS: %s -> %s (SCORE %.2f)"
+                            % (spoken_phrase, matched_phrase, score))
+        self.publisher.publish(topic, payload)
+        self.publisher.publish(self.success_topic, DEFAULT_SUCCESS_COMMAND)
+        voice_metrics.mark(self.hass, correlation_id, STAGE_PUBLISHED)
+        _LOGGER.info("PUBLISHED %s ON TOPIC %s" % (DEFAULT_SUCCESS_COMMAND, self.success_topic))
+        _LOGGER.warning("PUBLISHED %s ON TOPIC %s" % (payload, topic))
+        return True
+
+
 # -----------------------------------------------------------------------------
 
 @asyncio.coroutine
 def async_setup(hass, config):
+    started = time.monotonic()
     phrases_json = config[DOMAIN].get(CONFIG_PHRASE_LIST, DEFAULT_PHRASE_LIST)
     topics_json = config[DOMAIN].get(CONFIG_TOPIC_LIST, DEFAULT_TOPIC_LIST)
     payloads_json = config[DOMAIN].get(CONFIG_PAYLOAD_LIST, DEFAULT_PAYLOAD_LIST)
     mqtt_broker = config[DOMAIN].get(CONFIG_MQTT_BROKER, DEFAULT_MQTT_BROKER)
     mqtt_port = config[DOMAIN].get(CONFIG_MQTT_PORT, DEFAULT_MQTT_PORT)
+    mqtt_qos = config[DOMAIN].get(CONFIG_MQTT_QOS, DEFAULT_MQTT_QOS)
+    mqtt_queue_size = config[DOMAIN].get(CONFIG_MQTT_QUEUE_SIZE, DEFAULT_MQTT_QUEUE_SIZE)
     notfound_topic = config[DOMAIN].get(CONFIG_MQTT_COMMAND_NOT_FOUND_TOPIC, DEFAULT_MQTT_COMMAND_NOT_FOUND_TOPIC)
     success_topic = config[DOMAIN].get(CONFIG_MQTT_SUCCESS_TOPIC, DEFAULT_MQTT_SUCCESS_TOPIC)
+    state_topic = config[DOMAIN].get(CONFIG_STATE_TOPIC, DEFAULT_STATE_TOPIC)
+    state_max_age = config[DOMAIN].get(CONFIG_STATE_MAX_AGE, DEFAULT_STATE_MAX_AGE)
+    state_answer_topic = config[DOMAIN].get(CONFIG_STATE_ANSWER_TOPIC, DEFAULT_STATE_ANSWER_TOPIC)
+
+    grammar_path = config[DOMAIN].get(CONFIG_GRAMMAR)
+    intents = config[DOMAIN].get(CONFIG_INTENTS, {})
+    fuzzy_threshold = config[DOMAIN].get(CONFIG_FUZZY_THRESHOLD, DEFAULT_FUZZY_THRESHOLD)
+    room_slot = config[DOMAIN].get(CONFIG_ROOM_SLOT, DEFAULT_ROOM_SLOT)
+
+    # Grammar, table, index and broker connection are set up after
+    # homeassistant_start, or by the first command
+    def load():
+        grammar = None
+        if grammar_path is not None:
+            assert os.path.exists(grammar_path), 'Grammar does not exist in path %s' % grammar_path
+            grammar = jsgf.Grammar.load(grammar_path)
+        table = IntentTable(
+            list(phrases_json), list(topics_json), list(payloads_json), grammar,
+            {rule: (i[CONFIG_TOPIC], i[CONFIG_PAYLOAD]) for rule, i in intents.items()},
+            fuzzy_threshold if fuzzy_threshold < 1 else None)
+        _LOGGER.info("INTENTS LOADED: %s, TEMPLATES: %s, INDEXED FOR NEAR MISSES: %d" % (
+            str(table.intents), str(table.templates), len(table.fuzzy) if table.fuzzy is not None else 0))
 
-    topics = [c for c in topics_json]
-    phrases = [p for p in phrases_json]
-    payloads = [p for p in payloads_json]
-    assert len(topics) == len(phrases), 'Assign exactly one topic for each phrase'
-    assert len(topics) == len(payloads), 'Assign exactly one payload for each topic'
-    indexed_topics = dict(zip(phrases, topics))
-    indexed_payloads = dict(zip(phrases, payloads))
-    _LOGGER.info("INTENTS LOADED: %s" % str(indexed_topics))
+        publisher = MqttPublisher(mqtt_broker, mqtt_port, qos=mqtt_qos, queue_size=mqtt_queue_size)
+        states = None
+        if state_max_age > 0:
+            states = StateCache(state_max_age, state_answer_topic)
+            publisher.subscribe(state_topic, states.update)
+        publisher.start()
+        publisher.publish('hass/say', "Olá eu sou o gênio")
+        return IntentHandler(hass, table, publisher, states, success_topic, notfound_topic, room_slot)
+
+    loaded = startup.get(hass).lazy(DOMAIN, load)
+    # voice_assistant and satellite take the handler from here
+    hass.data[DOMAIN] = loaded
 
     @asyncio.coroutine
-    async def parse(call):
-        client = mqtt.Client()
-        client.connect(mqtt_broker, mqtt_port, 60)
-        client.loop_start()
-        _LOGGER.info("INTENT_TABLE: MQTT CLIENT CONNECTED ON %s:%d" % (mqtt_broker, mqtt_port))
+    def parse(call):
         spoken_phrase = call.data.get(ATTR_TEXT, DEFAULT_UNKNOWN_COMMAND)
-        _LOGGER.info('INTENT_TABLE RECEIVED DATA: %s' % spoken_phrase)
-        if spoken_phrase in indexed_topics.keys() and spoken_phrase in indexed_payloads:
-            topic = indexed_topics.get(spoken_phrase)
-            payload = indexed_payloads.get(spoken_phrase)
-            _LOGGER.info("INTENT FOUND: %s" % spoken_phrase)
-            client.publish(topic, payload)
-            client.publish(success_topic, DEFAULT_SUCCESS_COMMAND)
-            _LOGGER.info("PUBLISHED %s ON TOPIC %s" % (DEFAULT_SUCCESS_COMMAND, success_topic))
-            _LOGGER.warning("PUBLISHED %s ON TOPIC %s" % (payload, topic))
-        else:
-            _LOGGER.warning("INTENT NOT FOUND: %s" % spoken_phrase)
-            _LOGGER.warning("PUBLISHING : %s ON TOPIC %s" % (spoken_phrase, notfound_topic))
-            client.publish(notfound_topic, spoken_phrase)
-        client.disconnect()
+        handler = yield from loaded.async_get(hass)
+        handler.handle(spoken_phrase, voice_metrics.correlation_id(hass, call.data))
 
     # Make sure module terminates property when home assistant stops
     @asyncio.coroutine
     def terminate(event):
-        client = mqtt.Client()
-        client.connect(mqtt_broker, mqtt_port, 60)
         _LOGGER.info('INTENT_TABLE EXITING')
-        client.publish(success_topic, DEFAULT_SUCCESS_COMMAND)
+        if not loaded.ready:
+            return
+        publisher = loaded.get().publisher
+        publisher.publish(success_topic, DEFAULT_SUCCESS_COMMAND)
+        yield from hass.async_add_job(publisher.stop)
 
     # After defining values and functions, register services in Home Assistant
     hass.services.async_register(DOMAIN, SERVICE_PARSE, parse)
     hass.bus.async_listen(EVENT_HOMEASSISTANT_STOP, terminate)
-    client = mqtt.Client()
-    client.connect(mqtt_broker, mqtt_port, 60)
-    client.publish('hass/say', "Olá eu sou o gênio")
     _LOGGER.info('INTENT_TABLE STARTED')
+    startup.get(hass).setup_done(DOMAIN, started)
     return True
-
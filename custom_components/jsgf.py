@@ -0,0 +1,346 @@
+"""
+Minimal JSGF reader shared by the voice components (not a Home Assistant
+component by itself).
+
+Parses the subset of JSGF used in data/pocketsphinx (alternatives, groups,
+optionals, rule references, * and + repetitions and {tags}) and compiles a
+rule into a token automaton. Determinization is lazy: each (state, token)
+transition is computed once and memoized, so advancing by one word costs a
+dictionary lookup however large the grammar is.
+
+Automaton.parse also tells which rules a sentence went through, and the
+words or {tag} each of them matched, so rule references work as slots.
+"""
+import re
+
+_TOKEN_RE = re.compile(r'''
+    (?P<rule><[^>\s]+>)
+  | (?P<tag>\{[^}]*\})
+  | (?P<quoted>"[^"]*")
+  | (?P<symbol>[()\[\]|*+;=])
+  | (?P<word>[^\s()\[\]|*+;=<>{}"]+)
+''', re.VERBOSE)
+
+_COMMENT_RE = re.compile(r'//[^\n]*|/\*.*?\*/', re.DOTALL)
+_HEADER_RE = re.compile(r'^\s*#JSGF[^;]*;', re.MULTILINE)
+_STATEMENT_RE = re.compile(r'^\s*(grammar|import)\s+[^;]*;', re.MULTILINE)
+_GRAMMAR_NAME_RE = re.compile(r'^\s*grammar\s+([^;\s]+)\s*;', re.MULTILINE)
+
+
+class GrammarError(ValueError):
+    pass
+
+
+# -----------------------------------------------------------------------------
+# PARSER
+
+class Grammar(object):
+    """
+    Parsed JSGF grammar. Expansions are nested tuples:
+    ('word', w), ('ref', name), ('seq', items), ('alt', items),
+    ('opt', item), ('repeat', item, minimum) and ('tag', item, text).
+    """
+
+    def __init__(self, text):
+        text = _COMMENT_RE.sub('', text)
+        name = _GRAMMAR_NAME_RE.search(text)
+        self.name = name.group(1) if name else None
+        text = _HEADER_RE.sub('', text)
+        text = _STATEMENT_RE.sub('', text)
+
+        self.rules = {}
+        self.public = []
+        tokens = self._tokenize(text)
+        position = 0
+        while position < len(tokens):
+            public = tokens[position] == ('word', 'public')
+            if public:
+                position += 1
+            kind, rule = tokens[position]
+            if kind != 'rule' or tokens[position + 1] != ('symbol', '='):
+                raise GrammarError('Expected a rule definition near %s' % rule)
+            end = tokens.index(('symbol', ';'), position)
+            expansion, consumed = self._parse_alternatives(tokens[position + 2:end], 0)
+            if consumed != end - position - 2:
+                raise GrammarError('Unexpected %s in rule %s' % (tokens[position + 2 + consumed][1], rule))
+            # As in sphinxbase, the first definition of a rule wins
+            self.rules.setdefault(rule, expansion)
+            if public and rule not in self.public:
+                self.public.append(rule)
+            position = end + 1
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding='utf-8') as grammar_file:
+            return cls(grammar_file.read())
+
+    @staticmethod
+    def _tokenize(text):
+        tokens = []
+        for match in _TOKEN_RE.finditer(text):
+            kind = match.lastgroup
+            value = match.group(kind)
+            if kind == 'rule':
+                value = value[1:-1]
+            elif kind == 'quoted':
+                kind, value = 'word', value[1:-1]
+            elif kind == 'tag':
+                value = value[1:-1].strip()
+            tokens.append((kind, value))
+        return tokens
+
+    def _parse_alternatives(self, tokens, position):
+        items = []
+        sequence, position = self._parse_sequence(tokens, position)
+        items.append(sequence)
+        while position < len(tokens) and tokens[position] == ('symbol', '|'):
+            sequence, position = self._parse_sequence(tokens, position + 1)
+            items.append(sequence)
+        return (items[0] if len(items) == 1 else ('alt', items)), position
+
+    def _parse_sequence(self, tokens, position):
+        items = []
+        while position < len(tokens):
+            kind, value = tokens[position]
+            if kind == 'symbol' and value in '|)]':
+                break
+            if kind == 'symbol' and value in '([':
+                inner, position = self._parse_alternatives(tokens, position + 1)
+                closing = ')' if value == '(' else ']'
+                if position >= len(tokens) or tokens[position] != ('symbol', closing):
+                    raise GrammarError('Missing %s' % closing)
+                item = inner if value == '(' else ('opt', inner)
+            elif kind == 'word':
+                item = ('word', value)
+            elif kind == 'rule':
+                item = ('ref', value)
+            else:
+                raise GrammarError('Unexpected %s' % value)
+            position += 1
+
+            # Postfix operators and tags
+            while position < len(tokens):
+                kind, value = tokens[position]
+                if (kind, value) == ('symbol', '*'):
+                    item = ('repeat', item, 0)
+                elif (kind, value) == ('symbol', '+'):
+                    item = ('repeat', item, 1)
+                elif kind == 'tag':
+                    item = ('tag', item, value)
+                else:
+                    break
+                position += 1
+            items.append(item)
+        return (items[0] if len(items) == 1 else ('seq', items)), position
+
+    def default_rule(self):
+        """The rule named after the grammar if there is one, else the first public rule."""
+        if self.name in self.rules:
+            return self.name
+        if not self.public:
+            raise GrammarError('Grammar has no public rule')
+        return self.public[0]
+
+    def compile(self, rule=None):
+        return Automaton(self, rule or self.default_rule())
+
+
+# -----------------------------------------------------------------------------
+# AUTOMATON
+
+class Automaton(object):
+    """
+    Token automaton accepting exactly the sentences of one rule.
+
+    Each word edge is labelled with the rules it is nested in and the tag in
+    scope in each of them. The automaton has one state per word and group
+    of the grammar text, so it grows with the sum of the alternatives, not
+    with the number of sentences they combine into.
+    """
+
+    START = 0
+    DEAD = -1
+
+    def __init__(self, grammar, rule):
+        self.grammar = grammar
+        self.rule = rule
+        self._edges = []
+        self._epsilon = []
+        # (state, token, target) -> ((rule, tag), ...) from the outermost rule
+        self._labels = {}
+        self._single_closures = {}
+        start = self._new_state()
+        final = self._new_state()
+        self._build(('ref', rule), start, final, ())
+        self._final = final
+        self._start = start
+
+        # Deterministic states are created on demand
+        self._closures = [self._closure({start})]
+        self._closure_ids = {self._closures[0]: self.START}
+        self._transitions = [{}]
+
+    def _new_state(self):
+        self._edges.append({})
+        self._epsilon.append([])
+        return len(self._edges) - 1
+
+    def _build(self, node, entry, exit, expanding, scope=()):
+        kind = node[0]
+        if kind == 'word':
+            self._edges[entry].setdefault(node[1], set()).add(exit)
+            # Ambiguous grammars: the first way a word was reached wins
+            self._labels.setdefault((entry, node[1], exit), scope)
+        elif kind == 'ref':
+            name = node[1]
+            if name == 'NULL':
+                self._epsilon[entry].append(exit)
+                return
+            if name == 'VOID':
+                return
+            if name not in self.grammar.rules:
+                raise GrammarError('Unknown rule <%s>' % name)
+            if name in expanding:
+                raise GrammarError('Recursive rule <%s> is not supported' % name)
+            self._build(self.grammar.rules[name], entry, exit, expanding + (name,), scope + ((name, None),))
+        elif kind == 'seq':
+            current = entry
+            for item in node[1][:-1]:
+                following = self._new_state()
+                self._build(item, current, following, expanding, scope)
+                current = following
+            self._build(node[1][-1], current, exit, expanding, scope)
+        elif kind == 'alt':
+            for item in node[1]:
+                self._build(item, entry, exit, expanding, scope)
+        elif kind == 'opt':
+            self._build(node[1], entry, exit, expanding, scope)
+            self._epsilon[entry].append(exit)
+        elif kind == 'repeat':
+            # Private entry and exit so the loop cannot leak into siblings
+            loop_entry = self._new_state()
+            loop_exit = self._new_state()
+            self._epsilon[entry].append(loop_entry)
+            self._build(node[1], loop_entry, loop_exit, expanding, scope)
+            self._epsilon[loop_exit].append(loop_entry)
+            self._epsilon[loop_exit].append(exit)
+            if node[2] == 0:
+                self._epsilon[entry].append(exit)
+        elif kind == 'tag':
+            # The tag is the value of the innermost rule around it
+            if scope:
+                scope = scope[:-1] + ((scope[-1][0], node[2]),)
+            self._build(node[1], entry, exit, expanding, scope)
+
+    def _closure(self, states):
+        stack = list(states)
+        closure = set(states)
+        while stack:
+            for following in self._epsilon[stack.pop()]:
+                if following not in closure:
+                    closure.add(following)
+                    stack.append(following)
+        return frozenset(closure)
+
+    def advance(self, state, token):
+        """Next state after token, or DEAD if no sentence continues this way."""
+        if state == self.DEAD:
+            return self.DEAD
+        following = self._transitions[state].get(token)
+        if following is None:
+            targets = set()
+            for nfa_state in self._closures[state]:
+                targets.update(self._edges[nfa_state].get(token, ()))
+            if not targets:
+                following = self.DEAD
+            else:
+                closure = self._closure(targets)
+                following = self._closure_ids.get(closure)
+                if following is None:
+                    following = len(self._closures)
+                    self._closures.append(closure)
+                    self._closure_ids[closure] = following
+                    self._transitions.append({})
+            self._transitions[state][token] = following
+        return following
+
+    def is_final(self, state):
+        return state != self.DEAD and self._final in self._closures[state]
+
+    def can_continue(self, state):
+        """True if some longer sentence starts with what was consumed."""
+        return state != self.DEAD and any(self._edges[s] for s in self._closures[state])
+
+    def run(self, tokens, state=START):
+        for token in tokens:
+            state = self.advance(state, token)
+            if state == self.DEAD:
+                break
+        return state
+
+    def accepts(self, tokens):
+        return self.is_final(self.run(tokens))
+
+    def parse(self, tokens):
+        """
+        Returns {rule: value} for every rule the sentence went through, the
+        value being the {tag} in scope in that rule or else the words it
+        matched; or None if the sentence is not accepted.
+
+        Simulates the automaton over its states rather than the determinized
+        one, carrying one path per state, so it runs in a single pass over
+        the tokens and keeps no table of sentences.
+        """
+        # state -> path, as (token, scope, previous) links, first path wins
+        paths = {s: None for s in self._state_closure(self._start)}
+        for token in tokens:
+            following = {}
+            for state, path in paths.items():
+                for target in self._edges[state].get(token, ()):
+                    step = (token, self._labels[(state, token, target)], path)
+                    for reached in self._state_closure(target):
+                        if reached not in following:
+                            following[reached] = step
+            if not following:
+                return None
+            paths = following
+        if self._final not in paths:
+            return None
+
+        steps = []
+        path = paths[self._final]
+        while path is not None:
+            token, scope, path = path
+            steps.append((token, scope))
+        words = {}
+        tags = {}
+        for token, scope in reversed(steps):
+            for rule, tag in scope:
+                words.setdefault(rule, []).append(token)
+                if tag is not None:
+                    tags[rule] = tag
+        return {rule: tags.get(rule, ' '.join(matched)) for rule, matched in words.items()}
+
+    def sentences(self, max_length=16):
+        """
+        Yields every sentence of up to max_length words, as token lists.
+        Grammars with repetitions have infinitely many: take what you need.
+        """
+        stack = [(self.START, ())]
+        while stack:
+            state, tokens = stack.pop()
+            if self.is_final(state):
+                yield list(tokens)
+            if len(tokens) >= max_length:
+                continue
+            words = set()
+            for nfa_state in self._closures[state]:
+                words.update(self._edges[nfa_state])
+            for word in sorted(words, reverse=True):
+                stack.append((self.advance(state, word), tokens + (word,)))
+
+    def _state_closure(self, state):
+        closure = self._single_closures.get(state)
+        if closure is None:
+            closure = self._single_closures[state] = self._closure({state})
+        return closure
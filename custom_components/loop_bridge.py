@@ -0,0 +1,82 @@
+"""
+Hands events and state updates from worker threads to the event loop (not
+a Home Assistant component by itself).
+
+Detector, recognizer and TTS threads must not call hass.states.async_set or
+hass.bus.async_fire, and hass.states.set blocks the thread until the loop
+runs it. Instead they push updates here: appending to a deque is atomic, so
+producers never take a lock, and the loop drains everything pushed since
+the last drain in one callback, scheduled with a single
+call_soon_threadsafe. Within a batch only the last state of each entity is
+written; events are all fired, in the order they were pushed.
+"""
+import collections
+import logging
+
+_LOGGER = logging.getLogger(__name__)
+
+# Key of the shared bridge in hass.data
+DATA_BRIDGE = 'loop_bridge'
+
+_STATE = 0
+_EVENT = 1
+_CALL = 2
+
+
+def get(hass):
+    """The bridge shared by every component of this Home Assistant."""
+    bridge = hass.data.get(DATA_BRIDGE)
+    if bridge is None:
+        bridge = hass.data.setdefault(DATA_BRIDGE, LoopBridge(hass))
+    return bridge
+
+
+class LoopBridge(object):
+
+    def __init__(self, hass):
+        self.hass = hass
+        # Drains run, items pushed and states dropped for a newer one
+        self.batches = 0
+        self.items = 0
+        self.coalesced = 0
+        self._pending = collections.deque()
+        self._scheduled = False
+
+    def set_state(self, entity_id, state, attributes=None):
+        self._push((_STATE, entity_id, state, attributes))
+
+    def fire(self, event_type, data=None):
+        self._push((_EVENT, event_type, data, None))
+
+    def call(self, callback, *args):
+        """Runs callback(*args) on the loop, in order with the other updates."""
+        self._push((_CALL, callback, args, None))
+
+    def _push(self, item):
+        self._pending.append(item)
+        # A drain clears the flag before it starts popping, so this item is
+        # either seen by a drain already scheduled or schedules a new one
+        if not self._scheduled:
+            self._scheduled = True
+            self.hass.loop.call_soon_threadsafe(self._drain)
+
+    def _drain(self):
+        self._scheduled = False
+        batch = []
+        while self._pending:
+            batch.append(self._pending.popleft())
+        last = {item[1]: index for index, item in enumerate(batch) if item[0] == _STATE}
+        self.batches += 1
+        self.items += len(batch)
+        self.coalesced += sum(1 for item in batch if item[0] == _STATE) - len(last)
+        for index, (kind, target, value, attributes) in enumerate(batch):
+            try:
+                if kind == _STATE:
+                    if last[target] == index:
+                        self.hass.states.async_set(target, value, attributes)
+                elif kind == _EVENT:
+                    self.hass.bus.async_fire(target, value)
+                else:
+                    target(*value)
+            except Exception:
+                _LOGGER.exception("LOOP_BRIDGE: UPDATE FAILED: %s" % str(target))
@@ -0,0 +1,624 @@
+"""
+Microphones in other rooms (satellites) sending their commands to this
+Home Assistant.
+
+A satellite is a small process next to a microphone: the shared capture, the
+snowboy hotword (or none, to record commands back to back) and a VoiceGate
+(webrtcvad). After the hotword it streams only the audio the gate lets
+through, from the first word until the silence after the last one, over a
+TCP socket, ADPCM compressed (4 bits per sample, a quarter of the PCM) or as
+plain PCM. Nothing else leaves the room, and nothing is decoded there.
+
+    python3 -m custom_components.satellite --room quarto --central genio:10555 \\
+        --model /opt/cefetmg/data/etc/genio.pmdl
+
+This component is the other end: it accepts any number of satellites, and
+decodes their commands in a thread pool as large as the stt_speech_recognition
+decoder processes (decoder_processes: auto is one per core but one), so
+commands spoken in different rooms at the same time are decoded in parallel.
+The text goes to intent_table with the room of the satellite, so 'ligar luz'
+said in the kitchen switches the kitchen light, while 'ligar luz sala'
+still switches the living room one. The satellite gets the text back.
+
+Commands reach intent_table (doors included), so the component listens
+only on localhost unless told otherwise. To take satellites from the
+network, set host and a token, and start each satellite with the same
+--token: connections without it are dropped.
+
+Protocol: frames of a one byte kind and a four byte length (network order),
+then the payload. The satellite says HELLO (JSON: room, sample_rate, codec
+and token) once, and for each command START (JSON: correlation_id), AUDIO frames and
+END; the central answers RESULT (JSON: correlation_id, text, understood and
+the seconds it took after END).
+"""
+import argparse
+import asyncio
+import audioop
+import collections
+import concurrent.futures
+import hmac
+import json
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+
+import voluptuous as vol
+
+from homeassistant.const import CONF_HOST, CONF_PORT, CONF_TOKEN, EVENT_HOMEASSISTANT_STOP
+from homeassistant.helpers import config_validation as cv
+
+from custom_components import audio_capture, intent_table, loop_bridge, startup, stt_speech_recognition, \
+    voice_metrics
+
+_LOGGER = logging.getLogger(__name__)
+
+DEPENDENCIES = [stt_speech_recognition.DOMAIN, intent_table.DOMAIN]
+
+DOMAIN = 'satellite'
+
+# ------------------------
+# Configuration parameters
+# ------------------------
+
+# Commands decoded at the same time (defaults to the decoder processes)
+CONF_WORKERS = 'workers'
+# Longest command accepted, in seconds of audio
+CONF_MAX_COMMAND = 'max_command'
+
+# ----------------------
+# Configuration defaults
+# ----------------------
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 10555
+DEFAULT_MAX_COMMAND = 15.0
+
+CODEC_PCM = 'pcm'
+CODEC_ADPCM = 'adpcm'
+CODECS = [CODEC_PCM, CODEC_ADPCM]
+DEFAULT_CODEC = CODEC_ADPCM
+
+# Satellite side: seconds to wait for the first word, and longest command
+DEFAULT_COMMAND_TIMEOUT = 4.0
+DEFAULT_COMMAND_LIMIT = 10.0
+# Seconds a satellite waits for the text of a command
+DEFAULT_RESULT_TIMEOUT = 30.0
+DEFAULT_RECONNECT = 5.0
+
+CONFIG_SCHEMA = vol.Schema({
+    DOMAIN: vol.Schema({
+        vol.Optional(CONF_HOST, DEFAULT_HOST): cv.string,
+        vol.Optional(CONF_PORT, DEFAULT_PORT): cv.port,
+        vol.Optional(CONF_TOKEN): cv.string,
+        vol.Optional(CONF_WORKERS): vol.All(int, vol.Range(min=1)),
+        vol.Optional(CONF_MAX_COMMAND, DEFAULT_MAX_COMMAND): vol.All(vol.Coerce(float), vol.Range(min=1))
+    })
+}, extra=vol.ALLOW_EXTRA)
+
+# ----------
+# Protocol
+# ----------
+
+FRAME_HEADER = struct.Struct('!BI')
+KIND_HELLO = 1
+KIND_START = 2
+KIND_AUDIO = 3
+KIND_END = 4
+KIND_RESULT = 5
+# Larger frames are a broken or foreign peer
+MAX_FRAME = 1 << 20
+
+SAMPLE_WIDTH = audio_capture.SAMPLE_WIDTH
+# The decoders take 16 kHz audio, as the capture front end delivers it
+SAMPLE_RATE = 16000
+
+# ---------------------------------------
+# Events, objects and states of satellites
+# ---------------------------------------
+
+# Fired for each command decoded, with room, text, understood and correlation_id
+EVENT_SATELLITE_COMMAND = 'satellite_command'
+
+# One entity per room heard from, the state is the last text
+OBJECT_FORMAT = '%s.%s'
+
+state_attrs = {
+    'icon': 'mdi:access-point'
+}
+
+
+class SatelliteError(Exception):
+    pass
+
+
+# -----------------------------------------------------------------------------
+# FRAMES AND CODECS
+
+def frame(kind, payload=b''):
+    return FRAME_HEADER.pack(kind, len(payload)) + payload
+
+
+def json_frame(kind, data):
+    return frame(kind, json.dumps(data).encode())
+
+
+def read_frame(sock):
+    """(kind, payload) of the next frame on a blocking socket. Raises ConnectionError when it closes."""
+    kind, size = FRAME_HEADER.unpack(_read_exactly(sock, FRAME_HEADER.size))
+    if size > MAX_FRAME:
+        raise SatelliteError('Frame of %d bytes' % size)
+    return kind, _read_exactly(sock, size)
+
+
+def _read_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('Connection closed')
+        data += chunk
+    return bytes(data)
+
+
+@asyncio.coroutine
+def async_read_frame(reader):
+    """(kind, payload) of the next frame on an asyncio stream, or None when it closes."""
+    try:
+        header = yield from reader.readexactly(FRAME_HEADER.size)
+        kind, size = FRAME_HEADER.unpack(header)
+        if size > MAX_FRAME:
+            raise SatelliteError('Frame of %d bytes' % size)
+        payload = yield from reader.readexactly(size)
+    except asyncio.IncompleteReadError:
+        return None
+    return kind, payload
+
+
+class Codec(object):
+    """
+    Encodes or decodes the audio of one command. ADPCM keeps its predictor
+    between chunks, so a new Codec (or reset()) is needed for each command.
+    """
+
+    def __init__(self, name=DEFAULT_CODEC):
+        if name not in CODECS:
+            raise SatelliteError('Unknown codec %s' % name)
+        self.name = name
+        self._state = None
+
+    def reset(self):
+        self._state = None
+
+    def encode(self, data):
+        if self.name == CODEC_PCM:
+            return bytes(data)
+        encoded, self._state = audioop.lin2adpcm(bytes(data), SAMPLE_WIDTH, self._state)
+        return encoded
+
+    def decode(self, data):
+        if self.name == CODEC_PCM:
+            return data
+        decoded, self._state = audioop.adpcm2lin(data, SAMPLE_WIDTH, self._state)
+        return decoded
+
+
+# -----------------------------------------------------------------------------
+# SATELLITE
+
+def command_chunks(capture, reader, gate, timeout=DEFAULT_COMMAND_TIMEOUT, limit=DEFAULT_COMMAND_LIMIT,
+                   session=None):
+    """
+    Chunks of one spoken command, as the gate lets them through: from the
+    first word (with the gate's pre-roll) until the gate closes again. Ends
+    without any chunk when nobody speaks for timeout seconds, and after
+    limit seconds in any case. Blocking.
+    """
+    gate.reset()
+    chunk_seconds = capture.bytes_to_seconds(capture.chunk_bytes)
+    recorded = 0.0
+    heard_speech = False
+    while recorded < limit:
+        data = reader.read(capture.chunk_bytes, timeout=1.0, session=session)
+        if data is None:
+            if not capture.running or (session is not None and session.cancelled):
+                return
+            continue
+        recorded += chunk_seconds
+        data = gate.process(data)
+        if data is not None:
+            heard_speech = True
+            yield bytes(data)
+        elif heard_speech or recorded >= timeout:
+            return
+
+
+class SatelliteClient(object):
+    """Connection of a satellite to the central Home Assistant. Blocking, one command at a time."""
+
+    def __init__(self, host, port, room, codec=DEFAULT_CODEC, result_timeout=DEFAULT_RESULT_TIMEOUT, token=None):
+        self.host = host
+        self.port = port
+        self.room = room
+        self.codec = codec
+        # Shared with the central, which drops satellites without it
+        self.token = token
+        self.result_timeout = result_timeout
+        # PCM bytes recorded and bytes sent for them
+        self.stats = {
+            'commands': 0,
+            'pcm_bytes': 0,
+            'sent_bytes': 0,
+            'connects': 0
+        }
+        self._socket = None
+
+    @property
+    def connected(self):
+        return self._socket is not None
+
+    def connect(self):
+        if self._socket is not None:
+            return
+        sock = socket.create_connection((self.host, self.port), timeout=self.result_timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        hello = {'room': self.room, 'sample_rate': SAMPLE_RATE, 'codec': self.codec}
+        if self.token is not None:
+            hello['token'] = self.token
+        sock.sendall(json_frame(KIND_HELLO, hello))
+        self._socket = sock
+        self.stats['connects'] += 1
+        _LOGGER.info('SATELLITE %s: CONNECTED TO %s:%d (%s)' % (self.room, self.host, self.port, self.codec))
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def send_command(self, chunks, correlation_id=None):
+        """
+        Streams the chunks of one command as they come and returns the
+        central's RESULT (correlation_id, text, understood), or None when
+        there were no chunks. The connection is dropped on any error.
+        """
+        correlation_id = correlation_id or voice_metrics.new_correlation_id()
+        encoder = Codec(self.codec)
+        started = False
+        try:
+            for chunk in chunks:
+                if not started:
+                    self.connect()
+                    self._socket.sendall(json_frame(KIND_START, {'correlation_id': correlation_id}))
+                    started = True
+                payload = encoder.encode(chunk)
+                self._socket.sendall(frame(KIND_AUDIO, payload))
+                self.stats['pcm_bytes'] += len(chunk)
+                self.stats['sent_bytes'] += len(payload)
+            if not started:
+                return None
+            self._socket.sendall(frame(KIND_END))
+            self.stats['commands'] += 1
+            while True:
+                kind, payload = read_frame(self._socket)
+                if kind != KIND_RESULT:
+                    continue
+                result = json.loads(payload.decode())
+                if result.get('correlation_id') == correlation_id:
+                    return result
+        except (OSError, ValueError, SatelliteError):
+            self.close()
+            raise
+
+
+class Satellite(object):
+    """
+    Records commands in one room and sends them to the central. With a
+    snowboy model each command follows the hotword; without one, commands
+    are taken back to back (replaying a WAV file, for instance).
+    """
+
+    def __init__(self, capture, client, model=None, sensitivity=0.5, audio_gain=1.0,
+                 timeout=DEFAULT_COMMAND_TIMEOUT, limit=DEFAULT_COMMAND_LIMIT, on_result=None):
+        self.capture = capture
+        self.client = client
+        self.model = model
+        self.sensitivity = sensitivity
+        self.audio_gain = audio_gain
+        self.timeout = timeout
+        self.limit = limit
+        self.on_result = on_result
+        # webrtcvad even when the capture has none: only speech is sent
+        self.gate = audio_capture.VoiceGate(capture, **(capture.vad or {
+            'aggressiveness': audio_capture.DEFAULT_VAD_AGGRESSIVENESS}))
+        self._session = capture.session()
+        self._hotword = threading.Event()
+        self._detector = None
+
+    def run(self):
+        """Until the capture stops (the end of a WAV file) or stop(). Blocking."""
+        self.capture.start()
+        reader = None
+        if self.model is not None:
+            from custom_components.hotword_snowboy import ResidentDetector
+            self._detector = ResidentDetector(self.capture, self.model, self.sensitivity, self.audio_gain,
+                                              self._hotword.set)
+            self._detector.start()
+            self._detector.arm()
+        else:
+            reader = self.capture.reader()
+
+        while self.capture.running and not self._session.cancelled:
+            if self._detector is not None:
+                if not self._hotword.wait(1.0):
+                    continue
+                self._hotword.clear()
+                reader = self.capture.command_reader()
+            chunks = command_chunks(self.capture, reader, self.gate, self.timeout, self.limit, self._session)
+            try:
+                result = self.client.send_command(chunks)
+            except (OSError, ValueError, SatelliteError) as error:
+                _LOGGER.warning('SATELLITE %s: COMMAND LOST: %s' % (self.client.room, error))
+                result = None
+                if not self._session.cancelled:
+                    time.sleep(DEFAULT_RECONNECT)
+            if result is not None:
+                _LOGGER.warning('SATELLITE %s: %s' % (self.client.room, result))
+                if self.on_result is not None:
+                    self.on_result(result)
+            if self._detector is not None:
+                self._detector.arm()
+        self.client.close()
+
+    def stop(self):
+        self._session.cancel()
+        if self._detector is not None:
+            self._detector.stop()
+
+
+# -----------------------------------------------------------------------------
+# CENTRAL
+
+class SatelliteServer(object):
+    """
+    Accepts satellites on host:port and decodes their commands on workers
+    threads: decode(raw_data) gives the text (None if not understood) and
+    handle(text, correlation_id, room) acts on it. on_command(room,
+    correlation_id, text, understood) is called in the worker thread.
+    With a token, satellites that do not say it in HELLO are dropped.
+
+    Audio arrives while the command is spoken and is decoded once it ends;
+    a connection waits only for its own commands.
+    """
+
+    def __init__(self, decode, handle, workers=1, host=DEFAULT_HOST, port=DEFAULT_PORT,
+                 max_command=DEFAULT_MAX_COMMAND, on_command=None, token=None):
+        self.decode = decode
+        self.handle = handle
+        self.workers = workers
+        self.host = host
+        self.port = port
+        self.token = token
+        self.max_bytes = int(max_command * SAMPLE_RATE) * SAMPLE_WIDTH
+        self.on_command = on_command
+        self.stats = {
+            'satellites': 0,
+            'commands': collections.Counter(),
+            'understood': 0,
+            'received_bytes': 0,
+            'pcm_bytes': 0,
+            'decode_seconds': 0.0,
+            'busy': 0,
+            'max_busy': 0
+        }
+        self._executor = None
+        self._server = None
+        self._busy_lock = threading.Lock()
+
+    @property
+    def address(self):
+        """(host, port) actually listened on; port 0 picks a free one."""
+        return self._server.sockets[0].getsockname()[:2]
+
+    @asyncio.coroutine
+    def start(self):
+        self._executor = concurrent.futures.ThreadPoolExecutor(self.workers)
+        self._server = yield from asyncio.start_server(self._serve, self.host, self.port)
+        _LOGGER.info('SATELLITE: LISTENING ON %s:%d, %d WORKERS' % (self.address + (self.workers,)))
+        if self.token is None and self.host not in ('127.0.0.1', 'localhost', '::1'):
+            _LOGGER.warning('SATELLITE: ANYONE REACHING %s:%d CAN SEND COMMANDS, SET A TOKEN' % self.address)
+
+    @asyncio.coroutine
+    def stop(self):
+        if self._server is not None:
+            self._server.close()
+            yield from self._server.wait_closed()
+            self._server = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    @asyncio.coroutine
+    def _serve(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        room = None
+        connected = False
+        try:
+            received = yield from async_read_frame(reader)
+            if received is None or received[0] != KIND_HELLO:
+                raise SatelliteError('%s did not say hello' % (peer,))
+            hello = json.loads(received[1].decode())
+            room = hello['room']
+            if self.token is not None and not hmac.compare_digest(
+                    str(hello.get('token', '')).encode(), self.token.encode()):
+                raise SatelliteError('%s from %s has a wrong token' % (room, peer))
+            if hello.get('sample_rate', SAMPLE_RATE) != SAMPLE_RATE:
+                raise SatelliteError('%s sends %s Hz audio' % (room, hello['sample_rate']))
+            codec = Codec(hello.get('codec', CODEC_PCM))
+            self.stats['satellites'] += 1
+            connected = True
+            _LOGGER.warning('SATELLITE %s CONNECTED FROM %s (%s)' % (room, peer, codec.name))
+
+            correlation_id, audio = None, None
+            while True:
+                received = yield from async_read_frame(reader)
+                if received is None:
+                    break
+                kind, payload = received
+                self.stats['received_bytes'] += len(payload)
+                if kind == KIND_START:
+                    correlation_id = json.loads(payload.decode())['correlation_id']
+                    audio = bytearray()
+                    codec.reset()
+                elif kind == KIND_AUDIO and audio is not None:
+                    if len(audio) < self.max_bytes:
+                        audio += codec.decode(payload)
+                elif kind == KIND_END and audio is not None:
+                    del audio[self.max_bytes:]
+                    self.stats['pcm_bytes'] += len(audio)
+                    ended = time.monotonic()
+                    text, understood = yield from asyncio.get_event_loop().run_in_executor(
+                        self._executor, self._command, room, correlation_id, bytes(audio))
+                    writer.write(json_frame(KIND_RESULT, {
+                        'correlation_id': correlation_id,
+                        'text': text,
+                        'understood': understood,
+                        'seconds': time.monotonic() - ended
+                    }))
+                    yield from writer.drain()
+                    correlation_id, audio = None, None
+        except (OSError, ValueError, KeyError, SatelliteError) as error:
+            _LOGGER.warning('SATELLITE %s: CONNECTION DROPPED: %s' % (room or peer, error))
+        finally:
+            writer.close()
+            if connected:
+                self.stats['satellites'] -= 1
+
+    def _command(self, room, correlation_id, audio):
+        with self._busy_lock:
+            self.stats['busy'] += 1
+            self.stats['max_busy'] = max(self.stats['max_busy'], self.stats['busy'])
+        understood = False
+        try:
+            started = time.monotonic()
+            try:
+                text = self.decode(audio)
+            except stt_speech_recognition.DecoderPoolError as error:
+                _LOGGER.warning('SATELLITE %s: DECODER ERROR: %s' % (room, error))
+                text = None
+            decoded = time.monotonic() - started
+            understood = bool(self.handle(text or stt_speech_recognition.DEFAULT_UNKNOWN_COMMAND,
+                                          correlation_id, room))
+        finally:
+            with self._busy_lock:
+                self.stats['busy'] -= 1
+                self.stats['commands'][room] += 1
+                self.stats['understood'] += understood
+        self.stats['decode_seconds'] += decoded
+        _LOGGER.warning('SATELLITE %s: %.1f s OF AUDIO DECODED IN %.0f ms, TEXT %s, UNDERSTOOD %s' % (
+            room, len(audio) / float(SAMPLE_WIDTH * SAMPLE_RATE), 1000 * decoded, text, understood))
+        if self.on_command is not None:
+            self.on_command(room, correlation_id, text, understood)
+        return text, understood
+
+
+# -----------------------------------------------------------------------------
+
+@asyncio.coroutine
+def async_setup(hass, config):
+    started = time.monotonic()
+    conf = config.get(DOMAIN, {})
+    stt_conf = config.get(stt_speech_recognition.DOMAIN, {})
+    # The in-process decoder takes one command at a time
+    workers = conf.get(CONF_WORKERS) or max(1, stt_speech_recognition.decoder_process_count(
+        stt_conf.get(stt_speech_recognition.CONF_DECODER_PROCESSES,
+                     stt_speech_recognition.DEFAULT_DECODER_PROCESSES)))
+    bridge = loop_bridge.get(hass)
+    decode = hass.data[stt_speech_recognition.DATA_DECODE]
+    # Built by intent_table after homeassistant_start, or by the first command
+    intents = hass.data[intent_table.DOMAIN]
+
+    def on_command(room, correlation_id, text, understood):
+        # Runs in a worker thread
+        voice_metrics.mark(hass, correlation_id, stt_speech_recognition.EVENT_SPEECH_TO_TEXT)
+        bridge.set_state(OBJECT_FORMAT % (DOMAIN, room), text or stt_speech_recognition.DEFAULT_UNKNOWN_COMMAND,
+                         dict(state_attrs, friendly_name='Satellite %s' % room, understood=understood))
+        bridge.fire(EVENT_SATELLITE_COMMAND, {
+            'room': room,
+            'text': text,
+            'understood': understood,
+            voice_metrics.ATTR_CORRELATION_ID: correlation_id
+        })
+
+    server = SatelliteServer(
+        decode, lambda text, correlation_id, room: intents.get().handle(text, correlation_id, room), workers,
+        conf.get(CONF_HOST, DEFAULT_HOST), conf.get(CONF_PORT, DEFAULT_PORT),
+        conf.get(CONF_MAX_COMMAND, DEFAULT_MAX_COMMAND), on_command, conf.get(CONF_TOKEN))
+    hass.data[DOMAIN] = server
+
+    yield from server.start()
+
+    @asyncio.coroutine
+    def async_terminate(event):
+        yield from server.stop()
+
+    hass.bus.async_listen(EVENT_HOMEASSISTANT_STOP, async_terminate)
+    startup.get(hass).setup_done(DOMAIN, started)
+    return True
+
+
+# -----------------------------------------------------------------------------
+# SATELLITE PROCESS
+
+def _device_profiles(device_name):
+    from custom_components import audio_devices
+    return audio_devices.DeviceProfiles(
+        os.path.abspath(audio_capture.DEFAULT_PROFILE), SAMPLE_RATE,
+        lambda rate: audio_capture.FrontEnd.blocks(rate, SAMPLE_RATE, audio_capture.DEFAULT_FRAMES_PER_BUFFER)[0],
+        device_name=device_name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sends the commands spoken in a room to Home Assistant.')
+    parser.add_argument('--room', required=True, help='room slot of the grammar, e.g. quarto')
+    parser.add_argument('--central', default='localhost:%d' % DEFAULT_PORT, help='host:port of the satellite component')
+    parser.add_argument('--model', help='snowboy model; without it commands are recorded back to back')
+    parser.add_argument('--sensitivity', type=float, default=0.5)
+    parser.add_argument('--wav', help='replay this 16 bit mono WAV file instead of the microphone')
+    parser.add_argument('--device-name', help='part of the name of the input device')
+    parser.add_argument('--codec', choices=CODECS, default=DEFAULT_CODEC)
+    parser.add_argument('--token', default=os.environ.get('SATELLITE_TOKEN'),
+                        help='token of the satellite component (default: $SATELLITE_TOKEN)')
+    parser.add_argument('--vad-aggressiveness', type=int, default=audio_capture.DEFAULT_VAD_AGGRESSIVENESS)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    if args.wav:
+        source = audio_capture.WaveFileSource(args.wav, realtime=True)
+        input_rate = source.sample_rate
+    else:
+        input_rate = SAMPLE_RATE
+        profiles = _device_profiles(args.device_name)
+        source = audio_capture.PyAudioSource(SAMPLE_RATE, profiles=profiles)
+    front_end = None
+    if input_rate != SAMPLE_RATE:
+        front_end = audio_capture.FrontEnd(input_rate, SAMPLE_RATE, high_pass=0, agc=False, limit=1.0)
+    capture = audio_capture.AudioCapture(source, vad={'aggressiveness': args.vad_aggressiveness},
+                                         front_end=front_end)
+
+    host, _, port = args.central.rpartition(':')
+    client = SatelliteClient(host or 'localhost', int(port), args.room, args.codec, token=args.token)
+    satellite = Satellite(capture, client, args.model and os.path.expanduser(args.model), args.sensitivity)
+    try:
+        satellite.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        satellite.stop()
+        capture.stop()
+    _LOGGER.info('SATELLITE %s: %s' % (args.room, client.stats))
+
+
+if __name__ == '__main__':
+    main()
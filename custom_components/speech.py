@@ -5,15 +5,38 @@ sudo apt-get update && sudo apt-get install espeak
 pip install pyttsx3
 '''
 
-import pyttsx3
+import asyncio
+import collections
+import hashlib
+import heapq
+import itertools
 import logging
+import os
+import tempfile
+import threading
+import time
+import wave
+
 import voluptuous as vol
+from homeassistant.const import EVENT_HOMEASSISTANT_STOP
 from homeassistant.helpers import config_validation as cv
 
+from custom_components import loop_bridge, startup, voice_metrics
+
 DOMAIN = "speech"
 SERVICE_SPEAK = "speak"
+# Drops queued phrases (all, or those with the given message) and stops the current one
+SERVICE_CANCEL = "cancel"
 EVENT_TEXT_TO_SPEECH = 'text_to_speech'
-REQUIREMENTS = ['pyttsx3']
+# Fired by hotword_snowboy; stops speech when barge_in is on
+EVENT_HOTWORD_DETECTED = 'hotword_detected'
+# Unix time the hotword was detected, in its event data
+ATTR_DETECTED_AT = 'detected_at'
+# Depth of the queue, with the wait of the last phrase in its attributes
+SENSOR_QUEUE = 'sensor.speech_queue'
+# Voice pipeline stage recorded by voice_metrics when speak is called
+STAGE_SPEAK_REQUESTED = 'speak_requested'
+REQUIREMENTS = ['pyttsx3', 'PyAudio>=0.2.8']
 _LOGGER = logging.getLogger(__name__)
 
 # ----------
@@ -22,6 +45,13 @@ _LOGGER = logging.getLogger(__name__)
 
 CONF_VOICE = 'voice'
 CONF_SPEECH_RATE = 'speech_rate'
+CONF_CACHE_DIR = 'cache_dir'
+CONF_CACHE_SIZE = 'cache_size_mb'
+CONF_MEMORY_CACHE_SIZE = 'memory_cache_size_mb'
+CONF_PRERENDER = 'prerender'
+# Seconds in which the same phrase is spoken only once
+CONF_COALESCE_WINDOW = 'coalesce_window'
+CONF_BARGE_IN = 'barge_in'
 
 # --------------
 # Default values
@@ -30,6 +60,19 @@ CONF_SPEECH_RATE = 'speech_rate'
 DEFAULT_VOICE = 'brazil'
 DEFAULT_SPEECH_RATE = 160
 DEFAULT_MESSAGE = ['Seu desejo,', 'e', 'uma, ordem!']
+DEFAULT_CACHE_DIR = 'tts_cache'
+DEFAULT_CACHE_SIZE = 20
+DEFAULT_MEMORY_CACHE_SIZE = 4
+DEFAULT_COALESCE_WINDOW = 2.0
+DEFAULT_BARGE_IN = True
+
+# Lower is spoken first; a phrase interrupts one of a lower priority
+PRIORITY_HIGH = 'high'
+PRIORITY_NORMAL = 'normal'
+PRIORITY_LOW = 'low'
+PRIORITIES = {PRIORITY_HIGH: 0, PRIORITY_NORMAL: 1, PRIORITY_LOW: 2}
+# Seconds of audio written at a time, so playback can stop in between
+PLAYBACK_CHUNK = 0.05
 
 # ----------------
 # Calls attributes
@@ -37,6 +80,7 @@ DEFAULT_MESSAGE = ['Seu desejo,', 'e', 'uma, ordem!']
 
 ATTR_MESSAGE = 'message'
 ATTR_SPEECH_RATE = 'speech_rate'
+ATTR_PRIORITY = 'priority'
 
 # ------
 # Config
@@ -45,45 +89,538 @@ ATTR_SPEECH_RATE = 'speech_rate'
 CONFIG_SCHEMA = vol.Schema({
     DOMAIN: vol.Schema({
         vol.Optional(CONF_VOICE, DEFAULT_VOICE): cv.string,
-        vol.Optional(CONF_SPEECH_RATE, DEFAULT_SPEECH_RATE): int
+        vol.Optional(CONF_SPEECH_RATE, DEFAULT_SPEECH_RATE): int,
+        vol.Optional(CONF_CACHE_DIR, DEFAULT_CACHE_DIR): cv.string,
+        vol.Optional(CONF_CACHE_SIZE, DEFAULT_CACHE_SIZE): vol.Coerce(float),
+        vol.Optional(CONF_MEMORY_CACHE_SIZE, DEFAULT_MEMORY_CACHE_SIZE): vol.Coerce(float),
+        vol.Optional(CONF_COALESCE_WINDOW, DEFAULT_COALESCE_WINDOW): vol.All(vol.Coerce(float), vol.Range(min=0)),
+        vol.Optional(CONF_BARGE_IN, DEFAULT_BARGE_IN): cv.boolean,
+        # Each entry is a message, or a list of fragments, and an optional rate
+        vol.Optional(CONF_PRERENDER, []): [vol.Schema({
+            vol.Required(ATTR_MESSAGE): vol.Any(cv.string, [cv.string]),
+            vol.Optional(ATTR_SPEECH_RATE): int
+        })]
     })
 }, extra=vol.ALLOW_EXTRA)
 
 
 # ------------------------------------------------------------------------------------------------
-# SETUP
+# RENDERED PHRASE CACHE
+
+Rendered = collections.namedtuple('Rendered', ['sample_rate', 'sample_width', 'channels', 'frames'])
+
+
+def read_wav(path):
+    with wave.open(path, 'rb') as wav:
+        return Rendered(wav.getframerate(), wav.getsampwidth(), wav.getnchannels(),
+                        wav.readframes(wav.getnframes()))
+
+
+class PhraseCache(object):
+    """
+    Rendered speech keyed by (text, voice, rate). Recently used phrases stay
+    in memory as PCM; everything is also kept as WAV files on disk. Both
+    levels evict the least recently used phrase when over their size cap.
+    """
+
+    def __init__(self, directory, max_disk_bytes, max_memory_bytes):
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.max_memory_bytes = max_memory_bytes
+        self._memory = collections.OrderedDict()
+        self._memory_bytes = 0
+        self._disk = collections.OrderedDict()
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        files = [f for f in os.listdir(directory) if f.endswith('.wav')]
+        files.sort(key=lambda f: os.path.getmtime(os.path.join(directory, f)))
+        for file_name in files:
+            size = os.path.getsize(os.path.join(directory, file_name))
+            self._disk[file_name[:-4]] = size
+            self._disk_bytes += size
+
+    @staticmethod
+    def key(text, voice, rate):
+        return hashlib.sha1(('%s|%s|%s' % (text, voice, rate)).encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, '%s.wav' % key)
+
+    def get(self, key):
+        with self._lock:
+            rendered = self._memory.get(key)
+            if rendered is not None:
+                self._memory.move_to_end(key)
+                if key in self._disk:
+                    self._disk.move_to_end(key)
+                return rendered
+            if key not in self._disk:
+                return None
+            self._disk.move_to_end(key)
+        try:
+            rendered = read_wav(self.path(key))
+            os.utime(self.path(key))
+        except (OSError, wave.Error):
+            with self._lock:
+                self._disk_bytes -= self._disk.pop(key, 0)
+            return None
+        self._remember(key, rendered)
+        return rendered
+
+    def put(self, key, wav_path):
+        """Moves a freshly rendered WAV into the cache and returns its audio."""
+        rendered = read_wav(wav_path)
+        os.replace(wav_path, self.path(key))
+        size = os.path.getsize(self.path(key))
+        with self._lock:
+            self._disk_bytes += size - self._disk.pop(key, 0)
+            self._disk[key] = size
+            while self._disk_bytes > self.max_disk_bytes and len(self._disk) > 1:
+                evicted, evicted_size = self._disk.popitem(last=False)
+                self._disk_bytes -= evicted_size
+                try:
+                    os.remove(self.path(evicted))
+                except OSError:
+                    pass
+        self._remember(key, rendered)
+        return rendered
+
+    def _remember(self, key, rendered):
+        with self._lock:
+            if key in self._memory:
+                return
+            self._memory[key] = rendered
+            self._memory_bytes += len(rendered.frames)
+            while self._memory_bytes > self.max_memory_bytes and len(self._memory) > 1:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted.frames)
+
+
+# ------------------------------------------------------------------------------------------------
+# PLAYBACK
+
+class PcmPlayer(object):
+    """Plays PCM through an output stream kept open between phrases."""
+
+    def __init__(self):
+        self._audio = None
+        self._stream = None
+        self._format = None
+
+    def play(self, rendered, interrupted=lambda: False):
+        """Returns False if interrupted() became true before the end."""
+        audio_format = (rendered.sample_rate, rendered.sample_width, rendered.channels)
+        if self._stream is None or audio_format != self._format:
+            self.close()
+            import pyaudio
+            self._audio = pyaudio.PyAudio()
+            self._stream = self._audio.open(
+                format=self._audio.get_format_from_width(rendered.sample_width),
+                channels=rendered.channels, rate=rendered.sample_rate, output=True)
+            self._format = audio_format
+        chunk = rendered.sample_width * rendered.channels * int(rendered.sample_rate * PLAYBACK_CHUNK)
+        for start in range(0, len(rendered.frames), chunk):
+            if interrupted():
+                return False
+            self._stream.write(rendered.frames[start:start + chunk])
+        return True
+
+    def close(self):
+        if self._stream is not None:
+            self._stream.stop_stream()
+            self._stream.close()
+            self._stream = None
+        if self._audio is not None:
+            self._audio.terminate()
+            self._audio = None
+
+
+# ------------------------------------------------------------------------------------------------
+# TTS WORKER
+
+class Utterance(object):
+    """One call of speak: its fragments, and everyone waiting for them."""
+
+    def __init__(self, messages, rate, priority, play, sequence):
+        # Templates leave stray whitespace that would split cache entries
+        self.messages = [' '.join(m.split()) for m in messages]
+        self.rate = rate
+        self.priority = priority
+        self.play = play
+        self.sequence = sequence
+        self.key = (tuple(self.messages), rate)
+        self.callbacks = []
+        self.queued_at = time.monotonic()
+        # Fragments already spoken, kept when a higher priority interrupts
+        self.position = 0
+        self.started = False
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return (self.priority, self.sequence) < (other.priority, other.sequence)
+
+
+class SpeechWorker(object):
+    """
+    Owns the only pyttsx3 engine, in its own thread. Each fragment is
+    rendered once to WAV and then played from the phrase cache.
+
+    Phrases wait in a priority queue. One queued while a lower priority
+    phrase plays interrupts it between two chunks of audio, and the
+    interrupted phrase goes back to the queue from the fragment it was in.
+    A phrase already queued, playing or spoken in the last coalesce_window
+    seconds is not queued again: its caller waits for the same one.
+    cancel() drops queued phrases and stops the current one.
+    Callbacks get whether their phrase was cancelled instead of spoken.
+    If pyttsx3 cannot be started, every phrase is cancelled at once.
+    """
+
+    def __init__(self, voice, cache, player, coalesce_window=DEFAULT_COALESCE_WINDOW, on_change=None):
+        self.voice = voice
+        self.cache = cache
+        self.player = player
+        self.coalesce_window = coalesce_window
+        # Called from any thread with stats whenever the queue changes
+        self.on_change = on_change
+        self._queue = []
+        self._condition = threading.Condition()
+        self._sequence = itertools.count()
+        self._current = None
+        self._interrupt = False
+        self._running = True
+        # Set when the engine could not be built: nothing will ever be spoken
+        self._broken = False
+        # key -> monotonic time it was last spoken, oldest first
+        self._spoken = collections.OrderedDict()
+        self._engine = None
+        self._thread = threading.Thread(target=self._run, name=DOMAIN, daemon=True)
+        self.stats = {
+            'depth': 0,
+            'last_wait': None,
+            'max_wait': 0.0,
+            'spoken': 0,
+            'coalesced': 0,
+            'preempted': 0,
+            'cancelled': 0
+        }
 
-def setup(hass, config):
+    @property
+    def depth(self):
+        return len(self._queue) + (self._current is not None)
 
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self.cancel()
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._thread.join(timeout=5.0)
+
+    def speak(self, messages, rate, done=None, priority=PRIORITY_NORMAL):
+        """Queues fragments to be spoken; done(cancelled) is called from the worker afterwards."""
+        self._submit(messages, rate, done, PRIORITIES[priority], True)
+
+    def prerender(self, messages, rate):
+        self._submit(messages, rate, None, PRIORITIES[PRIORITY_LOW] + 1, False)
+
+    def cancel(self, messages=None, before=None):
+        """
+        Drops queued phrases with these fragments (all if None), queued
+        before the monotonic time before (any time if None), and stops the
+        current one if it matches. Prerendering is left alone. Returns how
+        many phrases were cancelled.
+        """
+        key = None if messages is None else tuple(' '.join(m.split()) for m in messages)
+
+        def matches(utterance):
+            return utterance.play and not utterance.cancelled and (key is None or utterance.key[0] == key) \
+                and (before is None or utterance.queued_at < before)
+
+        with self._condition:
+            dropped = [u for u in self._queue if matches(u)]
+            for utterance in dropped:
+                utterance.cancelled = True
+            if dropped:
+                self._queue = [u for u in self._queue if not u.cancelled]
+                heapq.heapify(self._queue)
+            cancelled = len(dropped)
+            if self._current is not None and matches(self._current):
+                # The worker calls its callbacks once playback stops
+                self._current.cancelled = True
+                self._interrupt = True
+                cancelled += 1
+            self.stats['cancelled'] += cancelled
+        for utterance in dropped:
+            self._finish(utterance)
+        self._changed()
+        return cancelled
+
+    def _submit(self, messages, rate, done, priority, play):
+        utterance = Utterance(messages, rate, priority, play, next(self._sequence))
+        with self._condition:
+            broken = self._broken
+            if broken:
+                utterance = None
+            elif play:
+                same = self._same(utterance.key)
+                if same is not None:
+                    self.stats['coalesced'] += 1
+                    if same is not True:
+                        if done is not None:
+                            same.callbacks.append(done)
+                        # The most urgent caller decides when it is spoken
+                        if priority < same.priority and same is not self._current:
+                            same.priority = priority
+                            heapq.heapify(self._queue)
+                        return
+                    utterance = None
+            if utterance is not None:
+                if done is not None:
+                    utterance.callbacks.append(done)
+                heapq.heappush(self._queue, utterance)
+                current = self._current
+                if current is not None and current.play and priority < current.priority:
+                    self._interrupt = True
+                self._condition.notify()
+        if utterance is None and done is not None:
+            # Spoken a moment ago, or never will be
+            done(broken)
+        self._changed()
+
+    def _same(self, key):
+        # Called with the condition held. The utterance with this key, or
+        # True if it was spoken within the coalesce window
+        for utterance in itertools.chain([self._current], self._queue):
+            if utterance is not None and utterance.play and not utterance.cancelled and utterance.key == key:
+                return utterance
+        spoken = self._spoken.get(key)
+        if spoken is not None and time.monotonic() - spoken < self.coalesce_window:
+            return True
+        return None
+
+    def _next(self):
+        with self._condition:
+            while self._running and not self._queue:
+                self._condition.wait()
+            if not self._running:
+                return None
+            utterance = heapq.heappop(self._queue)
+            self._current = utterance
+            self._interrupt = False
+            if utterance.play and not utterance.started:
+                utterance.started = True
+                wait = time.monotonic() - utterance.queued_at
+                self.stats['last_wait'] = wait
+                self.stats['max_wait'] = max(self.stats['max_wait'], wait)
+        self._changed()
+        return utterance
+
+    def _run(self):
+        try:
+            # Imported here, in the worker, so setup does not wait for it
+            import pyttsx3
+            self._engine = pyttsx3.init()
+            self._engine.setProperty('voice', self.voice)
+        except Exception:
+            _LOGGER.exception('Speech engine failed to start, every phrase will be cancelled')
+            self._fail()
+            return
+        while True:
+            utterance = self._next()
+            if utterance is None:
+                break
+            try:
+                while utterance.position < len(utterance.messages) and not self._interrupt:
+                    message = utterance.messages[utterance.position]
+                    rendered = self._render(message, utterance.rate)
+                    if utterance.play and not self._play(message, rendered, utterance.rate):
+                        break
+                    utterance.position += 1
+            except Exception:
+                _LOGGER.exception('Speech failed: %s' % ' '.join(utterance.messages))
+                utterance.position = len(utterance.messages)
+            with self._condition:
+                self._current = None
+                requeue = utterance.position < len(utterance.messages) and not utterance.cancelled
+                if requeue:
+                    self.stats['preempted'] += 1
+                    heapq.heappush(self._queue, utterance)
+                elif utterance.play and not utterance.cancelled:
+                    self.stats['spoken'] += 1
+                    self._remember(utterance.key)
+            if not requeue:
+                self._finish(utterance)
+            self._changed()
+        self.player.close()
+        self._engine.stop()
+
+    def _fail(self):
+        # Without an engine, callers waiting for their phrases are told at once
+        with self._condition:
+            self._broken = True
+            dropped, self._queue = self._queue, []
+            for utterance in dropped:
+                utterance.cancelled = True
+            self.stats['cancelled'] += sum(1 for utterance in dropped if utterance.play)
+        for utterance in dropped:
+            self._finish(utterance)
+        self.player.close()
+        self._changed()
+
+    def _remember(self, key):
+        # Called with the condition held
+        now = time.monotonic()
+        self._spoken.pop(key, None)
+        self._spoken[key] = now
+        while self._spoken and now - next(iter(self._spoken.values())) > self.coalesce_window:
+            self._spoken.popitem(last=False)
+
+    @staticmethod
+    def _finish(utterance):
+        for done in utterance.callbacks:
+            done(utterance.cancelled)
+
+    def _changed(self):
+        self.stats['depth'] = self.depth
+        if self.on_change is not None:
+            self.on_change(dict(self.stats))
+
+    def _render(self, message, rate):
+        key = PhraseCache.key(message, self.voice, rate)
+        rendered = self.cache.get(key)
+        if rendered is not None or not hasattr(self._engine, 'save_to_file'):
+            return rendered
+        handle, wav_path = tempfile.mkstemp(suffix='.wav', dir=self.cache.directory)
+        os.close(handle)
+        try:
+            self._engine.setProperty('rate', rate)
+            self._engine.save_to_file(message, wav_path)
+            self._engine.runAndWait()
+            return self.cache.put(key, wav_path)
+        finally:
+            if os.path.exists(wav_path):
+                os.remove(wav_path)
+
+    def _play(self, message, rendered, rate):
+        """Returns False if interrupted."""
+        if rendered is None:
+            # Engine cannot render to a file: speak directly, uncached and
+            # only interrupted between fragments
+            self._engine.setProperty('rate', rate)
+            self._engine.say(message)
+            self._engine.runAndWait()
+            return True
+        return self.player.play(rendered, lambda: self._interrupt)
+
+
+# ------------------------------------------------------------------------------------------------
+# SETUP
+
+@asyncio.coroutine
+def async_setup(hass, config):
+    started = time.monotonic()
     voice = config[DOMAIN].get(CONF_VOICE, DEFAULT_VOICE)
     speech_rate = config[DOMAIN].get(CONF_SPEECH_RATE, DEFAULT_SPEECH_RATE)
+    cache_dir = hass.config.path(config[DOMAIN].get(CONF_CACHE_DIR, DEFAULT_CACHE_DIR))
+    cache_size = config[DOMAIN].get(CONF_CACHE_SIZE, DEFAULT_CACHE_SIZE)
+    memory_cache_size = config[DOMAIN].get(CONF_MEMORY_CACHE_SIZE, DEFAULT_MEMORY_CACHE_SIZE)
+    coalesce_window = config[DOMAIN].get(CONF_COALESCE_WINDOW, DEFAULT_COALESCE_WINDOW)
+    barge_in = config[DOMAIN].get(CONF_BARGE_IN, DEFAULT_BARGE_IN)
+    bridge = loop_bridge.get(hass)
+
+    def publish_queue(stats):
+        def ms(seconds):
+            return None if seconds is None else round(1000 * seconds, 1)
+        attributes = dict(stats, last_wait=ms(stats['last_wait']), max_wait=ms(stats['max_wait']))
+        attributes.update({
+            'friendly_name': 'Speech queue',
+            'icon': 'mdi:playlist-play'
+        })
+        bridge.set_state(SENSOR_QUEUE, attributes.pop('depth'), attributes)
+
+    cache = yield from hass.async_add_job(
+        PhraseCache, cache_dir, int(cache_size * 2 ** 20), int(memory_cache_size * 2 ** 20))
+    worker = SpeechWorker(voice, cache, PcmPlayer(), coalesce_window, publish_queue)
+    worker.start()
+    hass.data[DOMAIN] = worker
 
+    for phrase in config[DOMAIN].get(CONF_PRERENDER, []):
+        messages = phrase[ATTR_MESSAGE]
+        worker.prerender(messages if isinstance(messages, list) else [messages],
+                         phrase.get(ATTR_SPEECH_RATE, speech_rate))
+
+    @asyncio.coroutine
     def speak(call):
 
         instance_speech_rate = call.data.get(ATTR_SPEECH_RATE, speech_rate)
+        priority = call.data.get(ATTR_PRIORITY, PRIORITY_NORMAL)
+        if priority not in PRIORITIES:
+            _LOGGER.warning('Unknown priority %s, using %s' % (priority, PRIORITY_NORMAL))
+            priority = PRIORITY_NORMAL
         messages = call.data.get(ATTR_MESSAGE, DEFAULT_MESSAGE)
         if not isinstance(messages, list):
             messages = [messages]
 
-        engine = pyttsx3.init()
-        engine.setProperty('voice', voice)
-        engine.setProperty('rate', instance_speech_rate)
         spoken_message = ' '.join(messages).replace(',', '')
-
+        correlation_id = voice_metrics.correlation_id(hass, call.data)
+        voice_metrics.mark(hass, correlation_id, STAGE_SPEAK_REQUESTED)
         _LOGGER.warning('Speaking: %s' % spoken_message)
-        for message in messages:
-            engine.say(message)
-            engine.runAndWait()
 
+        def done(cancelled):
+            if not cancelled:
+                voice_metrics.mark(hass, correlation_id, EVENT_TEXT_TO_SPEECH)
+            outcome.append(cancelled)
+            bridge.call(spoken.set)
+
+        # Wait for the worker without holding an executor thread
+        spoken = asyncio.Event()
+        outcome = []
+        worker.speak(messages, int(instance_speech_rate), done, priority)
+        yield from spoken.wait()
+
+        if outcome[0]:
+            _LOGGER.warning('Speech cancelled: %s' % spoken_message)
+            return
         _LOGGER.warning('Spoken Successfully: %s' % spoken_message)
         hass.bus.async_fire(EVENT_TEXT_TO_SPEECH, {
             'name': '%s.%s' % (DOMAIN, SERVICE_SPEAK),  # domain and name of the service
-            'message': spoken_message  # text
+            'message': spoken_message,  # text
+            voice_metrics.ATTR_CORRELATION_ID: correlation_id
         })
-        engine.stop()
+
+    @asyncio.coroutine
+    def cancel(call):
+        messages = call.data.get(ATTR_MESSAGE)
+        if messages is not None and not isinstance(messages, list):
+            messages = [messages]
+        _LOGGER.warning('Cancelled %d phrases' % worker.cancel(messages))
+
+    @asyncio.coroutine
+    def hotword_detected(event):
+        # The user is talking: whatever was being said is stale, but not
+        # what was queued after the hotword, like the prompt of this command
+        detected_at = event.data.get(ATTR_DETECTED_AT)
+        before = None if detected_at is None else time.monotonic() - max(0.0, time.time() - detected_at)
+        if worker.cancel(before=before):
+            _LOGGER.info('Speech interrupted by the hotword')
+
+    @asyncio.coroutine
+    def terminate(event):
+        yield from hass.async_add_job(worker.stop)
 
     # Register our service with Home Assistant.
-    hass.services.register(DOMAIN, SERVICE_SPEAK, speak)
+    hass.services.async_register(DOMAIN, SERVICE_SPEAK, speak)
+    hass.services.async_register(DOMAIN, SERVICE_CANCEL, cancel, schema=vol.Schema({
+        vol.Optional(ATTR_MESSAGE): vol.Any(cv.string, [cv.string])
+    }))
+    if barge_in:
+        hass.bus.async_listen(EVENT_HOTWORD_DETECTED, hotword_detected)
+    hass.bus.async_listen(EVENT_HOMEASSISTANT_STOP, terminate)
 
     # Return boolean to indicate that initialization was successfully.
+    startup.get(hass).setup_done(DOMAIN, started)
     return True
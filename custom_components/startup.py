@@ -0,0 +1,157 @@
+"""
+Startup of the voice components (not a Home Assistant component by itself).
+
+Setup only reads the configuration, builds cheap objects and registers
+services. Whatever is slow (importing speech libraries, loading models,
+opening audio devices, building indexes, connecting to the broker) is
+wrapped in a Lazy: it runs in one background thread after
+homeassistant_start, one job after the other in setup order, or in the
+first caller that needs it, whichever comes first.
+
+How long each component took to set up and to warm up is logged and kept
+in the attributes of sensor.voice_startup, so a component that starts
+doing heavy work in setup again shows up there.
+"""
+import asyncio
+import collections
+import logging
+import queue
+import threading
+import time
+
+from homeassistant.const import EVENT_HOMEASSISTANT_START
+
+from custom_components import loop_bridge
+
+_LOGGER = logging.getLogger(__name__)
+
+# Key of the shared report in hass.data
+DATA_STARTUP = 'startup'
+
+# State: total setup time of the voice components (ms)
+SENSOR_STARTUP = 'sensor.voice_startup'
+
+# Setups slower than this are logged as warnings (seconds)
+SLOW_SETUP = 0.1
+
+# How a Lazy job came to run
+BY_WARM_UP = 'warm-up'
+BY_FIRST_USE = 'first use'
+
+state_attrs = {
+    'friendly_name': 'Voice startup',
+    'icon': 'mdi:timer',
+    'unit_of_measurement': 'ms'
+}
+
+
+def get(hass):
+    """The report shared by every component of this Home Assistant."""
+    report = hass.data.get(DATA_STARTUP)
+    if report is None:
+        report = hass.data.setdefault(DATA_STARTUP, StartupReport(hass))
+    return report
+
+
+def ms(seconds):
+    return None if seconds is None else round(1000 * seconds, 1)
+
+
+# -----------------------------------------------------------------------------
+# LAZY
+
+class Lazy(object):
+    """
+    Runs job() once and keeps its result. Whoever calls get() first runs it
+    (the warm-up thread or a component that needs it now); later callers
+    wait for it, then get the result without taking the lock. If the job
+    fails the next get() tries again.
+    """
+
+    def __init__(self, name, job):
+        self.name = name
+        self.seconds = None
+        self.by = None
+        self._job = job
+        self._lock = threading.Lock()
+        self._ready = False
+        self._value = None
+
+    @property
+    def ready(self):
+        return self._ready
+
+    def get(self, by=BY_FIRST_USE):
+        if self._ready:
+            return self._value
+        with self._lock:
+            if not self._ready:
+                started = time.monotonic()
+                self._value = self._job()
+                self.seconds = time.monotonic() - started
+                self.by = by
+                self._ready = True
+        return self._value
+
+    @asyncio.coroutine
+    def async_get(self, hass):
+        """get() from the event loop: a job that has not run yet runs in the executor."""
+        if self._ready:
+            return self._value
+        value = yield from hass.async_add_job(self.get)
+        return value
+
+
+# -----------------------------------------------------------------------------
+# REPORT
+
+class StartupReport(object):
+
+    def __init__(self, hass):
+        self.hass = hass
+        self.setups = collections.OrderedDict()
+        self.jobs = []
+        self._queue = queue.Queue()
+        self._thread = None
+        # get() may be called from an executor thread (setup) or the loop (async_setup)
+        hass.loop.call_soon_threadsafe(hass.bus.async_listen_once, EVENT_HOMEASSISTANT_START, self._started)
+
+    def setup_done(self, domain, started):
+        """Records the setup time of domain, from started (time.monotonic()) until now."""
+        seconds = time.monotonic() - started
+        self.setups[domain] = seconds
+        if seconds > SLOW_SETUP:
+            _LOGGER.warning('STARTUP: %s SETUP TOOK %.0f ms' % (domain, 1000 * seconds))
+        else:
+            _LOGGER.info('STARTUP: %s SETUP IN %.1f ms' % (domain, 1000 * seconds))
+        self._publish()
+
+    def lazy(self, domain, job):
+        """A Lazy for job, warmed up after homeassistant_start."""
+        lazy = Lazy(domain, job)
+        self.jobs.append(lazy)
+        self._queue.put(lazy)
+        return lazy
+
+    def _started(self, event):
+        self._thread = threading.Thread(target=self._warm_up, name=DATA_STARTUP, daemon=True)
+        self._thread.start()
+
+    def _warm_up(self):
+        while True:
+            lazy = self._queue.get()
+            try:
+                lazy.get(BY_WARM_UP)
+            except Exception:
+                _LOGGER.exception('STARTUP: %s FAILED TO WARM UP' % lazy.name)
+                continue
+            _LOGGER.info('STARTUP: %s READY IN %.0f ms (%s)' % (lazy.name, 1000 * lazy.seconds, lazy.by))
+            self._publish()
+
+    def _publish(self):
+        attributes = dict(state_attrs)
+        for domain, seconds in self.setups.items():
+            attributes['%s_setup_ms' % domain] = ms(seconds)
+        for lazy in self.jobs:
+            attributes['%s_warm_up_ms' % lazy.name] = ms(lazy.seconds)
+        loop_bridge.get(self.hass).set_state(SENSOR_STARTUP, ms(sum(self.setups.values())), attributes)
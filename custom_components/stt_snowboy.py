@@ -18,18 +18,25 @@ sudo apt-get install liblapack-dev liblapack3 \
     libjack0 libjack-dev portaudio19-dev
 pip install snowboy==1.2.0b1
 """
+import asyncio
+import collections
 import os
 import logging
-import re
+import queue
+import threading
+import time
 
 import voluptuous as vol
 
 from homeassistant.const import CONF_NAME, EVENT_HOMEASSISTANT_STOP
 from homeassistant.helpers import config_validation as cv
 
+from custom_components import audio_capture, loop_bridge, startup, voice_metrics
+
 _LOGGER = logging.getLogger(__name__)
 
 REQUIREMENTS = ['snowboy']
+DEPENDENCIES = [audio_capture.DOMAIN]
 DOMAIN = 'stt_snowboy'
 
 # ------
@@ -42,6 +49,7 @@ CONF_MODELS = 'models'
 CONF_INTENT_TEXTS = 'intent_texts'
 CONF_KEYWORDS = 'keywords'
 CONF_TIMEOUT = 'timeout'
+CONF_EARLY_STOP = 'early_stop'
 
 # ----------------------
 # Configuration defaults
@@ -55,6 +63,7 @@ DEFAULT_KEYWORDS = ['']
 DEFAULT_MODELS = ['']
 DEFAULT_INTENT_TEXTS = ['']
 DEFAULT_UNKNOWN_COMMAND = 'unknown_command'
+DEFAULT_EARLY_STOP = True
 
 CONFIG_SCHEMA = vol.Schema({
     DOMAIN: vol.Schema({
@@ -64,7 +73,8 @@ CONFIG_SCHEMA = vol.Schema({
         vol.Optional(CONF_TIMEOUT, DEFAULT_TIMEOUT): float,
         vol.Optional(CONF_NAME, DEFAULT_NAME): cv.string,
         vol.Optional(CONF_SENSITIVITY, DEFAULT_SENSITIVITY): float,
-        vol.Optional(CONF_AUDIO_GAIN, DEFAULT_AUDIO_GAIN): float
+        vol.Optional(CONF_AUDIO_GAIN, DEFAULT_AUDIO_GAIN): float,
+        vol.Optional(CONF_EARLY_STOP, DEFAULT_EARLY_STOP): cv.boolean
     })
 }, extra=vol.ALLOW_EXTRA)
 
@@ -87,10 +97,242 @@ EVENT_SPEECH_TO_TEXT = 'speech_to_text'
 # Represents the hotword detector
 OBJECT_SNOWBOY = '%s.decoder' % DOMAIN
 
+# ----------------
+# Matcher statuses
+# ----------------
+
+# Heard keywords are still the beginning of some intent
+MATCH_PARTIAL = 'partial'
+# Exactly one intent ends at the last keyword
+MATCH_UNIQUE = 'unique'
+# More than one intent ends at the last keyword
+MATCH_AMBIGUOUS = 'ambiguous'
+# No intent can be finished before the deadline, even starting over
+MATCH_DEAD_END = 'dead_end'
+
+# Shortest time a keyword takes to say, to tell how many still fit before the deadline
+KEYWORD_SECONDS = 0.3
+
+
+# -----------------------------------------------------------------------------
+# INTENT MATCHER
+
+class IntentMatcher(object):
+    """
+    Aho-Corasick automaton over keyword tokens, compiled once at setup.
+
+    Each detected keyword advances the automaton by one transition, so the
+    cost per keyword does not depend on how many intents are configured.
+    Transitions that fall back through failure links are memoized the first
+    time they are taken. Falling back to ROOT is not the end: a later
+    keyword can still start an intent, as long as enough keywords fit in the
+    time left.
+    """
+
+    ROOT = 0
+
+    def __init__(self, intents):
+        self.intents = [i for i in intents if i.split()]
+        self._goto = [{}]
+        self._fail = [self.ROOT]
+        self._output = [()]
+        for intent in self.intents:
+            state = self.ROOT
+            for token in intent.split():
+                if token not in self._goto[state]:
+                    self._goto.append({})
+                    self._fail.append(self.ROOT)
+                    self._output.append(())
+                    self._goto[state][token] = len(self._goto) - 1
+                state = self._goto[state][token]
+            if intent not in self._output[state]:
+                self._output[state] += (intent,)
+
+        # Breadth-first: failure links and outputs inherited through them
+        queue = collections.deque(self._goto[self.ROOT].values())
+        while queue:
+            state = queue.popleft()
+            for token, child in self._goto[state].items():
+                fallback = self._fail[state]
+                while fallback != self.ROOT and token not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(token, self.ROOT)
+                self._fail[child] = target if target != child else self.ROOT
+                self._output[child] += tuple(
+                    i for i in self._output[self._fail[child]] if i not in self._output[child])
+                queue.append(child)
+
+        self._delta = [dict(g) for g in self._goto]
+
+        # Fewest keywords from each state to the end of some intent: along
+        # the trie, or after falling back (failure states are shallower)
+        order = [self.ROOT]
+        for state in order:
+            order.extend(self._goto[state].values())
+        ahead = [0] * len(self._goto)
+        for state in reversed(order):
+            children = [ahead[child] + 1 for child in self._goto[state].values()]
+            ahead[state] = 0 if self._output[state] else min(children) if children else len(order)
+        self._keywords_left = list(ahead)
+        for state in order[1:]:
+            self._keywords_left[state] = min(ahead[state], self._keywords_left[self._fail[state]])
+
+    @property
+    def states(self):
+        return len(self._goto)
+
+    def keywords_left(self, state):
+        """Fewest keywords still needed from state to finish an intent."""
+        return self._keywords_left[state]
+
+    def advance(self, state, token, seconds_left=None):
+        """
+        Consumes one keyword. Returns (next_state, status, intents), where
+        intents are the phrases ending at this keyword. The status is
+        MATCH_DEAD_END only when the keywords still needed cannot be said
+        in seconds_left (never without a deadline).
+        """
+        next_state = self._delta[state].get(token)
+        if next_state is None:
+            fallback = state
+            while fallback != self.ROOT and token not in self._goto[fallback]:
+                fallback = self._fail[fallback]
+            next_state = self._goto[fallback].get(token, self.ROOT)
+            self._delta[state][token] = next_state
+
+        intents = self._output[next_state]
+        if len(intents) == 1:
+            return next_state, MATCH_UNIQUE, intents
+        if intents:
+            return next_state, MATCH_AMBIGUOUS, intents
+        if seconds_left is not None and self._keywords_left[next_state] * KEYWORD_SECONDS > seconds_left:
+            return next_state, MATCH_DEAD_END, intents
+        return next_state, MATCH_PARTIAL, intents
+
+
+# -----------------------------------------------------------------------------
+# KEYWORD SPOTTING
+
+def build_detector(models, sensitivity, audio_gain):
+    """One snowboy detector running every keyword model at once."""
+    from snowboy import snowboydecoder, snowboydetect
+    detector = snowboydetect.SnowboyDetect(
+        resource_filename=snowboydecoder.RESOURCE_FILE.encode(),
+        model_str=','.join(models).encode())
+    detector.SetAudioGain(audio_gain)
+    detector.SetSensitivity(','.join([str(sensitivity)] * len(models)).encode())
+    return detector
+
+
+def spot_command(detector, capture, reader, keywords, matcher, session, early_stop=DEFAULT_EARLY_STOP,
+                 gate=None):
+    """
+    Feeds audio from reader to the keyword detector until the keywords heard
+    decide an intent. Returns the intent text, DEFAULT_UNKNOWN_COMMAND at the
+    session deadline, on an ambiguous sequence or when no intent can be said
+    before the deadline any more, or None if
+    the session was cancelled or the capture ended first.
+
+    Between chunks the thread sleeps on the capture until audio arrives, the
+    deadline passes or the session is cancelled. Chunks the capture voice
+    gate rejects are not scored by the models (a new gate unless one is given).
+    """
+    detector.Reset()
+    gate = gate or capture.voice_gate()
+    session.start()
+    state = IntentMatcher.ROOT
+    heard = []
+    while True:
+        data = reader.read(capture.chunk_bytes, session=session)
+        if data is None:
+            if session.expired and not session.cancelled:
+                return DEFAULT_UNKNOWN_COMMAND
+            return None
+        data = gate.process(data)
+        if data is None:
+            continue
+        index = detector.RunDetection(bytes(data))
+        if index <= 0:
+            continue
+
+        heard.append(keywords[index - 1])
+        _LOGGER.info("SERVICE SNOWBOY STT TEMP_TEXT: %s" % ' '.join(heard))
+        seconds_left = None if session.deadline is None else session.deadline - time.monotonic()
+        state, status, intents_detected = matcher.advance(state, heard[-1], seconds_left)
+        if status == MATCH_UNIQUE:
+            return intents_detected[0]
+        if status == MATCH_AMBIGUOUS:
+            _LOGGER.info("SERVICE SNOWBOY STT AMBIGUOUS: %s" % str(intents_detected))
+            return DEFAULT_UNKNOWN_COMMAND
+        if status == MATCH_DEAD_END and early_stop:
+            _LOGGER.info("SERVICE SNOWBOY STT DEAD END: %s" % ' '.join(heard))
+            return DEFAULT_UNKNOWN_COMMAND
+
+
+# -----------------------------------------------------------------------------
+# DETECTION WORKER
+
+class DetectionWorker(object):
+    """
+    Runs detection sessions one at a time in a dedicated thread, so there is
+    at most one session reading the microphone. Submitting a session cancels
+    the one still running; so does stop().
+    """
+
+    def __init__(self, capture, timeout, run_session):
+        # run_session(session) -> text or None, called in the worker thread
+        self.capture = capture
+        self.timeout = timeout
+        self._run_session = run_session
+        self._requests = queue.Queue()
+        self._current = None
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name=DOMAIN, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def submit(self, on_done):
+        """
+        Queues a session, cancelling the current one. on_done(text) is called
+        from the worker thread, with None if the session was cancelled.
+        """
+        session = self.capture.session(self.timeout)
+        with self._lock:
+            if self._current is not None:
+                self._current.cancel()
+            self._current = session
+        self._requests.put((session, on_done))
+
+    def cancel(self):
+        with self._lock:
+            if self._current is not None:
+                self._current.cancel()
+
+    def stop(self, timeout=2.0):
+        self.cancel()
+        self._requests.put(None)
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            request = self._requests.get()
+            if request is None:
+                break
+            session, on_done = request
+            text = None
+            if not session.cancelled:
+                try:
+                    text = self._run_session(session)
+                except Exception:
+                    _LOGGER.exception("SERVICE SNOWBOY STT FAILED")
+            on_done(None if session.cancelled else text)
+
 
 # -----------------------------------------------------------------------------
 
 def setup(hass, config):
+    started = time.monotonic()
     # Parametric Configuration
     name = config[DOMAIN].get(CONF_NAME, DEFAULT_NAME)
     models_json = config[DOMAIN].get(CONF_MODELS, DEFAULT_MODELS)
@@ -99,98 +341,89 @@ def setup(hass, config):
     sensitivity = config[DOMAIN].get(CONF_SENSITIVITY, DEFAULT_SENSITIVITY)
     audio_gain = config[DOMAIN].get(CONF_AUDIO_GAIN, DEFAULT_AUDIO_GAIN)
     timeout = config[DOMAIN].get(CONF_TIMEOUT, DEFAULT_TIMEOUT)
+    early_stop = config[DOMAIN].get(CONF_EARLY_STOP, DEFAULT_EARLY_STOP)
     state_attrs = {'friendly_name': 'Snowboy STT', 'icon': 'mdi:microphone'}
-    terminated = False
 
-    models = []
     keywords = [k for k in keywords_json]
     intents = [t for t in intents_json]
     assert len(models_json) == len(keywords), 'Assign exactly one text for each model'
-    for model in models_json:
-        assert os.path.exists(model), 'Model does not exist'
-        models.append(str(model))
-    indexed_models = dict(zip(keywords, models))
-    sensitivities = [sensitivity]*len(models)
-    _LOGGER.info("MODELS LOADED: %s" % str(indexed_models))
-    _LOGGER.info("SENSITIVITIES: %s" % str(sensitivities))
+    models = [str(model) for model in models_json]
+    capture = hass.data[audio_capture.DOMAIN]
+
+    # Checks and loads the keyword models and compiles the intents after
+    # homeassistant_start, or on first use
+    def load():
+        for model in models:
+            assert os.path.exists(model), 'Model does not exist: %s' % model
+        _LOGGER.info("MODELS LOADED: %s" % str(dict(zip(keywords, models))))
+        _LOGGER.info("SENSITIVITY: %s" % str(sensitivity))
+        matcher = IntentMatcher(intents)
+        _LOGGER.info("INTENTS COMPILED: %d intents, %d states" % (len(matcher.intents), matcher.states))
+        capture.start()
+        detector = build_detector(models, sensitivity, audio_gain)
+        assert detector.SampleRate() == capture.sample_rate, \
+            'Snowboy expects audio at %d Hz' % detector.SampleRate()
+        return detector, matcher
+
+    loaded = startup.get(hass).lazy(DOMAIN, load)
+
+    def run_session(session):
+        _LOGGER.info("KEYWORDS: %s" % str(keywords))
+        detector, matcher = loaded.get()
+        return spot_command(detector, capture, capture.command_reader(), keywords, matcher,
+                            session, early_stop)
+
+    worker = DetectionWorker(capture, timeout, run_session)
+    worker.start()
+    hass.data[DOMAIN] = worker
+    bridge = loop_bridge.get(hass)
 
     # Main Functionality Registered in HomeAssistant
-    def detect(call):
-
-        temp_text = ''
-
-        # Interruption Handling
-        interrupted = False
-        counter = 0
-
-        def interrupt_second():
-            nonlocal interrupted
-            nonlocal terminated
-            nonlocal counter
-            counter += 0.03
-            if int(counter) == timeout:
-                counter = 0
-                detected_text(DEFAULT_UNKNOWN_COMMAND)
-                return True
-            return interrupted or terminated
-
-        # Detects keyword
-        def detect_keyword(word):
-            nonlocal temp_text
-            temp_text = '%s %s' % (temp_text, word)
-            _LOGGER.info("SERVICE SNOWBOY STT TEMP_TEXT: %s" % temp_text)
-            _LOGGER.info("SERVICE SNOWBOY STT INTENTS: %s" % str(intents))
-            intents_detected = [t for t in intents if re.search(r'\b' + t + r'\b', temp_text)]
-            if intents_detected:
-                if len(intents_detected) == 1:
-                    detected_text(intents_detected[0])
-                else:
-                    detected_text(DEFAULT_UNKNOWN_COMMAND)
-
-        def lambda_callback_keyword(text):
-            return lambda: detect_keyword(text)
+    @asyncio.coroutine
+    def async_detect(call):
+        correlation_id = voice_metrics.correlation_id(hass, call.data)
 
-        # Fire detected event to HomeAssistant
-        def detected_text(text):
-            nonlocal interrupted
-            hass.states.async_set(OBJECT_SNOWBOY, STATE_IDLE, state_attrs)
-            hass.bus.async_fire(EVENT_SPEECH_RECORDED, {'name': name})
-            hass.bus.async_fire(EVENT_SPEECH_TO_TEXT, {
-                'name': name,  # name of the component
-                'text': text  # text
-            })
-            _LOGGER.info("SERVICE SNOWBOY STT DETECTED: %s" % text)
-            interrupted = True
-
-        from snowboy import snowboydecoder
         hass.states.async_set(OBJECT_SNOWBOY, STATE_LISTENING, state_attrs)
-        hass.bus.async_fire(EVENT_LISTENING, {'name': name, 'state': STATE_LISTENING})
+        voice_metrics.mark(hass, correlation_id, EVENT_LISTENING)
+        hass.bus.async_fire(EVENT_LISTENING, {
+            'name': name,
+            'state': STATE_LISTENING,
+            voice_metrics.ATTR_CORRELATION_ID: correlation_id
+        })
+
+        # The session runs in the worker; only its result comes back here
+        result = hass.loop.create_future()
+        worker.submit(lambda text: bridge.call(result.set_result, text))
+        text = yield from result
+        if text is None:
+            _LOGGER.info("SERVICE SNOWBOY STT CANCELLED")
+            return
 
-        _LOGGER.info("MODELS LOADED: %s" % str(indexed_models))
-        _LOGGER.info("MODELS: %s" % models)
-        _LOGGER.info("SENSITIVITIES: %s" % str(sensitivities))
-
-        detector = snowboydecoder.HotwordDetector(models,
-                                                  sensitivity=sensitivities,
-                                                  audio_gain=audio_gain)
-
-        _LOGGER.info("KEYWORDS: %s" % str(keywords))
-        callbacks = [lambda_callback_keyword(k) for k in keywords]
-        detector.start(detected_callback=callbacks,
-                       interrupt_check=interrupt_second,
-                       sleep_time=0.03)
-
-        detector.terminate()
+        # Fire detected event to HomeAssistant
+        hass.states.async_set(OBJECT_SNOWBOY, STATE_IDLE, state_attrs)
+        voice_metrics.mark(hass, correlation_id, EVENT_SPEECH_RECORDED)
+        hass.bus.async_fire(EVENT_SPEECH_RECORDED, {
+            'name': name,
+            voice_metrics.ATTR_CORRELATION_ID: correlation_id
+        })
+        voice_metrics.mark(hass, correlation_id, EVENT_SPEECH_TO_TEXT)
+        hass.bus.async_fire(EVENT_SPEECH_TO_TEXT, {
+            'name': name,  # name of the component
+            'text': text,  # text
+            voice_metrics.ATTR_CORRELATION_ID: correlation_id
+        })
+        _LOGGER.info("SERVICE SNOWBOY STT DETECTED: %s" % text)
         _LOGGER.info("SERVICE SNOWBOY STT COMPLETED")
 
     # Make sure snowboy terminates property when home assistant stops
-    def terminate(event):
-        nonlocal terminated
-        terminated = True
-        hass.bus.async_listen(EVENT_HOMEASSISTANT_STOP, terminate)
+    @asyncio.coroutine
+    def async_terminate(event):
+        yield from hass.async_add_job(worker.stop)
 
     # After defining values and functions, register services in Home Assistant
-    hass.services.async_register(DOMAIN, SERVICE_DETECT, detect)
-    hass.states.async_set(OBJECT_SNOWBOY, STATE_IDLE, state_attrs)
+    hass.bus.listen_once(EVENT_HOMEASSISTANT_STOP, async_terminate)
+    hass.services.register(DOMAIN, SERVICE_DETECT, async_detect)
+    hass.states.set(OBJECT_SNOWBOY, STATE_IDLE, state_attrs)
     _LOGGER.info('Snowboy STT Started')
+    startup.get(hass).setup_done(DOMAIN, started)
     return True
@@ -5,15 +5,22 @@ sudo apt-get install git build-essential \
     python3 python3-dev python3-pip python3-venv
 pip3 install SpeechRecognition
 """
+import collections
+import ctypes
 import os
 import logging
+import multiprocessing
+import threading
+import time
 import voluptuous as vol
-import speech_recognition as sr
-from homeassistant.const import CONF_NAME
+from homeassistant.const import CONF_NAME, EVENT_HOMEASSISTANT_STOP
 from homeassistant.helpers import config_validation as cv
 
+from custom_components import audio_capture, jsgf, loop_bridge, startup, voice_metrics
+
 _LOGGER = logging.getLogger(__name__)
 REQUIREMENTS = ['SpeechRecognition', 'pocketsphinx', 'webrtcvad==2.0.10', 'PyAudio>=0.2.8']
+DEPENDENCIES = [audio_capture.DOMAIN]
 DOMAIN = 'stt_speech_recognition'
 
 # ------------------------
@@ -23,6 +30,16 @@ DOMAIN = 'stt_speech_recognition'
 CONF_LANGUAGE = 'pt-br'
 CONF_GRAMMAR = 'grammar_path'
 CONF_TIMEOUT = 'timeout'
+CONF_STREAMING = 'streaming'
+CONF_STABLE_TIME = 'stable_time'
+CONF_CALIBRATION = 'calibration'
+# Worker processes decoding recorded commands (0 decodes in the calling
+# thread, 'auto' one per core but the one Home Assistant runs on)
+CONF_DECODER_PROCESSES = 'decoder_processes'
+# Commands waiting for a decoder process before new ones are refused
+CONF_DECODER_QUEUE = 'decoder_queue'
+# Seconds a command may wait for and take in a decoder process
+CONF_DECODER_TIMEOUT = 'decoder_timeout'
 
 
 # ----------------------
@@ -34,6 +51,28 @@ DEFAULT_UNKNOWN_COMMAND = 'unknown_command'
 DEFAULT_LANGUAGE = 'pt-br-picado'
 DEFAULT_GRAMMAR = '/opt/cefetmg/data/pocketsphinx/gramatica.jsgf'
 DEFAULT_TIMEOUT = 4.0
+DEFAULT_STREAMING = False
+DEFAULT_STABLE_TIME = 0.3
+DEFAULT_PHRASE_TIME_LIMIT = 10.0
+# Seconds streaming waits for a chunk before counting the device as stalled
+STALL_SECONDS = 1.0
+DEFAULT_DECODER_PROCESSES = 0
+DECODER_PROCESSES_AUTO = 'auto'
+DEFAULT_DECODER_QUEUE = 4
+DEFAULT_DECODER_TIMEOUT = 10.0
+# Longest command a decoder process accepts; longer ones lose their end
+DEFAULT_DECODER_BUFFER_SECONDS = 30.0
+# Decoders take 16 kHz, 16 bit mono PCM
+DECODER_BYTES_PER_SECOND = 16000 * 2
+
+# Key in hass.data of decode(raw_data), for commands recorded elsewhere (satellite)
+DATA_DECODE = '%s_decode' % DOMAIN
+
+# Energy threshold from the background noise estimator of audio_capture
+CALIBRATION_CACHED = 'cached'
+# Calibrate for one second before every command, as speech_recognition does
+CALIBRATION_FRESH = 'fresh'
+DEFAULT_CALIBRATION = CALIBRATION_CACHED
 
 # --------
 # Services
@@ -69,6 +108,13 @@ EVENT_SPEECH_RECORDED = 'speech_recorded'
 # Fired when decoding has finished
 EVENT_SPEECH_TO_TEXT = 'speech_to_text'
 
+# Why a streaming recording stopped
+ENDPOINT_GRAMMAR = 'grammar'
+ENDPOINT_SILENCE = 'silence'
+ENDPOINT_TIMEOUT = 'timeout'
+ENDPOINT_LIMIT = 'limit'
+ENDPOINT_STOPPED = 'stopped'
+
 
 # ------
 # Config
@@ -78,7 +124,14 @@ CONFIG_SCHEMA = vol.Schema({
     DOMAIN: vol.Schema({
         vol.Optional(CONF_NAME, DEFAULT_NAME): cv.string,
         vol.Optional(CONF_TIMEOUT, DEFAULT_TIMEOUT): float,
-        vol.Optional(CONF_LANGUAGE, DEFAULT_LANGUAGE): cv.string
+        vol.Optional(CONF_LANGUAGE, DEFAULT_LANGUAGE): cv.string,
+        vol.Optional(CONF_STREAMING, DEFAULT_STREAMING): cv.boolean,
+        vol.Optional(CONF_STABLE_TIME, DEFAULT_STABLE_TIME): vol.Coerce(float),
+        vol.Optional(CONF_CALIBRATION, DEFAULT_CALIBRATION): vol.In([CALIBRATION_CACHED, CALIBRATION_FRESH]),
+        vol.Optional(CONF_DECODER_PROCESSES, DEFAULT_DECODER_PROCESSES): vol.Any(
+            vol.All(int, vol.Range(min=0)), DECODER_PROCESSES_AUTO),
+        vol.Optional(CONF_DECODER_QUEUE, DEFAULT_DECODER_QUEUE): vol.All(int, vol.Range(min=1)),
+        vol.Optional(CONF_DECODER_TIMEOUT, DEFAULT_DECODER_TIMEOUT): vol.Coerce(float)
     })
 }, extra=vol.ALLOW_EXTRA)
 state_attrs = {
@@ -87,19 +140,19 @@ state_attrs = {
     'text': ''
 }
 
+
 # -----------------------------------------------------------------------------
-# SETUP
+# SPEECH RECOGNITION
 
+def speech_recognition():
+    """The speech_recognition module, imported on first use (about 100 ms)."""
+    import speech_recognition
+    return speech_recognition
 
-def setup(hass, config):
 
-    hass.states.set(OBJECT_POCKETSPHINX, STATE_LOADING, state_attrs)
-    name = config[DOMAIN].get(CONF_NAME, DEFAULT_NAME)
-    timeout = config[DOMAIN].get(CONF_TIMEOUT, DEFAULT_TIMEOUT)
-    language = config[DOMAIN].get(CONF_LANGUAGE, DEFAULT_LANGUAGE)
-    grammar = config[DOMAIN].get(CONF_GRAMMAR, DEFAULT_GRAMMAR)
-
-    language_dir = os.path.join(os.path.dirname(sr.__file__), "pocketsphinx-data", language)
+def model_paths(language, grammar):
+    """Decoder arguments for a pocketsphinx-data language of speech_recognition, checked."""
+    language_dir = os.path.join(os.path.dirname(speech_recognition().__file__), "pocketsphinx-data", language)
     acoustic_model_dir = os.path.join(language_dir, "acoustic-model")
     language_model_file = os.path.join(language_dir, "language-model.lm.bin")
     phoneme_dict_file = os.path.join(language_dir, "pronounciation-dictionary.dict")
@@ -108,49 +161,707 @@ def setup(hass, config):
     assert os.path.isdir(acoustic_model_dir), "Acoustic model directory not found: \"%s\"" % acoustic_model_dir
     assert os.path.exists(language_model_file), 'Language Model File does not exist in path %s' % language_model_file
     assert os.path.exists(phoneme_dict_file), 'Pronunciation Dictionary does not exist in path %s' % phoneme_dict_file
+    return acoustic_model_dir, language_model_file, phoneme_dict_file, grammar
+
+
+# -----------------------------------------------------------------------------
+# AUDIO SOURCE
+
+class CaptureSource(object):
+    """
+    speech_recognition source reading from the shared audio capture instead
+    of opening the microphone. When a hotword was just detected, recording
+    starts pre_roll seconds before the detection instead of at the call,
+    unless live is set. Build it with capture_source().
+    """
+
+    def __init__(self, capture, chunk_size=1024, live=False):
+        self.capture = capture
+        self.live = live
+        self.SAMPLE_RATE = capture.sample_rate
+        self.SAMPLE_WIDTH = capture.sample_width
+        self.CHUNK = chunk_size
+        self.stream = None
+
+    def __enter__(self):
+        reader = self.capture.reader() if self.live else self.capture.command_reader()
+        self.stream = CaptureSource.Stream(reader, self.capture.frame_bytes)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stream = None
+
+    class Stream(object):
+        def __init__(self, reader, frame_bytes):
+            self.reader = reader
+            self.frame_bytes = frame_bytes
+
+        def read(self, size):
+            # speech_recognition keeps the chunks around, so copy them out
+            data = self.reader.read(size * self.frame_bytes)
+            return b'' if data is None else bytes(data)
+
+
+_capture_source_type = None
+
+
+def capture_source(capture, chunk_size=1024, live=False):
+    """
+    A CaptureSource that is also the speech_recognition AudioSource the
+    recognizer asserts; the class is made on first use, with the import.
+    """
+    global _capture_source_type
+    if _capture_source_type is None:
+        _capture_source_type = type('CaptureSource', (CaptureSource, speech_recognition().AudioSource), {})
+    return _capture_source_type(capture, chunk_size, live)
+
+
+# -----------------------------------------------------------------------------
+# DECODER
+
+class SphinxDecoder(object):
+    """
+    pocketsphinx decoder built once and reused for every command, instead of
+    the one recognize_sphinx rebuilds (acoustic model, dictionary and
+    grammar) on each call. The compiled grammar is kept until the JSGF file
+    changes on disk.
+    """
+
+    def __init__(self, acoustic_model_dir, language_model_file, phoneme_dict_file, grammar):
+        self.acoustic_model_dir = acoustic_model_dir
+        self.language_model_file = language_model_file
+        self.phoneme_dict_file = phoneme_dict_file
+        self.grammar = grammar
+        self.load_time = None
+        self.automaton = None
+        self._decoder = None
+        self._grammar_mtime = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Builds the decoder. Blocking, call it off the event loop."""
+        import pocketsphinx
+
+        started = time.monotonic()
+        config = pocketsphinx.Decoder.default_config()
+        config.set_string("-hmm", self.acoustic_model_dir)
+        config.set_string("-lm", self.language_model_file)
+        config.set_string("-dict", self.phoneme_dict_file)
+        config.set_string("-logfn", os.devnull)
+        self._decoder = pocketsphinx.Decoder(config)
+        self._load_grammar()
+        self.load_time = time.monotonic() - started
+        _LOGGER.info("SPEECH_RECOGNITION: DECODER LOADED IN %.0f ms" % (1000 * self.load_time))
+        return self
+
+    def _load_grammar(self):
+        import pocketsphinx
+
+        mtime = os.path.getmtime(self.grammar)
+        grammar_dir = os.path.dirname(os.path.abspath(self.grammar))
+        grammar_name = os.path.splitext(os.path.basename(self.grammar))[0]
+        fsg_path = os.path.join(grammar_dir, '%s.fsg' % grammar_name)
+        logmath = self._decoder.get_logmath()
+        if os.path.exists(fsg_path) and os.path.getmtime(fsg_path) >= mtime:
+            fsg = pocketsphinx.FsgModel(fsg_path, logmath, 7.5)
+        else:
+            compiled = pocketsphinx.Jsgf(self.grammar)
+            rule = compiled.get_rule('%s.%s' % (grammar_name, grammar_name))
+            fsg = compiled.build_fsg(rule, logmath, 7.5)
+            # Decoder processes compile at the same time: each writes its own
+            # copy and moves it into place, so none reads a half-written file
+            temporary = '%s.%d.tmp' % (fsg_path, os.getpid())
+            fsg.writefile(temporary)
+            os.replace(temporary, fsg_path)
+            _LOGGER.info("SPEECH_RECOGNITION: GRAMMAR COMPILED TO %s" % fsg_path)
+        self._decoder.set_fsg(grammar_name, fsg)
+        self._decoder.set_search(grammar_name)
+        self._grammar_mtime = mtime
+
+        # Same grammar as a token automaton, to know when a sentence is complete
+        try:
+            self.automaton = jsgf.Grammar.load(self.grammar).compile()
+        except jsgf.GrammarError as error:
+            _LOGGER.warning("SPEECH_RECOGNITION: GRAMMAR ENDPOINTING DISABLED: %s" % error)
+            self.automaton = None
+
+    def decode(self, raw_data):
+        """
+        Decodes 16 kHz, 16 bit mono PCM. Returns the hypothesis text, or None
+        when nothing was recognized.
+        """
+        with self.utterance() as utterance:
+            utterance.feed(raw_data, full_utt=True)
+            return utterance.finish()
+
+    def utterance(self):
+        """Streaming decoding session. Holds the decoder until it exits."""
+        return SphinxUtterance(self)
+
+    def is_complete(self, text):
+        """True if text is a whole sentence of the grammar."""
+        return bool(text) and self.automaton is not None and self.automaton.accepts(text.split())
+
+
+class SphinxUtterance(object):
+    """Feeds audio to a SphinxDecoder chunk by chunk, exposing partial results."""
+
+    def __init__(self, owner):
+        self._owner = owner
+        self._decoder = None
+        self._finished = False
+
+    def __enter__(self):
+        self._owner._lock.acquire()
+        try:
+            if os.path.getmtime(self._owner.grammar) != self._owner._grammar_mtime:
+                self._owner._load_grammar()
+            self._decoder = self._owner._decoder
+            self._decoder.start_utt()
+        except Exception:
+            self._owner._lock.release()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if not self._finished:
+                self._decoder.end_utt()
+        finally:
+            self._owner._lock.release()
+
+    def feed(self, raw_data, full_utt=False):
+        """Decodes more audio. Returns the current partial hypothesis or None."""
+        self._decoder.process_raw(raw_data, False, full_utt)
+        hypothesis = self._decoder.hyp()
+        return hypothesis.hypstr if hypothesis is not None else None
+
+    @property
+    def in_speech(self):
+        return self._decoder.get_in_speech()
+
+    def finish(self):
+        """Ends the utterance and returns the final hypothesis or None."""
+        self._decoder.end_utt()
+        self._finished = True
+        hypothesis = self._decoder.hyp()
+        return hypothesis.hypstr if hypothesis is not None and hypothesis.hypstr else None
+
+
+# -----------------------------------------------------------------------------
+# DECODER POOL
+
+def decoder_process_count(value):
+    """Decoder processes for a decoder_processes option: 'auto' leaves one core to Home Assistant."""
+    if value == DECODER_PROCESSES_AUTO:
+        return max(1, (os.cpu_count() or 1) - 1)
+    return value
+
+
+class DecoderPoolError(Exception):
+    """A decoder process could not decode a command (handled as a speech_recognition RequestError)."""
+
+
+class DecoderBusy(DecoderPoolError):
+    """Too many commands are already waiting for a decoder process."""
+
+
+class DecoderTimeout(DecoderPoolError):
+    """No decoder process was free in time, or decoding took too long."""
+
+
+def serve_decoder(connection, buffer, decoder_args):
+    """
+    Body of a decoder process: loads one SphinxDecoder, then decodes every
+    command written into its shared buffer until it receives None.
+    """
+    try:
+        decoder = SphinxDecoder(*decoder_args).load()
+    except Exception as error:
+        connection.send(('error', repr(error)))
+        return
+    connection.send(('ready', decoder.load_time))
+    while True:
+        size = connection.recv()
+        if size is None:
+            break
+        try:
+            connection.send(('ok', decoder.decode(ctypes.string_at(buffer, size))))
+        except Exception as error:
+            connection.send(('error', repr(error)))
+
+
+class DecoderProcess(object):
+    """
+    One decoder process and its shared audio buffer. Audio is copied into
+    the buffer and only its size goes through the pipe. A process that
+    dies or stops answering is replaced; the replacement loads its decoder
+    in the background and is waited for by the next command.
+    """
+
+    def __init__(self, context, decoder_args, buffer_bytes):
+        self.context = context
+        self.decoder_args = decoder_args
+        self.buffer = context.RawArray(ctypes.c_char, buffer_bytes)
+        self.restarts = 0
+        self._process = None
+        self._connection = None
+        self._ready = False
+
+    def start(self):
+        self._connection, child = self.context.Pipe()
+        self._process = self.context.Process(
+            target=serve_decoder, args=(child, self.buffer, self.decoder_args),
+            name='%s decoder' % DOMAIN, daemon=True)
+        self._process.start()
+        child.close()
+        self._ready = False
+
+    def wait_ready(self, timeout=None):
+        """Blocks until the decoder is loaded. Returns its load time."""
+        status, value = self._receive(timeout)
+        if status != 'ready':
+            self.restart()
+            raise DecoderPoolError('Decoder process failed to load: %s' % value)
+        self._ready = True
+        return value
+
+    def decode(self, raw_data, timeout):
+        deadline = time.monotonic() + timeout
+        if not self._ready:
+            self.wait_ready(timeout)
+        size = min(len(raw_data), len(self.buffer))
+        size -= size % 2
+        if size < len(raw_data):
+            _LOGGER.warning("SPEECH_RECOGNITION: COMMAND TRUNCATED TO %.1f s FOR THE DECODER PROCESS"
+                            % (size / float(DECODER_BYTES_PER_SECOND)))
+        ctypes.memmove(self.buffer, raw_data, size)
+        try:
+            self._connection.send(size)
+        except (OSError, EOFError):
+            self._died()
+        status, value = self._receive(max(0.0, deadline - time.monotonic()))
+        if status != 'ok':
+            raise DecoderPoolError(value)
+        return value
+
+    def restart(self):
+        self.restarts += 1
+        _LOGGER.warning("SPEECH_RECOGNITION: RESTARTING DECODER PROCESS %s" % self._process.pid)
+        self.stop(timeout=0)
+        self.start()
+
+    def stop(self, timeout=1.0):
+        if self._process is None:
+            return
+        try:
+            self._connection.send(None)
+        except (OSError, EOFError):
+            pass
+        self._process.join(timeout)
+        if self._process.is_alive():
+            self._process.terminate()
+            self._process.join()
+        self._connection.close()
+
+    def _receive(self, timeout):
+        try:
+            if self._connection.poll(timeout):
+                return self._connection.recv()
+        except (OSError, EOFError):
+            self._died()
+        pid = self._process.pid
+        self.restart()
+        raise DecoderTimeout('Decoder process %d did not answer in %.2f s' % (pid, timeout))
+
+    def _died(self):
+        pid = self._process.pid
+        self.restart()
+        raise DecoderPoolError('Decoder process %d died' % pid)
+
+
+class DecoderPool(object):
+    """
+    Decodes recorded commands in worker processes, each with its own warm
+    SphinxDecoder, so decoding runs outside Home Assistant's GIL and its
+    shared executor and can use the other cores.
+
+    At most max_pending commands wait for a free process, served in arrival
+    order; more are refused with DecoderBusy instead of piling up. Processes
+    are started with spawn, not fork: Home Assistant has many threads whose
+    locks a forked child could inherit held.
+    """
+
+    def __init__(self, decoder_args, processes, max_pending=DEFAULT_DECODER_QUEUE,
+                 timeout=DEFAULT_DECODER_TIMEOUT, buffer_seconds=DEFAULT_DECODER_BUFFER_SECONDS):
+        self.context = multiprocessing.get_context('spawn')
+        self.decoder_args = decoder_args
+        self.buffer_bytes = int(buffer_seconds * DECODER_BYTES_PER_SECOND)
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.processes = self._new_processes(processes)
+        # Replaced by reload() but still decoding a command; stopped when released
+        self._retired = set()
+        self._retired_restarts = 0
+        self._idle = collections.deque()
+        # [event, process] of each waiting command, oldest first
+        self._waiting = collections.deque()
+        # Event of the process restart() waits for, while a command has it
+        self._wanted = {}
+        self._lock = threading.Lock()
+
+    @property
+    def restarts(self):
+        return self._retired_restarts + sum(p.restarts for p in self.processes)
+
+    def _new_processes(self, count):
+        return [DecoderProcess(self.context, self.decoder_args, self.buffer_bytes) for _ in range(count)]
+
+    def start(self):
+        """Starts the processes and waits for their decoders. Blocking."""
+        for process in self.processes:
+            process.start()
+        for process in self.processes:
+            load_time = process.wait_ready(self.timeout + 60.0)
+            _LOGGER.info("SPEECH_RECOGNITION: DECODER PROCESS LOADED IN %.0f ms" % (1000 * load_time))
+            self._release(process)
+        return self
+
+    def decode(self, raw_data, timeout=None):
+        """Same as SphinxDecoder.decode, raising DecoderPoolError when it cannot."""
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        process = self._acquire(timeout)
+        try:
+            return process.decode(raw_data, max(0.0, deadline - time.monotonic()))
+        finally:
+            self._release(process)
+
+    def restart(self):
+        """Replaces every process once, each as soon as it is free, e.g. to reload the grammar."""
+        for process in self.processes:
+            self._take(process)
+            process.restart()
+            self._release(process)
+
+    def reload(self):
+        """
+        Loads new processes while the current ones keep decoding, then swaps
+        them in at once, e.g. to reload the grammar. A command never waits
+        for a decoder to load. Blocking.
+        """
+        processes = self._new_processes(len(self.processes))
+        for process in processes:
+            process.start()
+        try:
+            for process in processes:
+                process.wait_ready(self.timeout + 60.0)
+        except DecoderPoolError:
+            for process in processes:
+                process.stop(timeout=0)
+            raise
+        with self._lock:
+            retired, self.processes = self.processes, processes
+            self._retired_restarts += sum(p.restarts for p in retired)
+            idle = list(self._idle)
+            self._idle.clear()
+            self._retired.update(p for p in retired if p not in idle)
+        for process in idle:
+            process.stop()
+        for process in processes:
+            self._release(process)
+
+    def _take(self, process):
+        """Takes this process out of service, waiting for its command to finish."""
+        with self._lock:
+            if process in self._idle:
+                self._idle.remove(process)
+                return
+            event = self._wanted[process] = threading.Event()
+        event.wait()
+
+    def _acquire(self, timeout):
+        with self._lock:
+            if self._idle and not self._waiting:
+                return self._idle.popleft()
+            if timeout is not None and len(self._waiting) >= self.max_pending:
+                raise DecoderBusy('%d commands already waiting for a decoder' % len(self._waiting))
+            slot = [threading.Event(), None]
+            self._waiting.append(slot)
+        if not slot[0].wait(timeout):
+            with self._lock:
+                # Handed a process between the timeout and taking the lock
+                if slot[1] is None:
+                    self._waiting.remove(slot)
+                    raise DecoderTimeout('No decoder process free in %.1f s' % timeout)
+        return slot[1]
+
+    def _release(self, process):
+        with self._lock:
+            retired = process in self._retired
+            self._retired.discard(process)
+        if retired:
+            process.stop()
+            return
+        with self._lock:
+            wanted = self._wanted.pop(process, None)
+            if wanted is not None:
+                # restart() is waiting for this one, it goes back after
+                wanted.set()
+            elif self._waiting:
+                slot = self._waiting.popleft()
+                slot[1] = process
+                slot[0].set()
+            else:
+                self._idle.append(process)
+
+    def stop(self):
+        for process in self.processes + list(self._retired):
+            process.stop()
+
+
+# -----------------------------------------------------------------------------
+# SETUP
+
+
+def setup(hass, config):
+    started = time.monotonic()
+    hass.states.set(OBJECT_POCKETSPHINX, STATE_LOADING, state_attrs)
+    name = config[DOMAIN].get(CONF_NAME, DEFAULT_NAME)
+    timeout = config[DOMAIN].get(CONF_TIMEOUT, DEFAULT_TIMEOUT)
+    language = config[DOMAIN].get(CONF_LANGUAGE, DEFAULT_LANGUAGE)
+    grammar = config[DOMAIN].get(CONF_GRAMMAR, DEFAULT_GRAMMAR)
+    streaming = config[DOMAIN].get(CONF_STREAMING, DEFAULT_STREAMING)
+    stable_time = config[DOMAIN].get(CONF_STABLE_TIME, DEFAULT_STABLE_TIME)
+    calibration = config[DOMAIN].get(CONF_CALIBRATION, DEFAULT_CALIBRATION)
+    decoder_processes = decoder_process_count(config[DOMAIN].get(CONF_DECODER_PROCESSES, DEFAULT_DECODER_PROCESSES))
+    capture = hass.data[audio_capture.DOMAIN]
+
+    # Services run in executor threads: updates reach the loop through the bridge
+    bridge = loop_bridge.get(hass)
+
+    # Streaming needs the decoder in this process, chunk by chunk: the
+    # processes then only decode commands recorded elsewhere (satellite)
+    decoder_args = None
+    pool = None
+    decoder = None
+    decoder_lock = threading.Lock()
+
+    def build_decoder():
+        return SphinxDecoder(*decoder_args).load()
+
+    # Models are checked and loaded after homeassistant_start, or by the first command
+    def load():
+        nonlocal decoder_args, pool, decoder
+        decoder_args = model_paths(language, grammar)
+        capture.start()
+        if decoder_processes:
+            pool = DecoderPool(decoder_args, decoder_processes,
+                               config[DOMAIN].get(CONF_DECODER_QUEUE, DEFAULT_DECODER_QUEUE),
+                               config[DOMAIN].get(CONF_DECODER_TIMEOUT, DEFAULT_DECODER_TIMEOUT)).start()
+        if streaming or pool is None:
+            decoder = build_decoder()
+        bridge.set_state(OBJECT_POCKETSPHINX, STATE_IDLE, state_attrs)
+
+    loaded = startup.get(hass).lazy(DOMAIN, load)
+
+    # Runs in the executor: stopping waits for the decoder processes to exit
+    def terminate(event):
+        if pool is not None:
+            pool.stop()
+
+    hass.bus.listen_once(EVENT_HOMEASSISTANT_STOP, terminate)
 
     # -------------------------------------------------------------------------
     # DETECTED TEXT CALLBACK
 
-    def detected_text(text):
-        hass.states.set(OBJECT_POCKETSPHINX, STATE_IDLE, state_attrs)
-        hass.bus.async_fire(EVENT_SPEECH_TO_TEXT, {'name': name, 'text': text})
+    def fire(event, correlation_id, **data):
+        voice_metrics.mark(hass, correlation_id, event)
+        data.update({'name': name, voice_metrics.ATTR_CORRELATION_ID: correlation_id})
+        bridge.fire(event, data)
+
+    def detected_text(text, correlation_id):
+        bridge.set_state(OBJECT_POCKETSPHINX, STATE_IDLE, state_attrs)
+        fire(EVENT_SPEECH_TO_TEXT, correlation_id, text=text)
         _LOGGER.info("SERVICE SPEECH_RECOGNITION_STT DETECTED: %s" % text)
+        return text
 
     # -------------------------------------------------------------------------
     # SERVICE LISTEN
 
+    def decode(raw_data):
+        if pool is not None:
+            return pool.decode(raw_data)
+        with decoder_lock:
+            current_decoder = decoder
+        return current_decoder.decode(raw_data)
+
+    def decode_recorded(raw_data):
+        """Text of a command recorded elsewhere (16 kHz, 16 bit mono PCM), or None. Blocking."""
+        loaded.get()
+        return decode(raw_data)
+
+    def calibrate(recognizer):
+        noise = capture.noise
+        if calibration == CALIBRATION_CACHED and noise.ready:
+            recognizer.energy_threshold = noise.energy_threshold
+            _LOGGER.info("SPEECH_RECOGNITION: CACHED ENERGY THRESHOLD %.0f" % recognizer.energy_threshold)
+            return
+        # Calibrate on live audio; the command reader keeps its own position
+        with capture_source(capture, live=True) as source:
+            recognizer.adjust_for_ambient_noise(source)
+        _LOGGER.info("SPEECH_RECOGNITION: CALIBRATED ENERGY THRESHOLD %.0f" % recognizer.energy_threshold)
+
     def listen(call):
+        recognize(voice_metrics.correlation_id(hass, call.data))
+
+    def record_and_decode(correlation_id, on_recorded=None):
+        sr = speech_recognition()
         r = sr.Recognizer()
-        with sr.Microphone() as source:
-            r.adjust_for_ambient_noise(source)
-            hass.states.set(OBJECT_POCKETSPHINX, STATE_LISTENING, state_attrs)
-            hass.bus.async_fire(EVENT_LISTENING, {'name': name, 'state': STATE_LISTENING})
+        with capture_source(capture) as source:
+            calibrate(r)
+            bridge.set_state(OBJECT_POCKETSPHINX, STATE_LISTENING, state_attrs)
+            fire(EVENT_LISTENING, correlation_id, state=STATE_LISTENING)
             try:
                 _LOGGER.warning("SPEECH_RECOGNITION: LISTENING TO MICROPHONE")
                 audio = r.listen(source, timeout=timeout)
-                hass.states.set(OBJECT_POCKETSPHINX, STATE_DECODING, state_attrs)
-                hass.bus.async_fire(EVENT_SPEECH_RECORDED, {'name': name})
+                bridge.set_state(OBJECT_POCKETSPHINX, STATE_DECODING, state_attrs)
+                fire(EVENT_SPEECH_RECORDED, correlation_id)
                 _LOGGER.warning("SPEECH_RECOGNITION: COMMAND RECORDED")
-
-                # recognize speech using Sphinx
-                speech = r.recognize_sphinx(audio, language=language, grammar=grammar)
+                if on_recorded is not None:
+                    on_recorded()
+
+                # recognize speech using the warm Sphinx decoder
+                started = time.monotonic()
+                speech = decode(audio.get_raw_data(convert_rate=16000, convert_width=2))
+                _LOGGER.info("SPEECH_RECOGNITION: DECODED %.1f s OF AUDIO IN %.0f ms" % (
+                    len(audio.frame_data) / float(audio.sample_rate * audio.sample_width),
+                    1000 * (time.monotonic() - started)))
+                if speech is None:
+                    raise sr.UnknownValueError()
                 _LOGGER.warning("SPEECH_RECOGNITION: SPEECH RECOGNIZED: %s" % speech)
-                detected_text(speech)
+                text = detected_text(speech, correlation_id)
 
             except sr.UnknownValueError:
                 _LOGGER.warning("SPEECH_RECOGNITION: Sphinx could not understand audio")
-                detected_text(DEFAULT_UNKNOWN_COMMAND)
-            except sr.RequestError as e:
+                text = detected_text(DEFAULT_UNKNOWN_COMMAND, correlation_id)
+            except (sr.RequestError, DecoderPoolError) as e:
                 _LOGGER.warning("SPEECH_RECOGNITION: Sphinx error; {0}".format(e))
-                detected_text(DEFAULT_UNKNOWN_COMMAND)
+                text = detected_text(DEFAULT_UNKNOWN_COMMAND, correlation_id)
             _LOGGER.info("SERVICE SPEECH_RECOGNITION COMPLETED")
+            return text
+
+    # -------------------------------------------------------------------------
+    # SERVICE LISTEN, STREAMING MODE
+
+    def stream_and_decode(correlation_id, on_recorded=None):
+        with decoder_lock:
+            current_decoder = decoder
+        chunk_seconds = capture.bytes_to_seconds(capture.chunk_bytes)
+        stable_chunks = max(1, int(round(stable_time / chunk_seconds)))
+        reader = capture.command_reader()
+
+        bridge.set_state(OBJECT_POCKETSPHINX, STATE_LISTENING, state_attrs)
+        fire(EVENT_LISTENING, correlation_id, state=STATE_LISTENING)
+        _LOGGER.warning("SPEECH_RECOGNITION: LISTENING TO MICROPHONE")
+
+        with current_decoder.utterance() as utterance:
+            recorded = 0.0
+            heard_speech = False
+            partial, stable = None, 0
+            endpoint = ENDPOINT_STOPPED
+            while True:
+                data = reader.read(capture.chunk_bytes, timeout=STALL_SECONDS)
+                if data is None:
+                    if not capture.running:
+                        break
+                    # The device stalled: the wait counts toward timeout and limit
+                    recorded += STALL_SECONDS
+                    hypothesis = partial
+                else:
+                    recorded += chunk_seconds
+                    hypothesis = utterance.feed(bytes(data))
+                speaking = utterance.in_speech
+                heard_speech = heard_speech or speaking
+
+                if hypothesis != partial:
+                    partial, stable = hypothesis, 0
+                    bridge.set_state(OBJECT_POCKETSPHINX, STATE_LISTENING, dict(state_attrs, text=partial or ''))
+                else:
+                    stable += 1
+
+                if stable >= stable_chunks and current_decoder.is_complete(partial):
+                    endpoint = ENDPOINT_GRAMMAR
+                elif heard_speech and not speaking:
+                    endpoint = ENDPOINT_SILENCE
+                elif not heard_speech and recorded >= timeout:
+                    endpoint = ENDPOINT_TIMEOUT
+                elif recorded >= timeout + DEFAULT_PHRASE_TIME_LIMIT:
+                    endpoint = ENDPOINT_LIMIT
+                else:
+                    continue
+                break
+
+            bridge.set_state(OBJECT_POCKETSPHINX, STATE_DECODING, state_attrs)
+            fire(EVENT_SPEECH_RECORDED, correlation_id)
+            _LOGGER.warning("SPEECH_RECOGNITION: COMMAND RECORDED (%s endpoint after %.2f s)" % (endpoint, recorded))
+            if on_recorded is not None:
+                on_recorded()
+            speech = utterance.finish() if heard_speech else None
+
+        if speech is None:
+            _LOGGER.warning("SPEECH_RECOGNITION: Sphinx could not understand audio")
+            text = detected_text(DEFAULT_UNKNOWN_COMMAND, correlation_id)
+        else:
+            _LOGGER.warning("SPEECH_RECOGNITION: SPEECH RECOGNIZED: %s" % speech)
+            text = detected_text(speech, correlation_id)
+        _LOGGER.info("SERVICE SPEECH_RECOGNITION COMPLETED")
+        return text
+
+    # -------------------------------------------------------------------------
+    # RECORD AND DECODE ONE COMMAND
+
+    def recognize(correlation_id, on_recorded=None):
+        """
+        Records and decodes one command, firing the same events as listen;
+        on_recorded() is called once recording stops, before decoding.
+        Returns the text (DEFAULT_UNKNOWN_COMMAND if not understood).
+        Blocking: voice_assistant calls it from its own thread.
+        """
+        loaded.get()
+        with capture.noise.suspended():
+            if streaming:
+                return stream_and_decode(correlation_id, on_recorded)
+            return record_and_decode(correlation_id, on_recorded)
+
+    # -------------------------------------------------------------------------
+    # SERVICE RESET
+
+    def reset(call):
+        nonlocal decoder
+        if not loaded.ready:
+            # Loads the models for the first time, nothing to reload
+            loaded.get()
+            return
+        if pool is not None:
+            pool.reload()
+            _LOGGER.warning("SPEECH_RECOGNITION: DECODER PROCESSES RELOADED")
+        if decoder is None:
+            return
+        # Build the new decoder before swapping, so listen never waits for it
+        new_decoder = build_decoder()
+        with decoder_lock:
+            decoder = new_decoder
+        _LOGGER.warning("SPEECH_RECOGNITION: DECODER RELOADED")
 
     # -------------------------------------------------------------------------
 
     # Service to listen and identify commands
     hass.services.register(DOMAIN, SERVICE_LISTEN, listen)
-    hass.states.set(OBJECT_POCKETSPHINX, STATE_IDLE, state_attrs)
+    hass.services.register(DOMAIN, SERVICE_RESET, reset)
+    hass.data[DOMAIN] = recognize
+    hass.data[DATA_DECODE] = decode_recorded
     _LOGGER.info('Started')
+    startup.get(hass).setup_done(DOMAIN, started)
 
     return True
@@ -0,0 +1,343 @@
+"""
+Runs a voice command, from the hotword to the spoken feedback, as one state
+machine calling the voice components directly.
+
+Before, a command went through a chain of automations: hotword_detected
+called cue_player.play and stt_speech_recognition.listen,
+listening_to_microphone called speech.speak, speech_to_text called
+intent_table.parse and hotword_snowboy.listen, and a successful command came
+back from the broker on hass/successful_command to input_boolean and then
+to speech.speak. Every hop rendered templates and dispatched a service call,
+and the feedback waited for an MQTT round trip.
+
+Here the detector hands the command to a thread that steps through
+
+    idle -> cue -> prompt -> recognizing -> intent -> feedback -> idle
+
+calling the cue player, the speech worker, the recognizer and the intent
+handler in turn. The components still fire their events (hotword_detected,
+listening_to_microphone, speech_recorded, speech_to_text) and this one fires
+cue_played and text_to_speech, so observers see the same events as before.
+The automations of the chain must be removed while this component is on.
+"""
+import asyncio
+import logging
+import queue
+import threading
+import time
+
+import voluptuous as vol
+from homeassistant.const import EVENT_HOMEASSISTANT_START, EVENT_HOMEASSISTANT_STOP
+from homeassistant.helpers import config_validation as cv
+
+from custom_components import (
+    audio_capture, cue_player, hotword_snowboy, intent_table, loop_bridge, speech, startup,
+    stt_speech_recognition, voice_metrics)
+
+_LOGGER = logging.getLogger(__name__)
+
+DOMAIN = 'voice_assistant'
+DEPENDENCIES = [audio_capture.DOMAIN, cue_player.DOMAIN, hotword_snowboy.DOMAIN,
+                stt_speech_recognition.DOMAIN, intent_table.DOMAIN, speech.DOMAIN]
+
+# ------
+# Config
+# ------
+
+# Cue played after the hotword, before the prompt ('' for none)
+CONF_HOTWORD_CUE = 'hotword_cue'
+
+# Cue played when the command has been recorded ('' for none)
+CONF_RECORDED_CUE = 'recorded_cue'
+
+# Phrases spoken before listening, after an intent was published and when
+# the command was not understood
+CONF_PROMPT = 'prompt'
+CONF_SUCCESS = 'success'
+CONF_UNKNOWN = 'unknown'
+
+# Room of this microphone: commands naming no room act on it (intent_table room_slot)
+CONF_ROOM = 'room'
+
+# ----------------------
+# Configuration defaults
+# ----------------------
+
+DEFAULT_CUE = 'command_recorded'
+DEFAULT_PROMPT = {speech.ATTR_MESSAGE: 'Diga', speech.ATTR_SPEECH_RATE: 100}
+DEFAULT_SUCCESS = {speech.ATTR_MESSAGE: speech.DEFAULT_MESSAGE, speech.ATTR_SPEECH_RATE: 160}
+DEFAULT_UNKNOWN = {speech.ATTR_MESSAGE: 'Não Entendi.', speech.ATTR_SPEECH_RATE: 120}
+
+PHRASE_SCHEMA = vol.Schema({
+    vol.Required(speech.ATTR_MESSAGE): vol.Any(cv.string, [cv.string]),
+    vol.Optional(speech.ATTR_SPEECH_RATE, speech.DEFAULT_SPEECH_RATE): int
+})
+
+CONFIG_SCHEMA = vol.Schema({
+    DOMAIN: vol.Schema({
+        vol.Optional(CONF_HOTWORD_CUE, DEFAULT_CUE): cv.string,
+        vol.Optional(CONF_RECORDED_CUE, DEFAULT_CUE): cv.string,
+        vol.Optional(CONF_PROMPT, DEFAULT_PROMPT): PHRASE_SCHEMA,
+        vol.Optional(CONF_SUCCESS, DEFAULT_SUCCESS): PHRASE_SCHEMA,
+        vol.Optional(CONF_UNKNOWN, DEFAULT_UNKNOWN): PHRASE_SCHEMA,
+        vol.Optional(CONF_ROOM): cv.string
+    })
+}, extra=vol.ALLOW_EXTRA)
+
+# Represents the command being run
+OBJECT_PIPELINE = '%s.pipeline' % DOMAIN
+
+# Waiting for the hotword
+STATE_IDLE = 'idle'
+
+# Playing the hotword cue
+STATE_CUE = 'cue'
+
+# Speaking the prompt
+STATE_PROMPT = 'prompt'
+
+# Recording and decoding the command
+STATE_RECOGNIZING = 'recognizing'
+
+# Publishing the intent
+STATE_INTENT = 'intent'
+
+# Speaking the feedback, with the detector armed again
+STATE_FEEDBACK = 'feedback'
+
+# Longest wait for a cue or the prompt before going on without it
+STEP_TIMEOUT = 30.0
+
+state_attrs = {
+    'friendly_name': 'Voice Assistant',
+    'icon': 'mdi:account-voice'
+}
+
+
+# -----------------------------------------------------------------------------
+# PHRASES
+
+def phrase(conf):
+    """(fragments, rate) from a phrase of the configuration."""
+    messages = conf[speech.ATTR_MESSAGE]
+    return (messages if isinstance(messages, list) else [messages],
+            conf.get(speech.ATTR_SPEECH_RATE, speech.DEFAULT_SPEECH_RATE))
+
+
+# -----------------------------------------------------------------------------
+# STATE MACHINE
+
+class VoiceAssistant(object):
+    """
+    Runs one command at a time in its own thread. A hotword heard while a
+    command is running is dropped: the detector stays disarmed until the
+    intent has been published, as it did with the automations.
+
+    recognize(correlation_id, on_recorded) and handle(text, correlation_id)
+    are the stt_speech_recognition and intent_table entry points; fire and
+    mark are loop_bridge.fire and voice_metrics.mark, and on_state(state,
+    attributes) receives every transition.
+    """
+
+    def __init__(self, detector, player, speaker, recognize, handle, phrases, cues,
+                 capture=None, fire=None, mark=None, on_state=None):
+        self.detector = detector
+        self.player = player
+        self.speaker = speaker
+        self.recognize = recognize
+        self.handle = handle
+        # (prompt, success, unknown), each (fragments, rate) or None
+        self.prompt, self.success, self.unknown = phrases
+        # (after the hotword, after recording), None for no cue
+        self.hotword_cue, self.recorded_cue = cues
+        # Told where the prompt ended, so the command does not start with it
+        self.capture = capture
+        self.fire = fire or (lambda event_type, data: None)
+        self.mark = mark or (lambda correlation_id, stage: None)
+        self.on_state = on_state
+        self.state = STATE_IDLE
+        self._current = None
+        self._busy = threading.Event()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=DOMAIN, daemon=True)
+        self.stats = {
+            'commands': 0,
+            'understood': 0,
+            'dropped': 0,
+            'last_duration': None
+        }
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._queue.put(None)
+        self._thread.join(timeout=5.0)
+
+    def detected(self, correlation_id):
+        """Detector listener: starts a command unless one is running. Never blocks."""
+        if self._busy.is_set():
+            self.stats['dropped'] += 1
+            _LOGGER.info('VOICE_ASSISTANT: HOTWORD IGNORED, %s STILL RUNNING' % self._current)
+            return
+        self._busy.set()
+        self._queue.put(correlation_id)
+
+    def _run(self):
+        while True:
+            correlation_id = self._queue.get()
+            if correlation_id is None:
+                break
+            try:
+                self._command(correlation_id)
+            except Exception:
+                _LOGGER.exception('VOICE_ASSISTANT: COMMAND %s FAILED' % correlation_id)
+                self._enter(STATE_IDLE, correlation_id)
+                self._rearm()
+
+    def _rearm(self):
+        # Ready for the next command before the detector can report it
+        self._busy.clear()
+        self.detector.arm()
+
+    def _command(self, correlation_id):
+        started = time.monotonic()
+        self.stats['commands'] += 1
+
+        self._enter(STATE_CUE, correlation_id)
+        self._wait(lambda done: self._cue(self.hotword_cue, correlation_id, done))
+
+        self._enter(STATE_PROMPT, correlation_id)
+        if self._wait(lambda done: self._say(self.prompt, correlation_id, speech.PRIORITY_HIGH, done)) \
+                and self.capture is not None:
+            self.capture.mark(audio_capture.MARK_PLAYBACK)
+
+        self._enter(STATE_RECOGNIZING, correlation_id)
+        text = self.recognize(correlation_id, lambda: self._cue(self.recorded_cue, correlation_id))
+
+        self._enter(STATE_INTENT, correlation_id, text=text)
+        understood = self.handle(text, correlation_id)
+        self.stats['understood'] += understood
+        # Listen for the next command while the feedback is spoken
+        self._rearm()
+
+        self._enter(STATE_FEEDBACK, correlation_id, text=text)
+        self.stats['last_duration'] = time.monotonic() - started
+        if not self._say(self.success if understood else self.unknown, correlation_id,
+                         speech.PRIORITY_NORMAL if understood else speech.PRIORITY_HIGH,
+                         lambda: self._finished(correlation_id)):
+            self._finished(correlation_id)
+
+    def _finished(self, correlation_id):
+        # Another command may have started during the feedback
+        if self._current == correlation_id:
+            self._enter(STATE_IDLE, correlation_id)
+
+    def _enter(self, state, correlation_id, **attributes):
+        self.state, self._current = state, correlation_id
+        _LOGGER.debug('VOICE_ASSISTANT: %s -> %s' % (correlation_id, state))
+        if self.on_state is not None:
+            attributes[voice_metrics.ATTR_CORRELATION_ID] = correlation_id
+            self.on_state(state, attributes)
+
+    @staticmethod
+    def _wait(step):
+        """Runs step(done) and waits for done(); False if the step did nothing."""
+        done = threading.Event()
+        if not step(done.set):
+            return False
+        if not done.wait(STEP_TIMEOUT):
+            _LOGGER.warning('VOICE_ASSISTANT: STEP TIMED OUT AFTER %.0f s' % STEP_TIMEOUT)
+        return True
+
+    def _cue(self, name, correlation_id, done=None):
+        """Queues a cue; False if there is none to play."""
+        if not name:
+            return False
+
+        def played():
+            self.mark(correlation_id, cue_player.EVENT_CUE_PLAYED)
+            self.fire(cue_player.EVENT_CUE_PLAYED, {
+                cue_player.ATTR_CUE: name,
+                voice_metrics.ATTR_CORRELATION_ID: correlation_id
+            })
+            if done is not None:
+                done()
+
+        if not self.player.play(name, played):
+            _LOGGER.warning('VOICE_ASSISTANT: UNKNOWN CUE %s' % name)
+            return False
+        return True
+
+    def _say(self, spoken, correlation_id, priority, done=None):
+        """Queues a phrase; False if there is none to say."""
+        if spoken is None:
+            return False
+        messages, rate = spoken
+        message = ' '.join(messages).replace(',', '')
+        self.mark(correlation_id, speech.STAGE_SPEAK_REQUESTED)
+
+        def said(cancelled):
+            if not cancelled:
+                self.mark(correlation_id, speech.EVENT_TEXT_TO_SPEECH)
+                self.fire(speech.EVENT_TEXT_TO_SPEECH, {
+                    'name': '%s.%s' % (speech.DOMAIN, speech.SERVICE_SPEAK),
+                    'message': message,
+                    voice_metrics.ATTR_CORRELATION_ID: correlation_id
+                })
+            if done is not None:
+                done()
+
+        self.speaker.speak(messages, rate, said, priority)
+        return True
+
+
+# -----------------------------------------------------------------------------
+
+@asyncio.coroutine
+def async_setup(hass, config):
+    started = time.monotonic()
+    conf = config.get(DOMAIN, {})
+    cues = tuple(conf.get(key, DEFAULT_CUE) or None for key in (CONF_HOTWORD_CUE, CONF_RECORDED_CUE))
+    phrases = tuple(phrase(conf.get(key, default)) for key, default in (
+        (CONF_PROMPT, DEFAULT_PROMPT), (CONF_SUCCESS, DEFAULT_SUCCESS), (CONF_UNKNOWN, DEFAULT_UNKNOWN)))
+    room = conf.get(CONF_ROOM)
+    bridge = loop_bridge.get(hass)
+    detector = hass.data[hotword_snowboy.DOMAIN]
+    # Built by intent_table after homeassistant_start, or by the first command
+    intents = hass.data[intent_table.DOMAIN]
+
+    def on_state(state, attributes):
+        bridge.set_state(OBJECT_PIPELINE, state, dict(state_attrs, **attributes))
+        # The detector is armed here instead of through hotword_snowboy.listen
+        if state == STATE_FEEDBACK:
+            bridge.set_state(hotword_snowboy.OBJECT_SNOWBOY, hotword_snowboy.STATE_LISTENING,
+                             hotword_snowboy.state_attrs)
+
+    assistant = VoiceAssistant(
+        detector, hass.data[cue_player.DOMAIN], hass.data[speech.DOMAIN],
+        hass.data[stt_speech_recognition.DOMAIN],
+        lambda text, correlation_id: intents.get().handle(text, correlation_id, room), phrases, cues,
+        capture=hass.data[audio_capture.DOMAIN], fire=bridge.fire,
+        mark=lambda correlation_id, stage: voice_metrics.mark(hass, correlation_id, stage),
+        on_state=on_state)
+    assistant.start()
+    detector.listeners.append(assistant.detected)
+    hass.data[DOMAIN] = assistant
+
+    @asyncio.coroutine
+    def async_start(event):
+        detector.arm()
+        hass.states.async_set(hotword_snowboy.OBJECT_SNOWBOY, hotword_snowboy.STATE_LISTENING,
+                              hotword_snowboy.state_attrs)
+
+    @asyncio.coroutine
+    def async_terminate(event):
+        yield from hass.async_add_job(assistant.stop)
+
+    hass.states.async_set(OBJECT_PIPELINE, STATE_IDLE, state_attrs)
+    hass.bus.async_listen(EVENT_HOMEASSISTANT_START, async_start)
+    hass.bus.async_listen(EVENT_HOMEASSISTANT_STOP, async_terminate)
+    _LOGGER.info('VOICE_ASSISTANT STARTED: cues %s, prompt %s, room %s' % (cues, phrases[0], room))
+    startup.get(hass).setup_done(DOMAIN, started)
+    return True
@@ -0,0 +1,304 @@
+"""
+Latency of the voice pipeline, per stage.
+
+Every event of a command (hotword_detected, listening_to_microphone,
+speech_recorded, speech_to_text, the intent publish and text_to_speech)
+carries the same correlation_id. The components call mark() at each stage;
+this component keeps a histogram of the time between consecutive stages of
+the same command and exposes p50/p95/p99 as sensor.voice_latency_* states.
+
+mark() only appends to a deque; histograms are updated on the event loop
+every scan_interval. Without a voice_metrics section, or with enabled: false,
+mark() returns immediately.
+"""
+import asyncio
+import collections
+import json
+import logging
+import math
+import time
+import uuid
+from datetime import timedelta
+
+import voluptuous as vol
+from homeassistant.const import CONF_SCAN_INTERVAL
+from homeassistant.helpers import config_validation as cv
+from homeassistant.helpers.event import async_track_time_interval
+
+from custom_components import startup
+
+_LOGGER = logging.getLogger(__name__)
+DOMAIN = 'voice_metrics'
+
+# ------
+# Config
+# ------
+
+CONF_ENABLED = 'enabled'
+CONF_DUMP_PATH = 'dump_path'
+
+# ----------------------
+# Configuration defaults
+# ----------------------
+
+DEFAULT_ENABLED = True
+DEFAULT_SCAN_INTERVAL = 10
+DEFAULT_DUMP_PATH = 'voice_metrics.json'
+
+CONFIG_SCHEMA = vol.Schema({
+    DOMAIN: vol.Schema({
+        vol.Optional(CONF_ENABLED, DEFAULT_ENABLED): cv.boolean,
+        vol.Optional(CONF_SCAN_INTERVAL, DEFAULT_SCAN_INTERVAL): vol.All(vol.Coerce(float), vol.Range(min=1)),
+        vol.Optional(CONF_DUMP_PATH, DEFAULT_DUMP_PATH): cv.string
+    })
+}, extra=vol.ALLOW_EXTRA)
+
+# --------
+# Services
+# --------
+
+# Writes every histogram to a JSON file
+SERVICE_DUMP = 'dump'
+
+# Clears every histogram
+SERVICE_RESET = 'reset'
+
+# Starts or stops recording
+SERVICE_TURN_ON = 'turn_on'
+SERVICE_TURN_OFF = 'turn_off'
+
+# ----------------
+# Calls attributes
+# ----------------
+
+# Carried by every event and service call of one voice command
+ATTR_CORRELATION_ID = 'correlation_id'
+ATTR_PATH = 'path'
+ATTR_RESET = 'reset'
+
+# Sensor with the latency from hotword to intent published
+STAGE_TOTAL = 'total'
+# Stage that closes a command for the total latency
+STAGE_END = 'intent_published'
+
+# Stages of one command separated by more than this are not measured
+SESSION_TIMEOUT = 60.0
+# Commands followed at the same time (only the latest ones are kept)
+MAX_SESSIONS = 32
+# Marks waiting for the next update before old ones are dropped
+MAX_PENDING_MARKS = 10000
+
+SENSOR_FORMAT = 'sensor.voice_latency_%s'
+
+
+# -----------------------------------------------------------------------------
+# HELPERS USED BY THE VOICE COMPONENTS
+
+def new_correlation_id():
+    return uuid.uuid4().hex[:12]
+
+
+def correlation_id(hass, data):
+    """
+    Correlation id of a service call. Calls triggered by MQTT automations
+    have none, and are attributed to the command being followed, if any.
+    """
+    value = data.get(ATTR_CORRELATION_ID)
+    if value and str(value).strip():
+        return str(value).strip()
+    recorder = hass.data.get(DOMAIN)
+    active = recorder.active if recorder is not None else None
+    return active or new_correlation_id()
+
+
+def mark(hass, correlation_id, stage):
+    """Records that a command reached a stage. Safe from any thread."""
+    recorder = hass.data.get(DOMAIN)
+    if recorder is not None:
+        recorder.mark(correlation_id, stage)
+
+
+# -----------------------------------------------------------------------------
+# HISTOGRAM
+
+class Histogram(object):
+    """
+    Log-spaced buckets 5% wide from 0.1 ms to about two minutes, so memory
+    is constant and percentiles are within 5% of the exact value.
+    """
+
+    MINIMUM = 1e-4
+    GROWTH = 1.05
+    BUCKETS = 290
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def add(self, seconds):
+        if seconds <= self.MINIMUM:
+            index = 0
+        else:
+            index = min(self.BUCKETS - 1, 1 + int(math.log(seconds / self.MINIMUM) / math.log(self.GROWTH)))
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        self.maximum = max(self.maximum, seconds)
+
+    def percentile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= rank and count:
+                return min(self.maximum, self.MINIMUM * self.GROWTH ** index)
+        return self.maximum
+
+    def summary(self):
+        def ms(seconds):
+            return None if seconds is None else round(1000 * seconds, 1)
+        return {
+            'count': self.count,
+            'mean': ms(self.total / self.count if self.count else None),
+            'p50': ms(self.percentile(0.50)),
+            'p95': ms(self.percentile(0.95)),
+            'p99': ms(self.percentile(0.99)),
+            'max': ms(self.maximum if self.count else None)
+        }
+
+
+# -----------------------------------------------------------------------------
+# RECORDER
+
+class Recorder(object):
+    """Turns stage marks into per-transition latency histograms."""
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.histograms = collections.OrderedDict()
+        self._marks = collections.deque(maxlen=MAX_PENDING_MARKS)
+        self._sessions = collections.OrderedDict()
+        self._active = (None, 0.0)
+
+    @property
+    def active(self):
+        """Correlation id of the latest command, if it is still running."""
+        active, last_seen = self._active
+        return active if time.monotonic() - last_seen < SESSION_TIMEOUT else None
+
+    def mark(self, correlation_id, stage):
+        if not self.enabled or not correlation_id:
+            return
+        now = time.monotonic()
+        self._active = (correlation_id, now)
+        self._marks.append((correlation_id, stage, now))
+
+    def update(self):
+        """Moves pending marks into histograms; returns the names that changed."""
+        changed = set()
+        while self._marks:
+            correlation_id, stage, timestamp = self._marks.popleft()
+            session = self._sessions.get(correlation_id)
+            if session is None or timestamp - session[2] > SESSION_TIMEOUT:
+                self._sessions[correlation_id] = [timestamp, stage, timestamp]
+                if len(self._sessions) > MAX_SESSIONS:
+                    self._sessions.popitem(last=False)
+                continue
+            started, previous, previous_time = session
+            changed.add(self._add('%s_to_%s' % (previous, stage), timestamp - previous_time))
+            if stage == STAGE_END:
+                changed.add(self._add(STAGE_TOTAL, timestamp - started))
+            session[1], session[2] = stage, timestamp
+        return changed
+
+    def _add(self, name, seconds):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.add(seconds)
+        return name
+
+    def reset(self):
+        self._marks.clear()
+        self._sessions.clear()
+        self.histograms.clear()
+
+    def summary(self):
+        return collections.OrderedDict((name, histogram.summary()) for name, histogram in self.histograms.items())
+
+
+# -----------------------------------------------------------------------------
+# SETUP
+
+@asyncio.coroutine
+def async_setup(hass, config):
+    started = time.monotonic()
+    enabled = config[DOMAIN].get(CONF_ENABLED, DEFAULT_ENABLED)
+    scan_interval = config[DOMAIN].get(CONF_SCAN_INTERVAL, DEFAULT_SCAN_INTERVAL)
+    dump_path = config[DOMAIN].get(CONF_DUMP_PATH, DEFAULT_DUMP_PATH)
+
+    recorder = Recorder(enabled)
+    hass.data[DOMAIN] = recorder
+
+    def publish(names):
+        for name in names:
+            summary = recorder.histograms[name].summary()
+            p50 = summary.pop('p50')
+            summary.update({
+                'friendly_name': 'Latency %s' % name.replace('_to_', ' > ').replace('_', ' '),
+                'unit_of_measurement': 'ms',
+                'icon': 'mdi:timer'
+            })
+            hass.states.async_set(SENSOR_FORMAT % name, p50, summary)
+
+    @asyncio.coroutine
+    def async_update(now=None):
+        publish(recorder.update())
+
+    @asyncio.coroutine
+    def async_dump(call):
+        recorder.update()
+        path = hass.config.path(call.data.get(ATTR_PATH, dump_path))
+        summary = recorder.summary()
+
+        def write():
+            with open(path, 'w') as dump_file:
+                json.dump(summary, dump_file, indent=2)
+
+        yield from hass.async_add_job(write)
+        for name, values in summary.items():
+            _LOGGER.warning("VOICE_METRICS %s: %s" % (name, values))
+        if call.data.get(ATTR_RESET, False):
+            recorder.reset()
+
+    @asyncio.coroutine
+    def async_reset(call):
+        recorder.reset()
+        for name in hass.states.async_entity_ids('sensor'):
+            if name.startswith(SENSOR_FORMAT % ''):
+                hass.states.async_remove(name)
+
+    @asyncio.coroutine
+    def async_turn_on(call):
+        recorder.enabled = True
+
+    @asyncio.coroutine
+    def async_turn_off(call):
+        recorder.enabled = False
+
+    hass.services.async_register(DOMAIN, SERVICE_DUMP, async_dump, schema=vol.Schema({
+        vol.Optional(ATTR_PATH): cv.string,
+        vol.Optional(ATTR_RESET): cv.boolean
+    }))
+    hass.services.async_register(DOMAIN, SERVICE_RESET, async_reset)
+    hass.services.async_register(DOMAIN, SERVICE_TURN_ON, async_turn_on)
+    hass.services.async_register(DOMAIN, SERVICE_TURN_OFF, async_turn_off)
+    async_track_time_interval(hass, async_update, timedelta(seconds=scan_interval))
+
+    _LOGGER.info('Started')
+    startup.get(hass).setup_done(DOMAIN, started)
+    return True
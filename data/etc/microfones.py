@@ -1,8 +1,19 @@
 #!/usr/bin/env python3
 
+import os
 import pprint
+import sys
+
 import pyaudio
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from custom_components.audio_devices import DeviceProfileError, DeviceProfiles, PyAudioDevices  # noqa: E402
+
+# Same choice audio_capture makes on its first start (16 kHz, ~1024 frame blocks)
+SAMPLE_RATE = 16000
+FRAMES_PER_BUFFER = 1024
+
 def main():
     audio = pyaudio.PyAudio()
     print('')
@@ -13,6 +24,11 @@ def main():
         print('-' * len(banner))
         pprint.pprint(info)
         print('')
+    profiles = DeviceProfiles(os.devnull, SAMPLE_RATE, lambda rate: rate * FRAMES_PER_BUFFER // SAMPLE_RATE)
+    try:
+        print('Perfil do audio_capture: %s' % (profiles.probe(PyAudioDevices(audio)),))
+    except DeviceProfileError as error:
+        print('Nenhum perfil: %s' % error)
 
 if __name__ == '__main__':
     main()
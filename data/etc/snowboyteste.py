@@ -1,18 +1,22 @@
-from snowboy import snowboydecoder
-import sys
+import os
 import signal
+import sys
+import threading
+
+from snowboy import snowboydecoder
 
-interrupted = False
+# Run from anywhere: the repository root holds custom_components
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
 
+from custom_components.audio_capture import AudioCapture, PyAudioSource  # noqa: E402
+from custom_components.hotword_snowboy import ResidentDetector  # noqa: E402
 
-def signal_handler(signal, frame):
-    global interrupted
-    interrupted = True
+# Set by SIGINT; the main thread sleeps on it instead of polling a flag
+interrupted = threading.Event()
 
 
-def interrupt_callback():
-    global interrupted
-    return interrupted
+def signal_handler(signal, frame):
+    interrupted.set()
 
 
 if len(sys.argv) == 1:
@@ -25,16 +29,19 @@ else:
 # capture SIGINT signal, e.g., Ctrl+C
 signal.signal(signal.SIGINT, signal_handler)
 
-detector = snowboydecoder.HotwordDetector(model, sensitivity=0.5)
+# The detector thread wakes only when the microphone delivers audio
+capture = AudioCapture(PyAudioSource())
+capture.start()
+detector = ResidentDetector(capture, model, 0.5, 1.0, snowboydecoder.play_audio_file, auto_rearm=True)
+detector.arm()
+detector.start()
 print('Listening... Press Ctrl+C to exit')
 
 # main loop
-detector.start(detected_callback=snowboydecoder.play_audio_file,
-               interrupt_check=interrupt_callback,
-               sleep_time=0.03)
-
-detector.terminate()
+interrupted.wait()
 
+detector.stop()
+capture.stop()
 
 
 """
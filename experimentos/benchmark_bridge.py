@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Rajada de comandos de voz vindos de threads de trabalho: cada comando faz a
+sequência de atualizações do stt_speech_recognition em modo streaming
+(listening, texto parcial a cada bloco, decoding, idle e três eventos). Compara
+hass.states.set / hass.bus.fire chamados direto das threads com o
+loop_bridge.
+
+Mede quantas vezes as threads acordam o loop (chamadas a
+call_soon_threadsafe), quantos estados são escritos de fato, o tempo até o
+último evento chegar a um ouvinte e a vazão de eventos.
+
+Uso (na venv do homeassistant, a partir da raiz do repositório):
+    python3 experimentos/benchmark_bridge.py [--commands 200] [--threads 4] [--partials 10]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from homeassistant.core import HomeAssistant  # noqa: E402
+
+from custom_components import loop_bridge  # noqa: E402
+
+ENTITY = 'stt_speech_recognition.pocketsphinx'
+EVENTS = ['listening_to_microphone', 'speech_recorded', 'speech_to_text']
+
+
+class Counter(object):
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def add(self):
+        with self._lock:
+            self.value += 1
+
+
+def command(set_state, fire, partials, index):
+    set_state(ENTITY, 'listening', {'text': ''})
+    fire(EVENTS[0], {'command': index})
+    for partial in range(partials):
+        set_state(ENTITY, 'listening', {'text': 'ligar luz'[:partial]})
+    set_state(ENTITY, 'decoding', {})
+    fire(EVENTS[1], {'command': index})
+    set_state(ENTITY, 'idle', {})
+    fire(EVENTS[2], {'command': index})
+
+
+def run(path, commands, threads, partials):
+    loop = asyncio.new_event_loop()
+    hass = HomeAssistant(loop)
+    wakeups = Counter()
+    call_soon_threadsafe = loop.call_soon_threadsafe
+
+    def counting(*args):
+        wakeups.add()
+        return call_soon_threadsafe(*args)
+
+    loop.call_soon_threadsafe = counting
+    received = []
+    states = []
+    finished = threading.Event()
+
+    def on_event(event):
+        received.append(time.perf_counter())
+        if event.event_type == EVENTS[2] and len(received) == commands * len(EVENTS):
+            finished.set()
+
+    for event_type in EVENTS:
+        hass.bus.async_listen(event_type, on_event)
+    hass.bus.async_listen('state_changed', lambda event: states.append(event))
+    loop_thread = threading.Thread(target=loop.run_forever, daemon=True)
+    loop_thread.start()
+
+    if path == 'direct':
+        set_state, fire = hass.states.set, hass.bus.fire
+    else:
+        bridge = loop_bridge.get(hass)
+        set_state, fire = bridge.set_state, bridge.fire
+
+    def worker(first):
+        for index in range(first, commands, threads):
+            command(set_state, fire, partials, index)
+
+    started = time.perf_counter()
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    finished.wait(30.0)
+    elapsed = time.perf_counter() - started
+    loop.call_soon_threadsafe(loop.stop)
+    loop_thread.join()
+    pushed = commands * (partials + 3 + len(EVENTS))
+    return pushed, wakeups.value, len(states), len(received), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--commands', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--partials', type=int, default=10)
+    args = parser.parse_args()
+
+    print('%-8s %8s %10s %10s %8s %10s %12s' % (
+        'path', 'updates', 'wakeups', 'states', 'events', 'time ms', 'events/s'))
+    for path in ('direct', 'bridge'):
+        pushed, wakeups, states, events, elapsed = run(path, args.commands, args.threads, args.partials)
+        print('%-8s %8d %10d %10d %8d %10.1f %12.0f' % (
+            path, pushed, wakeups, states, events, 1000 * elapsed, events / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Mede o bipe do cue_player sem placa de som (saída null ou arquivo WAV):
+
+    carga      tempo e memória para ler os WAVs de data/etc/wav
+    atraso     do play() até o primeiro quadro chegar na saída, e do play()
+               até o aviso de fim descontada a duração do bipe
+    vazamento  onde começa o leitor do comando (command_reader) com o bipe
+               tocado depois do hotword: antes o bipe entrava na gravação
+
+Se aplay ou cvlc estiverem instalados, mede também o caminho antigo: um
+processo novo por bipe (o media_player do VLC faz o mesmo), descontada a
+duração do arquivo.
+
+Uso:
+    python3 experimentos/benchmark_cues.py [--cue command_recorded] [-n 20]
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from custom_components import audio_capture  # noqa: E402
+from custom_components.audio_capture import AudioCapture, SyntheticSource  # noqa: E402
+from custom_components.cue_player import CuePlayer, NullSink, WaveFileSink, cue_seconds, load_cues  # noqa: E402
+
+CUES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'etc', 'wav')
+SPAWN_COMMANDS = [
+    ('aplay', ['aplay', '-q']),
+    ('cvlc', ['cvlc', '--play-and-exit', '--quiet'])
+]
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def report(name, values):
+    print('%-22s p50 %7.2f ms  p95 %7.2f ms  max %7.2f ms' % (
+        name, 1000 * percentile(values, 0.5), 1000 * percentile(values, 0.95), 1000 * max(values)))
+
+
+def measure_player(player, name, count):
+    delays, overheads = [], []
+    duration = cue_seconds(player.cues[name])
+    for _ in range(count):
+        done = threading.Event()
+        started = time.monotonic()
+        player.play(name, done.set)
+        done.wait()
+        overheads.append(time.monotonic() - started - duration)
+        delays.append(player.stats['last_delay'])
+    return delays, overheads
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cue', default='command_recorded')
+    parser.add_argument('-n', type=int, default=20)
+    args = parser.parse_args()
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    cues = load_cues(CUES)
+    elapsed = time.perf_counter() - started
+    print('loaded %s in %.1f ms, %.0f KiB' % (
+        ', '.join(cues), 1000 * elapsed, tracemalloc.get_traced_memory()[0] / 1024.0))
+    tracemalloc.stop()
+    duration = cue_seconds(cues[args.cue])
+    print('%s lasts %.0f ms' % (args.cue, 1000 * duration))
+
+    player = CuePlayer(cues, NullSink())
+    player.start()
+    delays, overheads = measure_player(player, args.cue, args.n)
+    player.stop()
+    report('null: to first frame', delays)
+    report('null: end - duration', overheads)
+
+    path = os.path.join(tempfile.mkdtemp(prefix='cues_'), 'sink.wav')
+    player = CuePlayer(cues, WaveFileSink(path))
+    player.start()
+    delays, overheads = measure_player(player, args.cue, args.n)
+    player.stop()
+    report('file: to first frame', delays)
+    report('file: end - duration', overheads)
+    print('file sink wrote %d bytes to %s' % (os.path.getsize(path), path))
+
+    wav = os.path.join(CUES, '%s.wav' % args.cue)
+    for name, command in SPAWN_COMMANDS:
+        if shutil.which(command[0]) is None:
+            print('%-22s not installed, skipped' % ('%s per cue' % name))
+            continue
+        overheads = []
+        for _ in range(args.n):
+            started = time.monotonic()
+            subprocess.run(command + [wav], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            overheads.append(time.monotonic() - started - duration)
+        report('%s: end - duration' % name, overheads)
+
+    # Hotword, then the cue, then the command reader
+    capture = AudioCapture(SyntheticSource(), pre_roll=0.25)
+    capture.start()
+    time.sleep(0.5)
+    player = CuePlayer(cues, NullSink(), capture)
+    player.start()
+    capture.mark(audio_capture.MARK_HOTWORD)
+    hotword = capture.position
+    done = threading.Event()
+    player.play(args.cue, done.set)
+    done.wait()
+    cue_end = capture.position
+    reader = capture.command_reader()
+    player.stop()
+    capture.stop()
+    print('command reader starts %.0f ms after the hotword, the cue ended %.0f ms after it '
+          '(without the playback mark it would start %.0f ms before the hotword, cue included)' % (
+              1000 * capture.bytes_to_seconds(reader.position - hotword),
+              1000 * capture.bytes_to_seconds(cue_end - hotword), 1000 * capture.pre_roll))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Exercita o perfil de dispositivo do audio_capture (audio_devices.DeviceProfiles)
+contra uma lista falsa de dispositivos, parecida com a do log em
+data/etc/snowboyteste.py: placa onboard, HDMI sem entrada, os PCMs do ALSA
+(front, rear, surround, dmix...) e um microfone USB que só grava a 44.1 e
+48 kHz. Cada formato sondado custa --probe-ms, como abrir o dispositivo ALSA.
+
+Cenários, em sequência sobre o mesmo arquivo de perfil:
+
+    primeira       sem perfil salvo: sonda (o padrão do sistema primeiro) e salva
+    seguinte       perfil salvo: abre direto, sem sondar
+    renumerado     o USB volta em outro índice: achado pelo nome
+    desplugado     o USB sumiu: sonda de novo e fica com o onboard
+    outro pedido   device_name mudou na configuração: o perfil salvo não vale
+
+Uso:
+    python3 experimentos/benchmark_device_profile.py [--probe-ms 40]
+"""
+import argparse
+import math
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from custom_components.audio_devices import Device, DeviceProfiles, FakeDevices  # noqa: E402
+
+SAMPLE_RATE = 16000
+FRAMES_PER_BUFFER = 1024
+
+ONBOARD = 'HDA Intel PCH: ALC662 rev3 Analog (hw:0,0)'
+USB = 'USB PnP Sound Device: Audio (hw:2,0)'
+ALSA_PCMS = ['sysdefault', 'front', 'surround21', 'surround40', 'surround41', 'surround50', 'surround51',
+             'surround71', 'iec958', 'spdif', 'dmix']
+
+
+def device_list(usb_index):
+    """The onboard card first, the ALSA PCMs, then the USB microphone at usb_index (None: unplugged)."""
+    devices = [
+        Device(0, ONBOARD, 2, 44100),
+        Device(1, 'HDA Intel PCH: HDMI 0 (hw:0,3)', 0, 44100)
+    ]
+    for name in ALSA_PCMS:
+        devices.append(Device(len(devices), name, 0 if name in ('iec958', 'spdif') else 2, 44100))
+    if usb_index is not None:
+        devices.insert(usb_index, Device(usb_index, USB, 1, 44100))
+        devices = [device._replace(index=index) for index, device in enumerate(devices)]
+    return devices
+
+
+class SlowDevices(FakeDevices):
+    """Each format probed takes probe_seconds, like opening the ALSA device."""
+
+    def __init__(self, devices, supported, default_index, probe_seconds):
+        super().__init__(devices, supported, default_index)
+        self.probe_seconds = probe_seconds
+
+    def supports(self, index, sample_rate, channels):
+        time.sleep(self.probe_seconds)
+        return super().supports(index, sample_rate, channels)
+
+
+def supported_formats():
+    # The onboard codec records 16 kHz mono through plughw; the USB microphone only at its native rates
+    formats = {(ONBOARD, rate, 1) for rate in (16000, 44100, 48000)}
+    formats |= {(USB, rate, 1) for rate in (44100, 48000)}
+    formats |= {(name, rate, 1) for name in ('sysdefault', 'dmix') for rate in (44100, 48000)}
+    return formats
+
+
+def period(rate):
+    """Frames read per block of about 1024 frames at 16 kHz, in whole resampling periods (as FrontEnd.blocks)."""
+    common = math.gcd(rate, SAMPLE_RATE)
+    return max(1, int(round(FRAMES_PER_BUFFER * common / float(SAMPLE_RATE)))) * rate // common
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--probe-ms', type=float, default=40.0)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(prefix='profile_'), '.audio_capture_profile.json')
+    # The USB microphone is the default input while plugged in
+    scenarios = [
+        ('primeira', 13, None),
+        ('seguinte', 13, None),
+        ('renumerado', 2, None),
+        ('desplugado', None, None),
+        ('seguinte', None, None),
+        ('outro pedido', None, 'ALC662')
+    ]
+    print('%-13s %-45s %6s %6s %8s %9s' % ('cenário', 'dispositivo', 'taxa', 'leitura', 'sondas', 'tempo'))
+    for name, usb_index, device_name in scenarios:
+        devices = SlowDevices(device_list(usb_index), supported_formats(), 0 if usb_index is None else usb_index,
+                              args.probe_ms / 1000.0)
+        profiles = DeviceProfiles(path, SAMPLE_RATE, period, device_name=device_name)
+        started = time.monotonic()
+        profile = profiles.resolve(devices)
+        elapsed = time.monotonic() - started
+        print('%-13s %-45s %6d %6d %8d %7.0f ms  (%s)' % (
+            name, '%d: %s' % (profile.device_index, profile.device_name), profile.sample_rate,
+            profile.frames_per_buffer, devices.probes, 1000 * elapsed, profiles.stats['source']))
+    print('perfil em %s' % path)
+
+
+if __name__ == '__main__':
+    main()
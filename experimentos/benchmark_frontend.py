@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Mede o FrontEnd do audio_capture (reamostragem, passa-altas, AGC e
+limitador com NumPy) contra o caminho atual de cada biblioteca:
+
+    ratecv+mul        audioop.ratecv para 16 kHz (o que o speech_recognition
+                      faz em AudioData.get_raw_data(convert_rate=16000)) e
+                      audioop.mul com o audio_gain escalar (o SetAudioGain do
+                      snowboy), bloco a bloco
+    speech_recognition AudioData.get_raw_data, se estiver instalado
+
+Para cada taxa de entrada (16, 44.1 e 48 kHz) mostra quadros de entrada por
+segundo de CPU (um núcleo, time.process_time) e quantas vezes o tempo real
+isso dá, e a qualidade do resultado:
+
+    alias   nível de um tom de 10 kHz depois de ir para 16 kHz (deveria sumir:
+            acima do Nyquist de 8 kHz ele volta como 6 kHz)
+    DC      média que sobra de um sinal de 1 kHz com offset de 3000
+    pico    pico de um tom a 99% da escala depois do ganho (32767 é clipping)
+
+Uso:
+    python3 experimentos/benchmark_frontend.py [--seconds 30]
+"""
+import argparse
+import audioop
+import math
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from custom_components.audio_capture import FrontEnd  # noqa: E402
+
+OUTPUT_RATE = 16000
+INPUT_RATES = [16000, 44100, 48000]
+FRAMES_PER_BUFFER = 1024
+# audio_gain of configuration.yaml before the front end
+SNOWBOY_GAIN = 0.7
+
+
+def tone(rate, frequency, seconds, amplitude, offset=0):
+    t = np.arange(int(rate * seconds)) / float(rate)
+    return np.clip(amplitude * 32767 * np.sin(2 * np.pi * frequency * t) + offset, -32768, 32767).astype(np.int16)
+
+
+def speech_like(rate, seconds):
+    """Noise shaped a bit like speech, with a slow level envelope and a DC offset."""
+    generator = np.random.RandomState(0)
+    t = np.arange(int(rate * seconds)) / float(rate)
+    envelope = 0.05 + 0.2 * (1 + np.sin(2 * np.pi * 0.5 * t))
+    noise = np.convolve(generator.standard_normal(len(t)), np.ones(8) / 8, mode='same')
+    return np.clip(32767 * envelope * noise + 500, -32768, 32767).astype(np.int16)
+
+
+class FrontEndPath(object):
+    name = 'front end'
+
+    def __init__(self, rate):
+        self.front_end = FrontEnd(rate, OUTPUT_RATE, FRAMES_PER_BUFFER)
+        self.front_end.open()
+        self.block = self.front_end.input_frames
+
+    def process(self, data):
+        return bytes(self.front_end.process(data))
+
+
+class AudioopPath(object):
+    name = 'ratecv+mul'
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.block = FRAMES_PER_BUFFER * rate // OUTPUT_RATE
+        self._state = None
+
+    def process(self, data):
+        if self.rate != OUTPUT_RATE:
+            data, self._state = audioop.ratecv(data, 2, 1, self.rate, OUTPUT_RATE, self._state)
+        return audioop.mul(data, 2, SNOWBOY_GAIN)
+
+
+class SpeechRecognitionPath(object):
+    name = 'speech_recognition'
+
+    def __init__(self, rate):
+        import speech_recognition
+        self.audio_data = speech_recognition.AudioData
+        self.rate = rate
+        self.block = FRAMES_PER_BUFFER * rate // OUTPUT_RATE
+
+    def process(self, data):
+        return self.audio_data(data, self.rate, 2).get_raw_data(convert_rate=OUTPUT_RATE, convert_width=2)
+
+
+def run(path, samples):
+    """Output of path for samples, block by block, and the CPU seconds it took."""
+    data = samples.tobytes()
+    step = 2 * path.block
+    output = []
+    started = time.process_time()
+    for start in range(0, len(data), step):
+        output.append(path.process(data[start:start + step]))
+    elapsed = time.process_time() - started
+    return np.frombuffer(b''.join(output), np.int16).astype(np.float64), elapsed
+
+
+def level_db(output, reference, skip):
+    rms = output[skip:].std()
+    return 20 * math.log10(max(rms, 1e-9) / reference)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seconds', type=float, default=30.0)
+    args = parser.parse_args()
+
+    paths = [FrontEndPath, AudioopPath]
+    try:
+        import speech_recognition  # noqa: F401
+        paths.append(SpeechRecognitionPath)
+    except ImportError:
+        print('speech_recognition is not installed, skipped')
+
+    skip = OUTPUT_RATE // 4
+    reference = 0.3 * 32767 / math.sqrt(2)
+    print('%-8s %-19s %12s %9s %9s %8s %7s' % ('rate', 'path', 'frames/s', 'realtime', 'alias', 'DC', 'peak'))
+    for rate in INPUT_RATES:
+        speech = speech_like(rate, args.seconds)
+        for path_class in paths:
+            _, elapsed = run(path_class(rate), speech)
+            alias, _ = run(path_class(rate), tone(rate, 10000, 2, 0.3)) if rate > OUTPUT_RATE else (None, 0)
+            offset, _ = run(path_class(rate), tone(rate, 1000, 2, 0.3, offset=3000))
+            loud, _ = run(path_class(rate), tone(rate, 1000, 2, 0.99))
+            print('%-8d %-19s %12.0f %8.0fx %9s %8.0f %7.0f' % (
+                rate, path_class.name, len(speech) / elapsed, args.seconds / elapsed,
+                '-' if alias is None else '%.0f dB' % level_db(alias, reference, skip),
+                offset[skip:].mean(), np.abs(loud[skip:]).max()))
+
+
+if __name__ == '__main__':
+    main()
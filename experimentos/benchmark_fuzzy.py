@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Mede a busca aproximada do intent_table (FuzzyIndex) com 10 mil frases
+sintéticas (4 verbos x 50 aparelhos x 50 cômodos, nomes inventados com
+sílabas do português).
+
+As consultas são frases conhecidas com um erro do reconhecedor: uma letra
+trocada, tirada ou acrescentada numa palavra, ou um artigo a mais ('a luz
+da sala'). Para cada uma compara o índice com a varredura de todas as
+frases (mesma pontuação, sem índice): tempo por consulta, quantas frases
+são pontuadas, e se os dois acham a mesma frase. Mede também o caminho
+exato (dicionário) e a construção do índice.
+
+Uso:
+    python3 experimentos/benchmark_fuzzy.py [--devices 50] [--rooms 50] [--lookups 2000] [--threshold 0.7]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from custom_components.intent_table import IntentTable  # noqa: E402
+
+VERBS = ['ligar', 'acender', 'desligar', 'apagar']
+SYLLABLES = [c + v for c in ['b', 'c', 'd', 'f', 'g', 'j', 'l', 'm', 'n', 'p', 'r', 's', 't', 'v', 'z', 'ch', 'lh', 'nh']
+             for v in 'aeiou']
+LETTERS = 'abcdefghijlmnopqrstuvz'
+ARTICLES = ['a', 'o', 'da', 'do']
+
+
+def words(count, rng):
+    names = set()
+    while len(names) < count:
+        names.add(''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    return sorted(names)
+
+
+def typo(word, rng):
+    position = rng.randrange(len(word))
+    kind = rng.choice(['swap', 'drop', 'add'])
+    if kind == 'swap':
+        return word[:position] + rng.choice(LETTERS) + word[position + 1:]
+    if kind == 'drop' and len(word) > 3:
+        return word[:position] + word[position + 1:]
+    return word[:position] + rng.choice(LETTERS) + word[position:]
+
+
+def misrecognize(phrase, rng):
+    tokens = phrase.split()
+    if rng.random() < 0.5:
+        index = rng.randrange(len(tokens))
+        tokens[index] = typo(tokens[index], rng)
+    else:
+        tokens.insert(rng.randrange(1, len(tokens)), rng.choice(ARTICLES))
+    return ' '.join(tokens)
+
+
+def linear_search(index, phrase, threshold):
+    """The same score over every phrase, without the inverted index."""
+    words = list(dict.fromkeys(phrase.split()))
+    similar = [index.similar(word) for word in words]
+    best = (0.0, None)
+    for phrase_words, candidate in zip(index._words, index.phrases):
+        total = sum(max([close.get(word, 0.0) for word in phrase_words]) for close in similar)
+        score = 2.0 * total / (len(words) + len(phrase_words))
+        if score >= threshold and (score, candidate) > best:
+            best = (score, candidate)
+    return best
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def timed(function, queries):
+    times, results = [], []
+    for query in queries:
+        started = time.perf_counter()
+        results.append(function(query))
+        times.append(time.perf_counter() - started)
+    return times, results
+
+
+def report(name, times):
+    print('%-16s mean %8.1f us  p50 %8.1f us  p95 %8.1f us' % (
+        name, 1e6 * sum(times) / len(times), 1e6 * percentile(times, 0.5), 1e6 * percentile(times, 0.95)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--devices', type=int, default=50)
+    parser.add_argument('--rooms', type=int, default=50)
+    parser.add_argument('--lookups', type=int, default=2000)
+    parser.add_argument('--threshold', type=float, default=0.7)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    devices, rooms = words(args.devices, rng), words(args.rooms, rng)
+    phrases = ['%s %s %s' % (verb, device, room) for verb in VERBS for device in devices for room in rooms]
+    topics = ['hass/switch/%s/%s/set' % tuple(p.split()[1:]) for p in phrases]
+    payloads = ['ON' if p.split()[0] in ('ligar', 'acender') else 'OFF' for p in phrases]
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    table = IntentTable(phrases, topics, payloads, fuzzy_threshold=args.threshold)
+    build = time.perf_counter() - started
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print('%d phrases, index built in %.2f s, %.1f MiB with the table' % (len(table.fuzzy), build, memory / 2 ** 20))
+
+    targets = [rng.choice(phrases) for _ in range(args.lookups)]
+    queries = [misrecognize(target, rng) for target in targets]
+
+    report('exact', timed(table.match, targets)[0])
+    index = table.fuzzy
+    index.candidates = 0
+    fuzzy_times, fuzzy_results = timed(lambda q: table.match(q), queries)
+    scored = index.candidates / len(queries)
+    linear_times, linear_results = timed(lambda q: linear_search(index, q, args.threshold), queries)
+    report('fuzzy (index)', fuzzy_times)
+    report('fuzzy (linear)', linear_times)
+    print('phrases scored per lookup: %.0f of %d (%.1f%%)' % (scored, len(index), 100.0 * scored / len(index)))
+
+    found = sum(1 for result in fuzzy_results if result[0] is not None)
+    correct = sum(1 for result, target in zip(fuzzy_results, targets) if result[1] == target)
+    agree = sum(1 for result, (score, candidate) in zip(fuzzy_results, linear_results)
+                if result[1] is None or result[1] == candidate)
+    print('accepted %d/%d, right phrase %d/%d, same phrase as the linear scan %d/%d' % (
+        found, len(queries), correct, len(queries), agree, len(queries)))
+
+
+if __name__ == '__main__':
+    main()
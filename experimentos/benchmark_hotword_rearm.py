@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Mede a latência de re-armar o detector de hotword: criar um HotwordDetector
+novo a cada listen (caminho antigo) vs armar o ResidentDetector já carregado.
+
+Precisa do snowboy e de um microfone. Uso:
+    python3 experimentos/benchmark_hotword_rearm.py /opt/cefetmg/data/snowboy/genio.pmdl [-n 20]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from snowboy import snowboydecoder  # noqa: E402
+
+from custom_components.audio_capture import AudioCapture, SyntheticSource  # noqa: E402
+from custom_components.hotword_snowboy import ResidentDetector  # noqa: E402
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def report(name, values):
+    print('%-20s p50 %9.3f ms  p95 %9.3f ms  max %9.3f ms' % (
+        name, 1000 * percentile(values, 0.5), 1000 * percentile(values, 0.95), 1000 * max(values)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('model')
+    parser.add_argument('-n', '--iterations', type=int, default=20)
+    args = parser.parse_args()
+
+    # Old path: model load and stream open until the detector is running,
+    # plus the teardown paid after each detection
+    rebuild = []
+    for _ in range(args.iterations):
+        start = time.monotonic()
+        detector = snowboydecoder.HotwordDetector(args.model, sensitivity=0.5)
+        rebuild.append(time.monotonic() - start)
+        start = time.monotonic()
+        detector.terminate()
+        rebuild[-1] += time.monotonic() - start
+
+    capture = AudioCapture(SyntheticSource())
+    capture.start()
+    resident = ResidentDetector(capture, args.model, 0.5, 1.0, lambda: None)
+    resident.start()
+    rearm = []
+    for _ in range(args.iterations):
+        start = time.monotonic()
+        resident.arm()
+        rearm.append(time.monotonic() - start)
+        resident.disarm()
+    resident.stop()
+    capture.stop()
+
+    report('new detector/listen', rebuild)
+    report('resident re-arm', rearm)
+    print('resident detector one-time load: %.1f ms' % (1000 * resident.load_time))
+
+
+if __name__ == '__main__':
+    main()
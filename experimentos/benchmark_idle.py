@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Mede CPU e acordadas por segundo do detector de hotword ocioso (ninguém
+falando): o laço antigo do snowboydecoder (consulta o buffer e dorme 30 ms
+quando vazio, chamando interrupt_check a cada volta) vs o ResidentDetector,
+que dorme na condição do audio_capture até chegar áudio, e desarmado não
+processa nada.
+
+Acordadas são as voltas do laço do detector: no antigo, cada sleep e cada
+leitura; no novo, cada bloco de áudio (ele nunca acorda sem áudio). A CPU
+é a do processo menos a da captura sozinha (thread do audio_capture), e as
+trocas de contexto voluntárias (getrusage) vão junto para comparação; elas
+incluem a troca do GIL e do lock da condição a cada bloco.
+
+Precisa do snowboy, mas não de microfone: o áudio vem de um SyntheticSource
+em tempo real (ou de um WAV com --wav). Uso:
+    python3 experimentos/benchmark_idle.py /opt/cefetmg/data/snowboy/genio.pmdl [--seconds 10]
+"""
+import argparse
+import os
+import resource
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from snowboy import snowboydecoder, snowboydetect  # noqa: E402
+
+from custom_components.audio_capture import AudioCapture, SyntheticSource, WaveFileSource  # noqa: E402
+from custom_components.hotword_snowboy import ResidentDetector  # noqa: E402
+
+SLEEP_TIME = 0.03
+
+
+class LegacyLoop(object):
+    """Same structure as snowboydecoder.HotwordDetector.start."""
+
+    def __init__(self, detector, capture):
+        self.detector = detector
+        self.capture = capture
+        self.wakeups = 0
+        self.interrupted = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self.interrupted.set()
+        self._thread.join()
+
+    def _run(self):
+        reader = self.capture.reader()
+        while True:
+            self.wakeups += 1
+            if self.interrupted.is_set():
+                break
+            available = reader.available - reader.available % self.capture.frame_bytes
+            if available == 0:
+                time.sleep(SLEEP_TIME)
+                continue
+            self.detector.RunDetection(bytes(reader.read(available, timeout=0)))
+
+
+def measure(seconds, wakeups=lambda: 0):
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu, switches, woken, started = time.process_time(), usage.ru_nvcsw, wakeups(), time.monotonic()
+    time.sleep(seconds)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    elapsed = time.monotonic() - started
+    return ((time.process_time() - cpu) / elapsed, (wakeups() - woken) / elapsed,
+            (usage.ru_nvcsw - switches) / elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('model')
+    parser.add_argument('--seconds', type=float, default=10.0)
+    parser.add_argument('--wav', help='WAV 16 kHz mono no lugar do silêncio sintético')
+    args = parser.parse_args()
+
+    source = WaveFileSource(args.wav, loop=True) if args.wav else SyntheticSource(amplitude=0.001)
+    capture = AudioCapture(source)
+    capture.start()
+    time.sleep(1.0)
+    results = [('capture only', measure(args.seconds))]
+
+    detector = snowboydetect.SnowboyDetect(
+        resource_filename=snowboydecoder.RESOURCE_FILE.encode(), model_str=args.model.encode())
+    detector.SetSensitivity(b'0.5')
+    legacy = LegacyLoop(detector, capture)
+    legacy.start()
+    results.append(('poll 30 ms', measure(args.seconds, lambda: legacy.wakeups)))
+    legacy.stop()
+
+    resident = ResidentDetector(capture, args.model, 0.5, 1.0, lambda: None, auto_rearm=True)
+    resident.start()
+    resident.arm()
+    results.append(('event armed', measure(args.seconds, lambda: resident.chunks)))
+    resident.disarm()
+    time.sleep(0.2)
+    results.append(('event disarmed', measure(args.seconds, lambda: resident.chunks)))
+    resident.stop()
+    capture.stop()
+
+    base_cpu = results[0][1][0]
+    print('%-15s %8s %14s %14s %16s' % ('', 'CPU %', 'detector CPU %', 'wakeups/s', 'ctx switches/s'))
+    for name, (cpu, wakeups, switches) in results:
+        print('%-15s %8.2f %14.2f %14.1f %16.1f' % (
+            name, 100 * cpu, 100 * (cpu - base_cpu), wakeups, switches))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Compara as duas formas do intent_table com uma gramática sintética de N
+cômodos x M aparelhos (padrão 100 x 50) e quatro verbos:
+
+    tabela    todas as frases enumeradas nas três listas (prhase_list, ...)
+    gramática o JSGF compilado uma vez, com <local>, <aparelho> e <acao> como
+              slots preenchendo templates de tópico e payload
+
+Mede tempo de construção, memória alocada (tracemalloc) e tempo por consulta,
+e confere que as duas formas dão o mesmo tópico e payload para cada frase.
+A memória da gramática é medida também com menos cômodos, para mostrar que
+ela cresce com os cômodos e aparelhos somados, não com o produto.
+
+Uso:
+    python3 experimentos/benchmark_intents.py [--rooms 100] [--devices 50] [--lookups 2000]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from custom_components import jsgf  # noqa: E402
+from custom_components.intent_table import IntentTable  # noqa: E402
+
+ACTIONS = [('ligar', 'ON'), ('acender', 'ON'), ('desligar', 'OFF'), ('apagar', 'OFF')]
+TOPIC = 'hass/switch/{local}/{aparelho}/set'
+PAYLOAD = '{acao}'
+
+
+def rooms(count):
+    return ['comodo%d' % i for i in range(count)]
+
+
+def devices(count):
+    return ['aparelho%d' % i for i in range(count)]
+
+
+def grammar_text(room_names, device_names):
+    return '\n'.join([
+        '#JSGF V1.0 UTF-8 br;',
+        'grammar sintetica;',
+        'public <sintetica> = <comando>;',
+        '<local> = %s;' % ' | '.join(room_names),
+        '<aparelho> = %s;' % ' | '.join(device_names),
+        '<acao> = %s;' % ' | '.join('%s {%s}' % action for action in ACTIONS),
+        '<comando> = <acao> [o | a] <aparelho> [da | do] <local>;'
+    ])
+
+
+def sentences(room_names, device_names):
+    for verb, payload in ACTIONS:
+        for device in device_names:
+            for room in room_names:
+                yield '%s %s %s' % (verb, device, room), ('hass/switch/%s/%s/set' % (room, device), payload)
+
+
+def measure(build):
+    tracemalloc.start()
+    started = time.perf_counter()
+    built = build()
+    elapsed = time.perf_counter() - started
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return built, elapsed, size
+
+
+def build_table(room_names, device_names):
+    phrases, intents = zip(*sentences(room_names, device_names))
+    topics, payloads = zip(*intents)
+    return IntentTable(list(phrases), list(topics), list(payloads))
+
+
+def build_grammar(room_names, device_names):
+    grammar = jsgf.Grammar(grammar_text(room_names, device_names))
+    return IntentTable([], [], [], grammar, {'comando': (TOPIC, PAYLOAD)})
+
+
+def time_lookups(table, phrases):
+    started = time.perf_counter()
+    for phrase in phrases:
+        table.lookup(phrase)
+    return (time.perf_counter() - started) / len(phrases)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rooms', type=int, default=100)
+    parser.add_argument('--devices', type=int, default=50)
+    parser.add_argument('--lookups', type=int, default=2000)
+    args = parser.parse_args()
+
+    room_names, device_names = rooms(args.rooms), devices(args.devices)
+    expected = dict(sentences(room_names, device_names))
+    random.seed(0)
+    phrases = random.sample(sorted(expected), min(args.lookups, len(expected)))
+    print('%d rooms x %d devices x %d verbs = %d sentences' % (
+        args.rooms, args.devices, len(ACTIONS), len(expected)))
+
+    table, table_time, table_size = measure(lambda: build_table(room_names, device_names))
+    grammar, grammar_time, grammar_size = measure(lambda: build_grammar(room_names, device_names))
+    mismatches = [p for p in phrases if grammar.lookup(p) != expected[p] or table.lookup(p) != expected[p]]
+    # Optional words only exist in the grammar
+    extra = grammar.lookup('ligar o %s da %s' % (device_names[-1], room_names[-1]))
+
+    print('%-9s %10s %12s %14s' % ('', 'build ms', 'memory KiB', 'lookup us'))
+    for name, engine, elapsed, size in (('table', table, table_time, table_size),
+                                        ('grammar', grammar, grammar_time, grammar_size)):
+        print('%-9s %10.1f %12.1f %14.2f' % (
+            name, 1000 * elapsed, size / 1024.0, 1e6 * time_lookups(engine, phrases)))
+    print('mismatches: %d, grammar-only sentence: %s' % (len(mismatches), extra))
+
+    print('grammar memory as rooms grow (%d devices):' % args.devices)
+    for count in sorted(set([max(1, args.rooms // 10), max(1, args.rooms // 2), args.rooms])):
+        engine, _, size = measure(lambda: build_grammar(rooms(count), device_names))
+        engine.lookup('ligar %s %s' % (device_names[0], rooms(count)[-1]))
+        print('  %4d rooms: %8.1f KiB' % (count, size / 1024.0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Compara a latência entre o parse do intent_table e a chegada da mensagem no
+broker: conexão nova a cada chamada (caminho antigo) vs MqttPublisher.
+
+Uso (na venv do homeassistant, a partir da raiz do repositório):
+    python3 experimentos/benchmark_mqtt.py [-n 200]
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import paho.mqtt.client as mqtt  # noqa: E402
+
+from custom_components.intent_table import MqttPublisher  # noqa: E402
+from fake_broker import FakeBroker  # noqa: E402
+
+TOPIC = 'hass/switch/sala/luz1/set'
+SUCCESS_TOPIC = 'hass/successful_command'
+
+
+def legacy_parse(broker):
+    # Same sequence intent_table.parse used to run on the event loop
+    client = mqtt.Client()
+    client.connect(broker.host, broker.port, 60)
+    client.loop_start()
+    client.publish(TOPIC, 'ON')
+    client.publish(SUCCESS_TOPIC, 'success')
+    client.disconnect()
+    client.loop_stop()
+
+
+def pooled_parse(publisher):
+    publisher.publish(TOPIC, 'ON')
+    publisher.publish(SUCCESS_TOPIC, 'success')
+
+
+def measure(name, parse, broker, iterations):
+    blocked, delivered = [], []
+    for i in range(iterations):
+        start = time.monotonic()
+        parse()
+        blocked.append(time.monotonic() - start)
+        arrival = broker.wait_for(TOPIC, i + 1)[i]
+        delivered.append(arrival - start)
+    report(name, blocked, delivered)
+
+
+def report(name, blocked, delivered):
+    def ms(values, q):
+        values = sorted(values)
+        return 1000 * values[min(len(values) - 1, int(q * len(values)))]
+    print('%-16s loop blocked p50 %7.3f ms  p95 %7.3f ms | parse->broker p50 %7.3f ms  p95 %7.3f ms  mean %7.3f ms'
+          % (name, ms(blocked, 0.5), ms(blocked, 0.95),
+             ms(delivered, 0.5), ms(delivered, 0.95), 1000 * statistics.mean(delivered)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--iterations', type=int, default=200)
+    args = parser.parse_args()
+
+    broker = FakeBroker().start()
+    measure('connect-per-call', lambda: legacy_parse(broker), broker, args.iterations)
+    connections = broker.connections
+    broker.stop()
+
+    broker = FakeBroker().start()
+    publisher = MqttPublisher(broker.host, broker.port)
+    publisher.start()
+    while not publisher.connected:
+        time.sleep(0.01)
+    measure('pooled', lambda: pooled_parse(publisher), broker, args.iterations)
+    publisher.stop()
+    broker.stop()
+
+    print('connections opened: connect-per-call %d, pooled %d' % (connections, broker.connections))
+    print('publisher stats: %s' % publisher.stats)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+"""
+Compara o caminho de um comando de voz pela cadeia de automações do
+automations.yaml com o voice_assistant (máquina de estados com chamadas
+diretas), do hotword até a fala de retorno ("Seu desejo é uma ordem") ser
+pedida.
+
+Os componentes são os mesmos nos dois casos e não demoram nada (bipe com
+saída null sem tempo real, reconhecedor que devolve o texto na hora, fala
+que termina assim que é pedida), então a diferença medida é só o custo da
+cadeia: eventos no barramento, templates, chamadas de serviço (as síncronas
+passam por uma thread do executor, como no Home Assistant 0.8x) e a volta
+pelo broker em hass/successful_command -> input_boolean -> speech.speak.
+O intent_table é o de verdade (IntentTable e MqttPublisher) e o broker é o
+fake_broker.
+
+O Home Assistant não entra: a cadeia antiga é reproduzida por um barramento
+mínimo com o mesmo despacho (evento -> automação -> serviço -> evento). Os
+templates são renderizados com jinja2 quando ele está instalado; sem ele só
+são contados. O tempo real do Home Assistant por salto é maior, então a
+diferença medida aqui é um limite inferior.
+
+Uso:
+    python3 experimentos/benchmark_orchestrator.py [-n 100]
+"""
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import paho.mqtt.client as mqtt  # noqa: E402
+
+from custom_components import loop_bridge  # noqa: E402
+from custom_components.cue_player import Cue, CuePlayer, NullSink  # noqa: E402
+from custom_components.intent_table import (  # noqa: E402
+    DEFAULT_MQTT_COMMAND_NOT_FOUND_TOPIC, DEFAULT_MQTT_SUCCESS_TOPIC, IntentHandler, IntentTable, MqttPublisher)
+from custom_components.stt_speech_recognition import (  # noqa: E402
+    EVENT_LISTENING, EVENT_SPEECH_RECORDED, EVENT_SPEECH_TO_TEXT)
+from custom_components.voice_assistant import (  # noqa: E402
+    DEFAULT_CUE, DEFAULT_PROMPT, DEFAULT_SUCCESS, DEFAULT_UNKNOWN, VoiceAssistant, phrase)
+from fake_broker import FakeBroker  # noqa: E402
+
+try:
+    import jinja2
+except ImportError:
+    jinja2 = None
+
+PHRASES = ['ligar luz sala', 'desligar luz sala', 'ligar luz quarto', 'desligar luz quarto']
+TOPICS = ['hass/switch/sala/luz1/set', 'hass/switch/sala/luz1/set',
+          'hass/switch/quarto/luz1/set', 'hass/switch/quarto/luz1/set']
+PAYLOADS = ['ON', 'OFF', 'ON', 'OFF']
+SUCCESS = phrase(DEFAULT_SUCCESS)[0]
+EVENT_HOTWORD = 'hotword_detected'
+EVENT_STATE_CHANGED = 'state_changed'
+BOOLEAN = 'input_boolean.successful_command'
+TEMPLATE = '{{ trigger.event.data.correlation_id }}'
+TEXT_TEMPLATE = '{{ trigger.event.data.text }}'
+
+
+class Hub(object):
+    """Bus, states and services with the dispatch of Home Assistant 0.8x, counting every hop."""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.data = {}
+        self.bus = self
+        self.states = self
+        self.executor = concurrent.futures.ThreadPoolExecutor(4)
+        self.listeners = collections.defaultdict(list)
+        self.services = {}
+        self.values = {}
+        self.hops = collections.Counter()
+        self.templates = {}
+
+    # bus
+    def async_listen(self, event_type, callback):
+        self.listeners[event_type].append(callback)
+
+    def async_fire(self, event_type, data=None):
+        self.hops['events'] += 1
+        for callback in self.listeners[event_type]:
+            self.hops['automations'] += 1
+            self.loop.create_task(callback(data or {}))
+
+    # states
+    def async_set(self, entity_id, state, attributes=None):
+        old = self.values.get(entity_id)
+        self.values[entity_id] = state
+        self.async_fire(EVENT_STATE_CHANGED, {'entity_id': entity_id, 'old_state': old, 'new_state': state})
+
+    # services
+    def register(self, service, handler, blocking=False):
+        self.services[service] = (handler, blocking)
+
+    async def call(self, service, data):
+        """Service call as the automation script runs it: call_service event, then the handler."""
+        self.hops['service calls'] += 1
+        self.async_fire('call_service', {'service': service})
+        handler, blocking = self.services[service]
+        if blocking:
+            self.hops['executor'] += 1
+            await self.loop.run_in_executor(self.executor, handler, data)
+        else:
+            await handler(data)
+
+    def render(self, template, trigger):
+        self.hops['templates'] += 1
+        if jinja2 is None:
+            return trigger['event']['data'].get('text' if 'text' in template else 'correlation_id')
+        if template not in self.templates:
+            self.templates[template] = jinja2.Template(template)
+        return self.templates[template].render(trigger=trigger).strip()
+
+
+class Trigger(dict):
+    def __init__(self, data):
+        super().__init__(event={'data': data})
+        self.event = type('Event', (), {'data': data})
+
+
+class Detector(object):
+    def __init__(self):
+        self.listeners = []
+        self.armed = True
+        self.armed_at = None
+
+    def arm(self):
+        self.armed = True
+        self.armed_at = time.monotonic()
+
+
+class Speaker(object):
+    """Speaks nothing: done() runs from its own thread right away, as the speech worker would."""
+
+    def __init__(self):
+        self.requests = []
+
+    def speak(self, messages, rate, done=None, priority=None):
+        self.requests.append((time.monotonic(), list(messages)))
+        if done is not None:
+            threading.Thread(target=done, args=(False,), daemon=True).start()
+
+
+class Recognizer(object):
+    """Returns the next phrase at once, firing the events stt_speech_recognition fires."""
+
+    def __init__(self, bridge):
+        self.bridge = bridge
+        self.text = None
+
+    def __call__(self, correlation_id, on_recorded=None):
+        data = {'name': 'stt_pocketsphinx', 'correlation_id': correlation_id}
+        self.bridge.fire(EVENT_LISTENING, dict(data, state='listening'))
+        self.bridge.fire(EVENT_SPEECH_RECORDED, data)
+        if on_recorded is not None:
+            on_recorded()
+        self.bridge.fire(EVENT_SPEECH_TO_TEXT, dict(data, text=self.text))
+        return self.text
+
+
+def automations(hub, player, speaker, recognizer, handler, detector):
+    """The command chain of automations.yaml and the services it calls."""
+
+    async def cue(data):
+        played = asyncio.Event()
+        player.play(data['cue'], lambda: hub.loop.call_soon_threadsafe(played.set))
+        await played.wait()
+
+    async def speak(data):
+        spoken = asyncio.Event()
+        speaker.speak(data.get('message', SUCCESS), 100, lambda cancelled: hub.loop.call_soon_threadsafe(spoken.set))
+        await spoken.wait()
+
+    async def parse(data):
+        handler.handle(data['text'], data['correlation_id'])
+
+    async def arm(data):
+        detector.arm()
+
+    async def turn_on(data):
+        hub.async_set(BOOLEAN, 'on')
+
+    hub.register('cue_player.play', cue)
+    hub.register('stt_speech_recognition.listen', lambda data: recognizer(data['correlation_id']), blocking=True)
+    hub.register('speech.speak', speak)
+    hub.register('intent_table.parse', parse)
+    hub.register('hotword_snowboy.listen', arm)
+    hub.register('input_boolean.turn_on', turn_on)
+
+    def automation(event_type, actions):
+        async def run(data):
+            trigger = Trigger(data)
+            for service, static, templates in actions:
+                rendered = {key: hub.render(template, trigger) for key, template in templates.items()}
+                await hub.call(service, dict(static, **rendered))
+        hub.async_listen(event_type, run)
+
+    automation(EVENT_HOTWORD, [
+        ('cue_player.play', {'cue': DEFAULT_CUE}, {'correlation_id': TEMPLATE}),
+        ('stt_speech_recognition.listen', {}, {'correlation_id': TEMPLATE})])
+    automation(EVENT_LISTENING, [('speech.speak', {'message': 'Diga'}, {'correlation_id': TEMPLATE})])
+    automation(EVENT_SPEECH_RECORDED, [('cue_player.play', {'cue': DEFAULT_CUE}, {})])
+    automation(EVENT_SPEECH_TO_TEXT, [
+        ('intent_table.parse', {}, {'text': TEXT_TEMPLATE, 'correlation_id': TEMPLATE}),
+        ('hotword_snowboy.listen', {}, {})])
+
+    async def boolean_changed(data):
+        if data['entity_id'] == BOOLEAN and data['new_state'] == 'on':
+            await hub.call('speech.speak', {})
+            hub.values[BOOLEAN] = 'off'
+    hub.async_listen(EVENT_STATE_CHANGED, boolean_changed)
+
+    async def unknown(data):
+        await hub.call('speech.speak', {'message': 'Não Entendi.'})
+
+    # The mqtt component: messages reach the loop from the paho thread
+    def on_message(client, userdata, message):
+        hub.hops['mqtt round trips'] += 1
+        if message.topic == DEFAULT_MQTT_SUCCESS_TOPIC:
+            hub.loop.call_soon_threadsafe(
+                lambda: hub.loop.create_task(hub.call('input_boolean.turn_on', {})))
+        else:
+            hub.loop.call_soon_threadsafe(lambda: hub.loop.create_task(unknown({})))
+    return on_message
+
+
+def run_commands(loop, hub, detector, speaker, recognizer, start_command, count):
+    """Seconds from each hotword to the feedback being asked for, and to the detector re-armed."""
+    feedback, rearmed = [], []
+    for i in range(count):
+        recognizer.text = PHRASES[i % len(PHRASES)]
+        asked = len(speaker.requests)
+        detector.armed = False
+        started = time.monotonic()
+        loop.call_soon_threadsafe(start_command, 'cmd%04d' % i)
+        while not [r for r in speaker.requests[asked:] if r[1] == SUCCESS]:
+            time.sleep(0.0002)
+        feedback.append(next(t for t, m in speaker.requests[asked:] if m == SUCCESS) - started)
+        rearmed.append(detector.armed_at - started)
+        time.sleep(0.01)
+    return feedback, rearmed
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def report(name, values):
+    print('%-34s p50 %7.2f ms  p95 %7.2f ms  mean %7.2f ms' % (
+        name, 1000 * percentile(values, 0.5), 1000 * percentile(values, 0.95), 1000 * sum(values) / len(values)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=100)
+    args = parser.parse_args()
+    # The components log every command
+    logging.basicConfig(level=logging.ERROR)
+
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    broker = FakeBroker().start()
+    publisher = MqttPublisher(broker.host, broker.port)
+    publisher.start()
+    table = IntentTable(PHRASES, TOPICS, PAYLOADS)
+    cues = {DEFAULT_CUE: Cue(16000, 2, 1, b'\0' * 3200)}
+    results = {}
+
+    # Automation chain
+    hub = Hub(loop)
+    bridge = loop_bridge.get(hub)
+    detector, speaker, recognizer = Detector(), Speaker(), Recognizer(bridge)
+    player = CuePlayer(cues, NullSink(realtime=False))
+    player.start()
+    handler = IntentHandler(hub, table, publisher, None, DEFAULT_MQTT_SUCCESS_TOPIC,
+                            DEFAULT_MQTT_COMMAND_NOT_FOUND_TOPIC)
+    on_message = automations(hub, player, speaker, recognizer, handler, detector)
+    client = mqtt.Client()
+    client.on_message = on_message
+    client.connect(broker.host, broker.port, 60)
+    client.subscribe([(DEFAULT_MQTT_SUCCESS_TOPIC, 0), (DEFAULT_MQTT_COMMAND_NOT_FOUND_TOPIC, 0)])
+    client.loop_start()
+    time.sleep(0.2)
+
+    def hotword(correlation_id):
+        hub.async_fire(EVENT_HOTWORD, {'correlation_id': correlation_id})
+    results['automations'] = run_commands(loop, hub, detector, speaker, recognizer, hotword, args.n)
+    hops = dict(hub.hops)
+    client.loop_stop()
+    client.disconnect()
+    player.stop()
+
+    # State machine
+    hub = Hub(loop)
+    bridge = loop_bridge.get(hub)
+    detector, speaker, recognizer = Detector(), Speaker(), Recognizer(bridge)
+    player = CuePlayer(cues, NullSink(realtime=False))
+    player.start()
+    handler = IntentHandler(hub, table, publisher, None, DEFAULT_MQTT_SUCCESS_TOPIC,
+                            DEFAULT_MQTT_COMMAND_NOT_FOUND_TOPIC)
+    assistant = VoiceAssistant(
+        detector, player, speaker, recognizer, handler.handle,
+        tuple(phrase(p) for p in (DEFAULT_PROMPT, DEFAULT_SUCCESS, DEFAULT_UNKNOWN)), (DEFAULT_CUE, DEFAULT_CUE),
+        fire=bridge.fire)
+    assistant.start()
+    detector.listeners.append(assistant.detected)
+
+    def hotword(correlation_id):
+        # hotword_snowboy fires the event for observers and calls its listeners
+        bridge.fire(EVENT_HOTWORD, {'correlation_id': correlation_id})
+        for listener in detector.listeners:
+            listener(correlation_id)
+    results['voice_assistant'] = run_commands(
+        loop, hub, detector, speaker, recognizer, lambda c: threading.Thread(target=hotword, args=(c,)).start(),
+        args.n)
+    assistant.stop()
+    player.stop()
+    publisher.stop()
+    broker.stop()
+
+    print('%d commands, templates %s' % (args.n, 'rendered with jinja2' if jinja2 else 'counted only (no jinja2)'))
+    print('hops per command on the automation chain: %s' % ', '.join(
+        '%s %.0f' % (name, value / float(args.n)) for name, value in sorted(hops.items())))
+    print('hops per command on voice_assistant: events %.0f (observers only), service calls 0, '
+          'templates 0, mqtt round trips 0' % (hub.hops['events'] / float(args.n)))
+    for name, (feedback, rearmed) in results.items():
+        report('%s: hotword -> feedback' % name, feedback)
+        report('%s: hotword -> re-armed' % name, rearmed)
+    saved = [a - b for a, b in zip(sorted(results['automations'][0]), sorted(results['voice_assistant'][0]))]
+    report('removed per command (feedback)', saved)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,538 @@
+#!/usr/bin/env python3
+"""
+Mede o pipeline de voz sem ninguém falando no microfone: reproduz corpora de
+WAVs rotulados pelo mesmo código dos componentes, com o audio_capture lendo
+de um WaveFileSource no lugar do PyAudio (não precisa de placa de som).
+
+Estágios:
+    hotword   ResidentDetector do hotword_snowboy
+    keywords  spot_command do stt_snowboy (snowboy multi-modelo + IntentMatcher)
+    sphinx    SphinxDecoder do stt_speech_recognition (decoder quente + gramática)
+    intent    IntentTable do intent_table, aplicada às saídas dos estágios de STT
+
+Para cada estágio: fator de tempo real (RTF, tempo de processamento / duração
+do áudio), latência por arquivo, tempo de CPU e acurácia contra os rótulos.
+Os estágios de snowboy usam o VoiceGate (webrtcvad) como configurado no
+audio_capture; --vad on/off força ligado ou desligado, e vad_passed é a
+fração dos blocos que chegou aos modelos. Para medir a CPU economizada e a
+mudança de acurácia, rode com --vad off --json sem.json e depois com
+--vad on --baseline sem.json.
+O áudio é entregue sem pausas e na mesma ordem, então execuções repetidas
+medem a mesma coisa; --json salva o resultado e --baseline compara com um
+resultado anterior, saindo com erro se houver regressão.
+
+Cada corpus é um diretório com WAVs (16 kHz, 16 bit, mono) e um labels.tsv:
+    arquivo.wav<TAB>texto esperado<TAB>hotword (1 ou 0, padrão 0)
+Texto vazio significa que nenhum comando deve ser reconhecido.
+
+Uso (na venv do homeassistant, a partir da raiz do repositório):
+    python3 experimentos/benchmark_replay.py corpus/ [outro_corpus/ ...] \\
+        [--stages hotword,keywords,sphinx,intent] [--repeat 3] [--vad config|on|off] \\
+        [--json resultado.json] [--baseline anterior.json]
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import wave
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import yaml  # noqa: E402
+
+from custom_components.audio_capture import AudioCapture, WaveFileSource  # noqa: E402
+
+STAGES = ['hotword', 'keywords', 'sphinx', 'intent']
+UNKNOWN = 'unknown_command'
+DEPLOY_ROOT = '/opt/cefetmg'
+
+# Regressions beyond these fail the --baseline comparison
+ACCURACY_TOLERANCE = 0.0
+RTF_TOLERANCE = 0.10
+
+
+# -----------------------------------------------------------------------------
+# CORPUS E CONFIGURAÇÃO
+
+class Sample(object):
+
+    def __init__(self, path, text, hotword):
+        self.path = path
+        self.text = text or UNKNOWN
+        self.hotword = hotword
+        with wave.open(path, 'rb') as wav:
+            self.duration = wav.getnframes() / float(wav.getframerate())
+
+
+def load_corpus(directory):
+    samples = []
+    with open(os.path.join(directory, 'labels.tsv'), encoding='utf-8') as labels:
+        for line in labels:
+            if not line.strip() or line.startswith('#'):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            text = fields[1].strip() if len(fields) > 1 else ''
+            hotword = len(fields) > 2 and fields[2].strip() == '1'
+            samples.append(Sample(os.path.join(directory, fields[0]), text, hotword))
+    return sorted(samples, key=lambda s: s.path)
+
+
+def corpus_digest(samples):
+    digest = hashlib.sha1()
+    for sample in samples:
+        digest.update(('%s\t%s\t%d\t' % (os.path.basename(sample.path), sample.text, sample.hotword)).encode())
+        with open(sample.path, 'rb') as wav:
+            digest.update(wav.read())
+    return digest.hexdigest()[:12]
+
+
+class ConfigLoader(yaml.SafeLoader):
+    """Ignores !include, !secret and friends: only the voice sections matter."""
+
+
+ConfigLoader.add_multi_constructor('!', lambda loader, suffix, node: None)
+
+
+def load_config(path):
+    with open(path, encoding='utf-8') as config_file:
+        return yaml.load(config_file, Loader=ConfigLoader)
+
+
+def local_path(path, root):
+    """Paths in configuration.yaml point at the deployed copy in /opt/cefetmg."""
+    if not os.path.exists(path) and path.startswith(DEPLOY_ROOT):
+        return os.path.join(root, path[len(DEPLOY_ROOT):].lstrip('/'))
+    return path
+
+
+def sample_name(path):
+    return os.path.join(os.path.basename(os.path.dirname(os.path.abspath(path))), os.path.basename(path))
+
+
+def vad_settings(config, mode):
+    """VoiceGate arguments from the audio_capture section, or None when off."""
+    from custom_components import audio_capture
+
+    conf = config.get(audio_capture.DOMAIN) or {}
+    if mode == 'off' or (mode == 'config' and not conf.get(audio_capture.CONF_VAD, audio_capture.DEFAULT_VAD)):
+        return None
+    return {
+        'aggressiveness': conf.get(audio_capture.CONF_VAD_AGGRESSIVENESS, audio_capture.DEFAULT_VAD_AGGRESSIVENESS),
+        'hangover': conf.get(audio_capture.CONF_VAD_HANGOVER, audio_capture.DEFAULT_VAD_HANGOVER),
+        'pre_roll': conf.get(audio_capture.CONF_VAD_PRE_ROLL, audio_capture.DEFAULT_VAD_PRE_ROLL)
+    }
+
+
+def open_capture(sample, vad=None):
+    """Capture over the whole file, delivered as fast as it is consumed."""
+    capture = AudioCapture(WaveFileSource(sample.path, realtime=False),
+                           buffer_seconds=sample.duration + 1.0, vad=vad)
+    capture.start()
+    # Buffer holds the whole file, so this reader starts at its first byte
+    return capture, capture.reader(since=0)
+
+
+# -----------------------------------------------------------------------------
+# MEDIÇÃO
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else None
+
+
+def word_errors(expected, recognized):
+    expected, recognized = expected.split(), recognized.split()
+    row = list(range(len(recognized) + 1))
+    for i, word in enumerate(expected, 1):
+        previous, row[0] = row[0], i
+        for j, other in enumerate(recognized, 1):
+            previous, row[j] = row[j], min(row[j] + 1, row[j - 1] + 1, previous + (word != other))
+    return row[-1]
+
+
+class StageResult(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.audio = 0.0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.latencies = []
+        self.correct = 0
+        self.total = 0
+        self.word_errors = 0
+        self.words = 0
+        self.outputs = {}
+        self.extra = {}
+
+    def add(self, sample, latency, correct, output=None):
+        self.audio += sample.duration
+        self.latencies.append(latency)
+        self.total += 1
+        self.correct += bool(correct)
+        if output is not None:
+            self.outputs[sample.path] = output
+
+    def summary(self):
+        summary = {
+            'files': self.total,
+            'audio_seconds': round(self.audio, 3),
+            'wall_seconds': round(self.wall, 4),
+            'cpu_seconds': round(self.cpu, 4),
+            'rtf': round(self.wall / self.audio, 5) if self.audio else None,
+            'cpu_rtf': round(self.cpu / self.audio, 5) if self.audio else None,
+            'latency_ms': {
+                'p50': round(1000 * percentile(self.latencies, 0.5), 4) if self.latencies else None,
+                'p95': round(1000 * percentile(self.latencies, 0.95), 4) if self.latencies else None,
+                'max': round(1000 * max(self.latencies), 4) if self.latencies else None
+            },
+            'accuracy': round(self.correct / float(self.total), 4) if self.total else None
+        }
+        if self.words:
+            summary['wer'] = round(self.word_errors / float(self.words), 4)
+        summary.update(self.extra)
+        return summary
+
+
+class Timed(object):
+    """Adds wall and process CPU time of a block to a StageResult."""
+
+    def __init__(self, result):
+        self.result = result
+
+    def __enter__(self):
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.result.wall += time.perf_counter() - self._wall
+        self.result.cpu += time.process_time() - self._cpu
+
+
+# -----------------------------------------------------------------------------
+# ESTÁGIOS
+
+def gate_summary(chunks, passed):
+    return round(passed / float(chunks), 4) if chunks else None
+
+
+def run_hotword(samples, config, root, vad):
+    from custom_components import audio_capture, hotword_snowboy
+
+    conf = config[hotword_snowboy.DOMAIN]
+    model = local_path(conf[hotword_snowboy.CONF_MODEL], root)
+    sensitivity = conf.get(hotword_snowboy.CONF_SENSITIVITY, hotword_snowboy.DEFAULT_SENSITIVITY)
+    audio_gain = conf.get(hotword_snowboy.CONF_AUDIO_GAIN, hotword_snowboy.DEFAULT_AUDIO_GAIN)
+
+    result = StageResult('hotword')
+    false_alarms = misses = 0
+    load_times = []
+    chunks = passed = 0
+    for sample in samples:
+        capture, reader = open_capture(sample, vad)
+        detections = []
+        detector = hotword_snowboy.ResidentDetector(
+            capture, model, sensitivity, audio_gain, lambda: detections.append(
+                capture.pop_mark(audio_capture.MARK_HOTWORD)), auto_rearm=True)
+        detector.arm()
+        with Timed(result):
+            started = time.perf_counter()
+            detector.start(reader)
+            detector.join()
+            latency = time.perf_counter() - started - detector.load_time
+        # The model is loaded once per HA run, not per command (its CPU time
+        # is taken as its wall time, loading is single threaded)
+        result.wall -= detector.load_time
+        result.cpu -= detector.load_time
+        load_times.append(detector.load_time)
+        chunks += detector.gate.chunks
+        passed += detector.gate.passed
+        detector.stop()
+        capture.stop()
+
+        detected = bool(detections)
+        false_alarms += detected and not sample.hotword
+        misses += sample.hotword and not detected
+        result.add(sample, latency, detected == sample.hotword,
+                   [round(capture.bytes_to_seconds(p), 3) for p in detections])
+    result.extra.update({
+        'false_alarms': false_alarms,
+        'misses': misses,
+        'model_load_ms': round(1000 * statistics.median(load_times), 1) if load_times else None,
+        'vad_passed': gate_summary(chunks, passed)
+    })
+    return result
+
+
+def run_keywords(samples, config, root, vad):
+    from custom_components import stt_snowboy
+
+    conf = config[stt_snowboy.DOMAIN]
+    models = [local_path(m, root) for m in conf[stt_snowboy.CONF_MODELS]]
+    keywords = list(conf[stt_snowboy.CONF_KEYWORDS])
+    matcher = stt_snowboy.IntentMatcher(list(conf[stt_snowboy.CONF_INTENT_TEXTS]))
+    timeout = conf.get(stt_snowboy.CONF_TIMEOUT, stt_snowboy.DEFAULT_TIMEOUT)
+    early_stop = conf.get(stt_snowboy.CONF_EARLY_STOP, stt_snowboy.DEFAULT_EARLY_STOP)
+    detector = stt_snowboy.build_detector(
+        models, conf.get(stt_snowboy.CONF_SENSITIVITY, stt_snowboy.DEFAULT_SENSITIVITY),
+        conf.get(stt_snowboy.CONF_AUDIO_GAIN, stt_snowboy.DEFAULT_AUDIO_GAIN))
+
+    result = StageResult('keywords')
+    decided_at = []
+    chunks = passed = 0
+    for sample in samples:
+        capture, reader = open_capture(sample, vad)
+        gate = capture.voice_gate()
+        with Timed(result):
+            started = time.perf_counter()
+            # Unpaced audio ends long before the wall clock deadline
+            text = stt_snowboy.spot_command(detector, capture, reader, keywords, matcher,
+                                            capture.session(timeout), early_stop, gate)
+            latency = time.perf_counter() - started
+        capture.stop()
+        chunks += gate.chunks
+        passed += gate.passed
+        text = text or UNKNOWN
+        decided_at.append(capture.bytes_to_seconds(reader.position))
+        result.add(sample, latency, text == sample.text, text)
+    result.extra['decided_after_audio_s'] = round(statistics.median(decided_at), 3) if decided_at else None
+    result.extra['vad_passed'] = gate_summary(chunks, passed)
+    return result
+
+
+def run_sphinx(samples, config, root, language_dir):
+    from custom_components import stt_speech_recognition as stt
+
+    conf = config.get(stt.DOMAIN) or {}
+    grammar = local_path(conf.get(stt.CONF_GRAMMAR, stt.DEFAULT_GRAMMAR), root)
+    if language_dir is None:
+        import speech_recognition as sr
+        language_dir = os.path.join(os.path.dirname(sr.__file__), 'pocketsphinx-data',
+                                    conf.get(stt.CONF_LANGUAGE, stt.DEFAULT_LANGUAGE))
+    decoder = stt.SphinxDecoder(os.path.join(language_dir, 'acoustic-model'),
+                                os.path.join(language_dir, 'language-model.lm.bin'),
+                                os.path.join(language_dir, 'pronounciation-dictionary.dict'),
+                                grammar).load()
+
+    result = StageResult('sphinx')
+    for sample in samples:
+        capture, reader = open_capture(sample)
+        chunks = []
+        while True:
+            data = reader.read(capture.chunk_bytes, timeout=1.0)
+            if data is None:
+                break
+            chunks.append(bytes(data))
+        capture.stop()
+        with Timed(result):
+            # Decode latency is what the user waits for after speaking
+            started = time.perf_counter()
+            text = decoder.decode(b''.join(chunks)) or UNKNOWN
+            latency = time.perf_counter() - started
+        result.add(sample, latency, text == sample.text, text)
+        if sample.text != UNKNOWN:
+            result.words += len(sample.text.split())
+            result.word_errors += word_errors(sample.text, '' if text == UNKNOWN else text)
+    result.extra['decoder_load_ms'] = round(1000 * decoder.load_time, 1)
+    return result
+
+
+def run_intent(samples, config, root, stt_results, iterations=1000):
+    from custom_components import intent_table, jsgf
+
+    conf = config[intent_table.DOMAIN]
+    grammar = conf.get(intent_table.CONFIG_GRAMMAR)
+    intents = conf.get(intent_table.CONFIG_INTENTS) or {}
+    table = intent_table.IntentTable(
+        list(conf.get(intent_table.CONFIG_PHRASE_LIST, [])),
+        list(conf.get(intent_table.CONFIG_TOPIC_LIST, [])),
+        list(conf.get(intent_table.CONFIG_PAYLOAD_LIST, [])),
+        jsgf.Grammar.load(local_path(grammar, root)) if grammar else None,
+        {rule: (i[intent_table.CONFIG_TOPIC], i[intent_table.CONFIG_PAYLOAD]) for rule, i in intents.items()})
+    result = StageResult('intent')
+    for sample in samples:
+        with Timed(result):
+            started = time.perf_counter()
+            for _ in range(iterations):
+                intent = table.lookup(sample.text)
+            latency = (time.perf_counter() - started) / iterations
+        # The label itself must map to a command unless it is unknown
+        result.add(sample, latency, (intent is None) == (sample.text == UNKNOWN))
+    # Lookups take no audio time: report RTF of the whole loop as not meaningful
+    result.audio = 0.0
+
+    # End to end: does the recognized text trigger the same command as the label?
+    for stt_result in stt_results:
+        correct = sum(table.lookup(output) == table.lookup(sample.text)
+                      for sample in samples for output in [stt_result.outputs.get(sample.path)]
+                      if output is not None)
+        result.extra['end_to_end_accuracy_%s' % stt_result.name] = round(
+            correct / float(len(stt_result.outputs)), 4) if stt_result.outputs else None
+    return result
+
+
+# -----------------------------------------------------------------------------
+# RELATÓRIO
+
+def environment():
+    try:
+        commit = subprocess.check_output(['git', '-C', ROOT, 'rev-parse', '--short', 'HEAD'],
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'processor': platform.processor() or None,
+        'cpus': os.cpu_count()
+    }
+
+
+def show(value, fmt):
+    return fmt % value if value is not None else '-'
+
+
+def print_report(stages):
+    print('%-9s %5s %8s %9s %9s %10s %10s %9s' % (
+        'stage', 'files', 'audio s', 'RTF', 'CPU RTF', 'p50 ms', 'p95 ms', 'accuracy'))
+    for name, summary in stages.items():
+        accuracy = summary['accuracy']
+        print('%-9s %5d %8.1f %9s %9s %10s %10s %9s' % (
+            name, summary['files'], summary['audio_seconds'],
+            show(summary['rtf'], '%.4f'), show(summary['cpu_rtf'], '%.4f'),
+            show(summary['latency_ms']['p50'], '%.4f'), show(summary['latency_ms']['p95'], '%.4f'),
+            show(None if accuracy is None else 100 * accuracy, '%.1f%%')))
+        extra = {k: v for k, v in summary.items() if k not in (
+            'files', 'audio_seconds', 'wall_seconds', 'cpu_seconds', 'rtf', 'cpu_rtf', 'latency_ms', 'accuracy')}
+        if extra:
+            print('          %s' % ', '.join('%s=%s' % item for item in sorted(extra.items())))
+
+
+def compare(stages, baseline):
+    """Returns the regressions against a previous run."""
+    regressions = []
+    for name, summary in stages.items():
+        previous = baseline.get('stages', {}).get(name)
+        if previous is None:
+            continue
+        if summary['accuracy'] is not None and previous['accuracy'] is not None \
+                and summary['accuracy'] < previous['accuracy'] - ACCURACY_TOLERANCE:
+            regressions.append('%s accuracy %.4f -> %.4f' % (name, previous['accuracy'], summary['accuracy']))
+        if summary['rtf'] and previous['rtf'] and summary['rtf'] > previous['rtf'] * (1 + RTF_TOLERANCE):
+            regressions.append('%s RTF %.5f -> %.5f' % (name, previous['rtf'], summary['rtf']))
+    return regressions
+
+
+def changes(stages, baseline):
+    """CPU and accuracy of each stage against a previous run, e.g. without the VAD."""
+    lines = []
+    for name, summary in stages.items():
+        previous = baseline.get('stages', {}).get(name)
+        if previous is None:
+            continue
+        if summary['cpu_rtf'] and previous['cpu_rtf']:
+            lines.append('%s CPU RTF %.5f -> %.5f (%+.1f%%)' % (
+                name, previous['cpu_rtf'], summary['cpu_rtf'],
+                100 * (summary['cpu_rtf'] / previous['cpu_rtf'] - 1)))
+        if summary['accuracy'] is not None and previous['accuracy'] is not None:
+            lines.append('%s accuracy %.4f -> %.4f' % (name, previous['accuracy'], summary['accuracy']))
+    return lines
+
+
+def best_of(runs):
+    """Keeps the fastest repetition of each stage; accuracy must not vary."""
+    stages = {}
+    for name in runs[0]:
+        summaries = [run[name] for run in runs]
+        best = min(summaries, key=lambda s: s['wall_seconds'])
+        best = dict(best)
+        if len(summaries) > 1 and best['rtf'] is not None:
+            best['rtf_runs'] = [s['rtf'] for s in summaries]
+        if len(set(s['accuracy'] for s in summaries)) > 1:
+            best['accuracy_runs'] = [s['accuracy'] for s in summaries]
+        stages[name] = best
+    return stages
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('corpora', nargs='+', help='diretórios com WAVs e labels.tsv')
+    parser.add_argument('--config', default=os.path.join(ROOT, 'configuration.yaml'))
+    parser.add_argument('--root', default=ROOT, help='onde procurar o que a configuração aponta em %s' % DEPLOY_ROOT)
+    parser.add_argument('--language-dir', help='modelo do pocketsphinx (padrão: o do speech_recognition)')
+    parser.add_argument('--stages', default=','.join(STAGES))
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--vad', choices=['config', 'on', 'off'], default='config',
+                        help='VoiceGate nos estágios de snowboy (padrão: como no audio_capture)')
+    parser.add_argument('--json', help='salva o resultado neste arquivo')
+    parser.add_argument('--baseline', help='resultado anterior para comparar')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR)
+    config = load_config(args.config)
+    samples = [s for corpus in args.corpora for s in load_corpus(corpus)]
+    stages = [s.strip() for s in args.stages.split(',') if s.strip()]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error('unknown stages: %s' % ', '.join(sorted(unknown)))
+    vad = vad_settings(config, args.vad)
+    print('%d files, %.1f s of audio, corpus %s, vad %s' % (
+        len(samples), sum(s.duration for s in samples), corpus_digest(samples), vad))
+
+    runs = []
+    outputs = {}
+    for _ in range(args.repeat):
+        results = []
+        if 'hotword' in stages:
+            results.append(run_hotword(samples, config, args.root, vad))
+        # Files with only the hotword in them say nothing about the STT stages
+        command_samples = [s for s in samples if s.text != UNKNOWN or not s.hotword]
+        if 'keywords' in stages:
+            results.append(run_keywords(command_samples, config, args.root, vad))
+        if 'sphinx' in stages:
+            results.append(run_sphinx(command_samples, config, args.root, args.language_dir))
+        if 'intent' in stages:
+            stt = [r for r in results if r.name in ('keywords', 'sphinx')]
+            results.append(run_intent(command_samples, config, args.root, stt))
+        runs.append({r.name: r.summary() for r in results})
+        outputs = {r.name: {sample_name(k): v for k, v in r.outputs.items()} for r in results if r.outputs}
+
+    report = {
+        'environment': environment(),
+        'corpus': {'files': len(samples), 'digest': corpus_digest(samples),
+                   'audio_seconds': round(sum(s.duration for s in samples), 3)},
+        'repeat': args.repeat,
+        'vad': vad,
+        'stages': best_of(runs),
+        'outputs': outputs
+    }
+    print_report(report['stages'])
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as result_file:
+            json.dump(report, result_file, indent=2, ensure_ascii=False, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as baseline_file:
+            baseline = json.load(baseline_file)
+        for line in changes(report['stages'], baseline):
+            print('vs baseline: %s' % line)
+        regressions = compare(report['stages'], baseline)
+        for regression in regressions:
+            print('REGRESSION: %s' % regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
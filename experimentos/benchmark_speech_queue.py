@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Mede a fila de fala do componente speech com o pyttsx3 de verdade, mas sem
+caixa de som: o reprodutor de teste só espera a duração do áudio,
+em blocos de PLAYBACK_CHUNK, como o PcmPlayer.
+
+    prompt     "Diga" chega 0,5 s depois de uma frase longa de estado:
+               quanto espera para começar a tocar com as duas na mesma
+               prioridade (fila simples) e com "Diga" em high
+    rajada     a mesma frase pedida N vezes ao mesmo tempo (várias
+               automações): quantas vezes é falada
+    barge-in   cancel() no meio de uma frase: quanto demora para o áudio
+               parar
+
+Uso:
+    python3 experimentos/benchmark_speech_queue.py [--burst 5]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from custom_components.speech import (  # noqa: E402
+    PLAYBACK_CHUNK, PRIORITY_HIGH, PRIORITY_NORMAL, PhraseCache, SpeechWorker)
+
+VOICE = 'brazil'
+STATUS = ['A luz da sala está ligada,', 'a luz do quarto está desligada,', 'e a porta da sala está fechada']
+PROMPT = ['Diga']
+
+
+class TimedPlayer(object):
+    """Plays nothing: takes as long as the audio, and records when each fragment starts and stops."""
+
+    def __init__(self):
+        self.plays = []
+        self.stopped = None
+
+    def play(self, rendered, interrupted=lambda: False):
+        self.plays.append((time.monotonic(), len(rendered.frames)))
+        chunk = rendered.sample_width * rendered.channels * int(rendered.sample_rate * PLAYBACK_CHUNK)
+        for start in range(0, len(rendered.frames), chunk):
+            if interrupted():
+                self.stopped = time.monotonic()
+                return False
+            time.sleep(PLAYBACK_CHUNK * min(1.0, (len(rendered.frames) - start) / float(chunk)))
+        return True
+
+    def close(self):
+        pass
+
+
+def start_worker(cache_dir):
+    player = TimedPlayer()
+    worker = SpeechWorker(VOICE, PhraseCache(cache_dir, 2 ** 30, 2 ** 30), player)
+    worker.start()
+    return worker, player
+
+
+def prompt_wait(cache_dir, priority, prompt_size):
+    worker, player = start_worker(cache_dir)
+    spoken = threading.Event()
+    worker.speak(STATUS, 160)
+    time.sleep(0.5)
+    asked = time.monotonic()
+    worker.speak(PROMPT, 100, lambda cancelled: spoken.set(), priority)
+    spoken.wait(60)
+    worker.stop()
+    started = min(t for t, size in player.plays if t >= asked and size == prompt_size)
+    return started - asked, worker.stats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--burst', type=int, default=5)
+    args = parser.parse_args()
+    try:
+        import pyttsx3  # noqa: F401
+    except ImportError:
+        print('pyttsx3 is not installed, skipped')
+        return
+    cache_dir = tempfile.mkdtemp(prefix='speech_queue_')
+
+    # Render everything once, so only scheduling is measured
+    worker, _ = start_worker(cache_dir)
+    done = threading.Event()
+    outcome = []
+    worker.speak(STATUS, 160)
+    worker.speak(PROMPT, 100, lambda cancelled: (outcome.append(cancelled), done.set()))
+    done.wait(60)
+    rendered = worker.cache.get(PhraseCache.key(PROMPT[0], VOICE, 100))
+    worker.stop()
+    if outcome != [False] or rendered is None:
+        sys.exit('the speech engine did not render "%s" (see the log above)' % PROMPT[0])
+    prompt_size = len(rendered.frames)
+
+    for name, priority in (('fifo', PRIORITY_NORMAL), ('priority', PRIORITY_HIGH)):
+        wait, stats = prompt_wait(cache_dir, priority, prompt_size)
+        print('%-9s "Diga" waited %6.0f ms to start (preempted %d)' % (name, 1000 * wait, stats['preempted']))
+
+    worker, _ = start_worker(cache_dir)
+    finished = []
+    for _ in range(args.burst):
+        worker.speak(PROMPT, 100, lambda cancelled: finished.append(time.monotonic()))
+    while len(finished) < args.burst:
+        time.sleep(0.01)
+    print('burst     %d calls, spoken %d time(s), coalesced %d' % (
+        args.burst, worker.stats['spoken'], worker.stats['coalesced']))
+    worker.stop()
+
+    worker, player = start_worker(cache_dir)
+    worker.speak(STATUS, 160)
+    time.sleep(0.5)
+    cancelled = time.monotonic()
+    worker.cancel()
+    while player.stopped is None:
+        time.sleep(0.001)
+    print('barge-in  audio stopped %.0f ms after cancel()' % (1000 * (player.stopped - cancelled)))
+    worker.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Compara a decodificação do pocketsphinx no processo do Home Assistant (um
+SphinxDecoder quente atrás de um lock, como o stt_speech_recognition faz sem
+decoder_processes) com o DecoderPool (processos com decoder próprio e áudio
+em memória compartilhada), com 1, 2 e 4 comandos decodificados ao mesmo
+tempo.
+
+Para cada caso: vazão (comandos/s), latência por comando (espera + decodificação)
+e o atraso de uma thread que acorda a cada 10 ms no processo principal, que
+mostra quanto a decodificação disputa o GIL com o resto do Home Assistant.
+
+Uso (na venv do homeassistant, a partir da raiz do repositório):
+    python3 experimentos/benchmark_sphinx_pool.py a.wav b.wav ... \\
+        [--grammar data/pocketsphinx/gramatica.jsgf] [--language-dir DIR] \\
+        [--processes 2] [--concurrency 1,2,4] [--requests 24]
+"""
+import argparse
+import concurrent.futures
+import os
+import sys
+import threading
+import time
+import wave
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from custom_components import stt_speech_recognition as stt  # noqa: E402
+
+TICK = 0.01
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def load_audio(paths):
+    audio = []
+    for path in paths:
+        with wave.open(path, 'rb') as wav:
+            assert (wav.getframerate(), wav.getsampwidth(), wav.getnchannels()) == (16000, 2, 1), \
+                '%s is not 16 kHz, 16 bit mono' % path
+            audio.append(wav.readframes(wav.getnframes()))
+    return audio
+
+
+class Ticker(object):
+    """Thread in the main process measuring how late its 10 ms wakeups are."""
+
+    def __init__(self):
+        self.lags = []
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._done.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._done.is_set():
+            expected = time.perf_counter() + TICK
+            time.sleep(TICK)
+            self.lags.append(max(0.0, time.perf_counter() - expected))
+
+
+def run(decode, audio, concurrency, requests):
+    latencies = []
+
+    def one(index):
+        started = time.perf_counter()
+        decode(audio[index % len(audio)])
+        latencies.append(time.perf_counter() - started)
+
+    with Ticker() as ticker, concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        started = time.perf_counter()
+        list(executor.map(one, range(requests)))
+        elapsed = time.perf_counter() - started
+    return requests / elapsed, latencies, ticker.lags
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('wavs', nargs='+')
+    parser.add_argument('--grammar', default=os.path.join(ROOT, 'data', 'pocketsphinx', 'gramatica.jsgf'))
+    parser.add_argument('--language-dir', help='modelo do pocketsphinx (padrão: pt-br-picado do speech_recognition)')
+    parser.add_argument('--processes', type=int, default=2)
+    parser.add_argument('--concurrency', default='1,2,4')
+    parser.add_argument('--requests', type=int, default=24)
+    args = parser.parse_args()
+
+    language_dir = args.language_dir
+    if language_dir is None:
+        import speech_recognition as sr
+        language_dir = os.path.join(os.path.dirname(sr.__file__), 'pocketsphinx-data', stt.DEFAULT_LANGUAGE)
+    decoder_args = (os.path.join(language_dir, 'acoustic-model'),
+                    os.path.join(language_dir, 'language-model.lm.bin'),
+                    os.path.join(language_dir, 'pronounciation-dictionary.dict'),
+                    args.grammar)
+    audio = load_audio(args.wavs)
+    seconds = sum(len(a) for a in audio) / float(stt.DECODER_BYTES_PER_SECOND) / len(audio)
+    print('%d files, %.1f s of audio on average, %d cpus' % (len(audio), seconds, os.cpu_count()))
+
+    decoder = stt.SphinxDecoder(*decoder_args).load()
+    pool = stt.DecoderPool(decoder_args, args.processes).start()
+    paths = [('in-thread', decoder.decode), ('pool x%d' % args.processes, pool.decode)]
+
+    print('%-12s %5s %10s %10s %10s %14s' % ('path', 'conc', 'cmds/s', 'p50 ms', 'p95 ms', 'tick p99 ms'))
+    for concurrency in [int(c) for c in args.concurrency.split(',')]:
+        for name, decode in paths:
+            throughput, latencies, lags = run(decode, audio, concurrency, args.requests)
+            print('%-12s %5d %10.2f %10.1f %10.1f %14.1f' % (
+                name, concurrency, throughput, 1000 * percentile(latencies, 0.5),
+                1000 * percentile(latencies, 0.95), 1000 * percentile(lags, 0.99)))
+    pool.stop()
+    print('decoder process restarts: %d' % pool.restarts)
+
+
+if __name__ == '__main__':
+    main()
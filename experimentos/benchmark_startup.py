@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Mede quanto custa importar cada módulo dos componentes de voz e as
+bibliotecas pesadas que eles usam, cada um num processo Python novo (sem
+nada em cache além do que o próprio Python importa ao iniciar).
+
+Os componentes não importam mais speech_recognition, paho nem pyttsx3 no
+topo do módulo: elas são importadas no aquecimento depois do
+homeassistant_start (ou no primeiro uso). A coluna "biblioteca" mostra o que
+deixou de pesar no carregamento dos componentes.
+
+Bibliotecas não instaladas aparecem como ausentes.
+
+Uso:
+    python3 experimentos/benchmark_startup.py [-n 5]
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+COMPONENTS = [
+    'custom_components.audio_capture',
+    'custom_components.cue_player',
+    'custom_components.hotword_snowboy',
+    'custom_components.stt_speech_recognition',
+    'custom_components.stt_snowboy',
+    'custom_components.intent_table',
+    'custom_components.speech',
+    'custom_components.voice_assistant'
+]
+LIBRARIES = [
+    'speech_recognition',
+    'paho.mqtt.client',
+    'pyttsx3',
+    'pocketsphinx',
+    'webrtcvad'
+]
+
+# Prints the import time of the module, in ms
+PROBE = 'import time; started = time.perf_counter(); import %s; print(1000 * (time.perf_counter() - started))'
+
+
+def import_ms(module, count):
+    """Best of count imports of module, each in a new process. None if it does not import."""
+    best = None
+    for _ in range(count):
+        result = subprocess.run([sys.executable, '-c', PROBE % module], cwd=ROOT,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+        if result.returncode != 0:
+            return None
+        elapsed = float(result.stdout.strip())
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def report(kind, module, elapsed):
+    if elapsed is None:
+        print('%-11s %-42s ausente' % (kind, module))
+    else:
+        print('%-11s %-42s %7.1f ms' % (kind, module, elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=5)
+    args = parser.parse_args()
+
+    for module in LIBRARIES:
+        report('biblioteca', module, import_ms(module, args.n))
+    for module in COMPONENTS:
+        report('componente', module, import_ms(module, args.n))
+
+
+if __name__ == '__main__':
+    main()
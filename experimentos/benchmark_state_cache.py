@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Mede quanto o cache de estados do intent_table encurta uma consulta como
+"luz sala ligada": do parse até a resposta chegar em hass/ask_state, que é o
+que dispara a automação que fala o estado (dali em diante o caminho é o
+mesmo nos dois casos).
+
+    ao vivo   STATUS vai para hass/switch/<local>/luz1/set, o aparelho
+              simulado responde em hass/ask_state depois de --device-delay
+    cache     o estado retido em .../status, guardado pelo StateCache,
+              é publicado direto em hass/ask_state
+
+Tudo passa pelo fake_broker (com SUBSCRIBE e retain), sem mosquitto. No fim,
+com um state_max_age curto, confere que um estado velho volta a perguntar
+ao aparelho.
+
+Uso:
+    python3 experimentos/benchmark_state_cache.py [-n 200] [--device-delay 0.05]
+"""
+import argparse
+import os
+import queue
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import paho.mqtt.client as mqtt  # noqa: E402
+
+from custom_components.intent_table import (  # noqa: E402
+    DEFAULT_STATE_ANSWER_TOPIC, DEFAULT_STATE_TOPIC, STATUS_PAYLOAD, MqttPublisher, StateCache)
+from fake_broker import FakeBroker  # noqa: E402
+
+ROOMS = ['sala', 'quarto', 'cozinha']
+COMMAND_TOPIC = 'hass/switch/%s/luz1/set'
+
+
+class Device(object):
+    """The switches: retained status on every change, STATUS answered after a delay."""
+
+    def __init__(self, broker, delay):
+        self.delay = delay
+        self.states = {room: 'OFF' for room in ROOMS}
+        self.client = mqtt.Client()
+        self.client.on_message = self._on_message
+        self.client.connect(broker.host, broker.port, 60)
+        self.client.subscribe('hass/switch/+/luz1/set')
+        self.client.loop_start()
+        for room, state in self.states.items():
+            self.client.publish('hass/switch/%s/luz1/status' % room, state, retain=True)
+
+    def stop(self):
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    def _on_message(self, client, userdata, message):
+        room = message.topic.split('/')[2]
+        payload = message.payload.decode()
+        if payload == STATUS_PAYLOAD:
+            threading.Timer(self.delay, client.publish,
+                            (DEFAULT_STATE_ANSWER_TOPIC, self.states[room])).start()
+        else:
+            self.states[room] = payload
+            client.publish('hass/switch/%s/luz1/status' % room, payload, retain=True)
+
+
+class Listener(object):
+    """Stands in for the hass/ask_state automation: records when answers arrive."""
+
+    def __init__(self, broker):
+        self.answers = queue.Queue()
+        self.client = mqtt.Client()
+        self.client.on_message = lambda c, u, message: self.answers.put((time.monotonic(), message.payload))
+        self.client.connect(broker.host, broker.port, 60)
+        self.client.subscribe(DEFAULT_STATE_ANSWER_TOPIC)
+        self.client.loop_start()
+
+    def stop(self):
+        self.client.disconnect()
+        self.client.loop_stop()
+
+
+def wait(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError()
+        time.sleep(0.01)
+
+
+def query(publisher, states, listener, room):
+    """What intent_table.parse does for 'luz <local> ligada'; returns (seconds, answer, cached)."""
+    started = time.monotonic()
+    topic, payload, cached = states.route(COMMAND_TOPIC % room, STATUS_PAYLOAD)
+    publisher.publish(topic, payload)
+    arrived, answer = listener.answers.get(timeout=5.0)
+    return arrived - started, answer.decode(), cached
+
+
+def report(name, latencies):
+    def ms(q):
+        values = sorted(latencies)
+        return 1000 * values[min(len(values) - 1, int(q * len(values)))]
+    print('%-8s query -> hass/ask_state  p50 %7.2f ms  p95 %7.2f ms  mean %7.2f ms' % (
+        name, ms(0.5), ms(0.95), 1000 * statistics.mean(latencies)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=200)
+    parser.add_argument('--device-delay', type=float, default=0.05,
+                        help='tempo do aparelho para responder um STATUS (s)')
+    args = parser.parse_args()
+
+    broker = FakeBroker().start()
+    device = Device(broker, args.device_delay)
+    listener = Listener(broker)
+    publisher = MqttPublisher(broker.host, broker.port)
+    states = StateCache(300)
+    publisher.subscribe(DEFAULT_STATE_TOPIC, states.update)
+    publisher.start()
+    wait(lambda: len(states) == len(ROOMS))
+
+    live = StateCache(300)  # never filled: every query goes to the device
+    results = {'live': [], 'cache': []}
+    wrong = 0
+    for i in range(args.n):
+        room = ROOMS[i % len(ROOMS)]
+        if i % 10 == 0:
+            # Someone switches the light; the cache follows the retained status
+            publisher.publish(COMMAND_TOPIC % room, 'ON' if device.states[room] == 'OFF' else 'OFF')
+            wait(lambda: states._states.get('hass/switch/%s/luz1/status' % room, (None,))[0] == device.states[room])
+        for name, cache in (('live', live), ('cache', states)):
+            seconds, answer, cached = query(publisher, cache, listener, room)
+            results[name].append(seconds)
+            wrong += answer != device.states[room]
+    report('live', results['live'])
+    report('cache', results['cache'])
+    print('answers different from the device: %d, cache stats %s' % (wrong, states.stats))
+
+    states.max_age = 0.2
+    time.sleep(0.3)
+    _, _, cached = query(publisher, states, listener, ROOMS[0])
+    print('after max_age: answered from cache %s (stats %s)' % (cached, states.stats))
+
+    publisher.stop()
+    listener.stop()
+    device.stop()
+    broker.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+Broker MQTT mínimo (3.1/3.1.1) para os benchmarks, dispensando o mosquitto.
+
+Entende apenas CONNECT, PUBLISH (QoS 0, 1 e 2), SUBSCRIBE, PINGREQ e
+DISCONNECT, e guarda o instante de chegada de cada mensagem publicada para
+medir latência. Mensagens publicadas são repassadas (sempre com QoS 0) a quem
+assinou um filtro que casa com o tópico, com + e #, e as publicadas com
+retain ficam guardadas e são entregues a cada nova assinatura.
+"""
+import socket
+import struct
+import threading
+import time
+
+
+def _read_exactly(conn, size):
+    data = b''
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('connection closed')
+        data += chunk
+    return data
+
+
+def _read_packet(conn):
+    header = _read_exactly(conn, 1)[0]
+    multiplier, length = 1, 0
+    while True:
+        byte = _read_exactly(conn, 1)[0]
+        length += (byte & 0x7F) * multiplier
+        multiplier *= 128
+        if not byte & 0x80:
+            break
+    return header, _read_exactly(conn, length) if length else b''
+
+
+def _encode_length(length):
+    encoded = b''
+    while True:
+        byte, length = length % 128, length // 128
+        encoded += bytes([byte | 0x80 if length else byte])
+        if not length:
+            return encoded
+
+
+def _publish_packet(topic, payload, retain):
+    topic = topic.encode('utf-8')
+    body = struct.pack('!H', len(topic)) + topic + payload
+    return bytes([0x31 if retain else 0x30]) + _encode_length(len(body)) + body
+
+
+def topic_matches(pattern, topic):
+    pattern, topic = pattern.split('/'), topic.split('/')
+    for index, level in enumerate(pattern):
+        if level == '#':
+            return True
+        if index >= len(topic) or (level != '+' and level != topic[index]):
+            return False
+    return len(pattern) == len(topic)
+
+
+class FakeBroker(object):
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind((host, port))
+        self._server.listen(16)
+        self.host, self.port = self._server.getsockname()
+        self.messages = []
+        self.retained = {}
+        self.connections = 0
+        # (connection, its send lock, topic filter)
+        self._subscriptions = []
+        self._condition = threading.Condition()
+        self._running = False
+
+    def start(self):
+        self._running = True
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._running = False
+        self._server.close()
+
+    def wait_for(self, topic, count, timeout=5.0):
+        """Blocks until count messages arrived on topic; returns their arrival times."""
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                arrived = [t for t, top, _ in self.messages if top == topic]
+                if len(arrived) >= count:
+                    return arrived
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError('%d/%d messages on %s' % (len(arrived), count, topic))
+                self._condition.wait(remaining)
+
+    def _accept_loop(self):
+        while self._running:
+            try:
+                conn, _ = self._server.accept()
+            except OSError:
+                return
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.connections += 1
+            threading.Thread(target=self._client_loop, args=(conn,), daemon=True).start()
+
+    def _client_loop(self, conn):
+        # Forwarded messages come from other connections' threads
+        lock = threading.Lock()
+
+        def send(data):
+            with lock:
+                conn.sendall(data)
+
+        try:
+            while True:
+                header, body = _read_packet(conn)
+                kind = header >> 4
+                if kind == 1:       # CONNECT
+                    send(b'\x20\x02\x00\x00')
+                elif kind == 3:     # PUBLISH
+                    self._handle_publish(send, header, body)
+                elif kind == 6:     # PUBREL
+                    send(b'\x70\x02' + body[:2])
+                elif kind == 8:     # SUBSCRIBE
+                    self._handle_subscribe(conn, send, body)
+                elif kind == 12:    # PINGREQ
+                    send(b'\xd0\x00')
+                elif kind == 14:    # DISCONNECT
+                    break
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            with self._condition:
+                self._subscriptions = [s for s in self._subscriptions if s[0] is not conn]
+            conn.close()
+
+    def _handle_publish(self, send, header, body):
+        arrived = time.monotonic()
+        qos = (header >> 1) & 0x03
+        retain = header & 0x01
+        topic_length = struct.unpack('!H', body[:2])[0]
+        topic = body[2:2 + topic_length].decode('utf-8')
+        offset = 2 + topic_length
+        if qos:
+            packet_id = body[offset:offset + 2]
+            offset += 2
+            send((b'\x40\x02' if qos == 1 else b'\x50\x02') + packet_id)
+        payload = body[offset:]
+        with self._condition:
+            self.messages.append((arrived, topic, payload))
+            if retain and payload:
+                self.retained[topic] = payload
+            elif retain:
+                self.retained.pop(topic, None)
+            subscribers = [s for s in self._subscriptions if topic_matches(s[2], topic)]
+            self._condition.notify_all()
+        packet = _publish_packet(topic, payload, False)
+        for _, send_to, _ in subscribers:
+            try:
+                send_to(packet)
+            except OSError:
+                pass
+
+    def _handle_subscribe(self, conn, send, body):
+        packet_id, offset, granted, filters = body[:2], 2, b'', []
+        while offset < len(body):
+            length = struct.unpack('!H', body[offset:offset + 2])[0]
+            filters.append(body[offset + 2:offset + 2 + length].decode('utf-8'))
+            offset += 3 + length
+            granted += b'\x00'
+        send(b'\x90' + _encode_length(2 + len(granted)) + packet_id + granted)
+        with self._condition:
+            self._subscriptions.extend((conn, send, f) for f in filters)
+            retained = [(t, p) for t, p in self.retained.items() if any(topic_matches(f, t) for f in filters)]
+        for topic, payload in retained:
+            send(_publish_packet(topic, payload, True))
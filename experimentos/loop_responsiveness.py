@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Mostra quanto o event loop atrasa durante uma sessão do stt_snowboy.detect:
+a sessão rodando direto no loop (como o serviço registrado com
+async_register fazia) vs no DetectionWorker, com o resultado voltando ao
+loop por call_soon_threadsafe.
+
+Um tick de 10 ms no loop mede o atraso de cada acordada. O áudio vem de um
+SyntheticSource em tempo real. Sem --models a sessão usa um detector que
+nunca dispara, então sempre termina pelo timeout: mede só o agendamento,
+que é o que importa aqui. Com --models usa o snowboy de verdade.
+
+Sai com código 1 se, com a sessão no DetectionWorker, o p99 do atraso do
+loop passar de --max-lag-ms: assim serve de teste de regressão (não há
+testes automatizados no repositório).
+
+Uso:
+    python3 experimentos/loop_responsiveness.py [--timeout 3] [--max-lag-ms 50] [--models a.pmdl,b.pmdl --keywords a,b]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from custom_components.audio_capture import AudioCapture, SyntheticSource  # noqa: E402
+from custom_components.stt_snowboy import (  # noqa: E402
+    DetectionWorker, IntentMatcher, build_detector, spot_command)
+
+TICK = 0.01
+# p99 loop lag, in ms, allowed while a session runs in the worker
+DEFAULT_MAX_LAG_MS = 50.0
+
+
+class SilentDetector(object):
+    """Stands in for snowboy when no models are given: never detects."""
+
+    def Reset(self):
+        pass
+
+    def RunDetection(self, data):
+        return 0
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def ticker(lags, done):
+    while not done.is_set():
+        expected = time.monotonic() + TICK
+        await asyncio.sleep(TICK)
+        lags.append(max(0.0, time.monotonic() - expected))
+
+
+async def measure(loop, capture, run_session, timeout, run_in_worker):
+    lags = []
+    done = asyncio.Event()
+    tick = asyncio.ensure_future(ticker(lags, done))
+    await asyncio.sleep(0.2)
+    started = time.monotonic()
+    if run_in_worker:
+        worker = DetectionWorker(capture, timeout, run_session)
+        worker.start()
+        result = loop.create_future()
+        worker.submit(lambda text: loop.call_soon_threadsafe(result.set_result, text))
+        text = await result
+        worker.stop()
+    else:
+        # What the old service did: the whole session on the loop
+        text = run_session(capture.session(timeout))
+    elapsed = time.monotonic() - started
+    await asyncio.sleep(0.2)
+    done.set()
+    await tick
+    return text, elapsed, lags
+
+
+def report(name, text, elapsed, lags):
+    print('%-14s session %.2f s -> %-16s loop lag p50 %7.1f ms  p99 %7.1f ms  max %7.1f ms' % (
+        name, elapsed, text, 1000 * percentile(lags, 0.5), 1000 * percentile(lags, 0.99), 1000 * max(lags)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--timeout', type=float, default=3.0)
+    parser.add_argument('--max-lag-ms', type=float, default=DEFAULT_MAX_LAG_MS,
+                        help='p99 do atraso do loop aceito com a sessão no worker')
+    parser.add_argument('--models')
+    parser.add_argument('--keywords')
+    args = parser.parse_args()
+
+    if args.models:
+        models = args.models.split(',')
+        keywords = args.keywords.split(',')
+        detector = build_detector(models, 0.5, 1.0)
+    else:
+        keywords = ['ligar', 'luz', 'sala']
+        detector = SilentDetector()
+    matcher = IntentMatcher([' '.join(keywords)])
+
+    capture = AudioCapture(SyntheticSource())
+    capture.start()
+
+    def run_session(session):
+        return spot_command(detector, capture, capture.reader(), keywords, matcher, session)
+
+    loop = asyncio.get_event_loop()
+    report('on the loop', *loop.run_until_complete(measure(loop, capture, run_session, args.timeout, False)))
+    text, elapsed, lags = loop.run_until_complete(measure(loop, capture, run_session, args.timeout, True))
+    report('in the worker', text, elapsed, lags)
+    capture.stop()
+
+    lag = 1000 * percentile(lags, 0.99)
+    if lag > args.max_lag_ms:
+        print('REGRESSION: loop lag p99 %.1f ms with the session in the worker, above %.1f ms' % (
+            lag, args.max_lag_ms))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""
+Simula o modo satélite no localhost: o lado central do componente satellite
+(SatelliteServer) e N satélites, um por cômodo (sala, quarto, cozinha, ...),
+cada um repetindo um arquivo WAV pelo AudioCapture como se fosse o microfone,
+sem hotword (os comandos são gravados um atrás do outro, cortados pelo
+VoiceGate) e enviados pelo SatelliteClient.
+
+Sem argumentos os WAVs são sintetizados: cada comando é um som vozeado
+(harmônicos de uma fundamental, com sílabas) entre silêncios, e a fundamental
+diz qual frase foi "falada". O decodificador falso acha a fundamental com FFT
+e demora --decode-ms, como um processo decodificando. Com --sphinx, os WAVs
+dados (16 kHz, 16 bit mono, um por satélite, repetidos se faltarem) são
+decodificados de verdade pelo DecoderPool do stt_speech_recognition.
+
+O intent_table é o de verdade, com a gramática do repositório e os templates
+do configuration.yaml, e publica num publicador que só guarda os tópicos:
+'ligar luz' dito na cozinha tem de ir para hass/switch/cozinha/luz1/set.
+
+Para cada codec (pcm e adpcm) mostra cada comando (cômodo, texto, tópico
+publicado, latência do fim do comando até a resposta) e o resumo: bytes
+enviados contra o áudio gravado, latência p50 e máxima e quantos comandos
+foram decodificados ao mesmo tempo.
+
+Uso:
+    python3 experimentos/satellites.py [--satellites 3] [--commands 4] [--workers 2] [--decode-ms 400]
+    python3 experimentos/satellites.py --sphinx a.wav b.wav c.wav [--language-dir DIR] [--workers 2]
+"""
+import argparse
+import asyncio
+import math
+import os
+import sys
+import tempfile
+import threading
+import wave
+
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from custom_components import audio_capture, jsgf, satellite  # noqa: E402
+from custom_components import stt_speech_recognition as stt  # noqa: E402
+from custom_components.intent_table import (  # noqa: E402
+    DEFAULT_MQTT_COMMAND_NOT_FOUND_TOPIC, DEFAULT_MQTT_SUCCESS_TOPIC, IntentHandler, IntentTable)
+
+ROOMS = ['sala', 'quarto', 'cozinha', 'escritorio', 'varanda']
+GRAMMAR = os.path.join(ROOT, 'data', 'pocketsphinx', 'gramatica.jsgf')
+# intents of intent_table in configuration.yaml
+TEMPLATES = {
+    'comando': ('hass/switch/{local}/luz1/set', '{acao}'),
+    'abertura': ('hass/switch/{local}/porta1/set', 'ON'),
+    'consulta': ('hass/switch/{local}/luz1/set', 'STATUS'),
+    'estado_porta': ('hass/switch/{local}/porta1/set', 'STATUS'),
+    'som': ('hass/speaker/volume', '{volume}')
+}
+
+# Synthetic commands: phrase i is voiced at BASE_PITCH + i * PITCH_STEP Hz
+PHRASES = ['ligar luz', 'desligar luz', 'abra porta', 'ligar luz sala', 'aumente volume']
+BASE_PITCH = 120.0
+PITCH_STEP = 35.0
+# A voiced command peaks this much above the median of the pitch band
+VOICED_PEAK = 20.0
+SAMPLE_RATE = satellite.SAMPLE_RATE
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+# -----------------------------------------------------------------------------
+# SYNTHETIC ROOMS
+
+def voiced(pitch, seconds, generator):
+    """Harmonics of pitch with a syllable envelope, about speech level."""
+    t = np.arange(int(seconds * SAMPLE_RATE)) / float(SAMPLE_RATE)
+    signal = sum(np.sin(2 * np.pi * k * pitch * t) / k for k in range(1, 12) if k * pitch < 3500)
+    syllables = 0.55 + 0.45 * np.sin(2 * np.pi * 4 * t) ** 2
+    edges = np.minimum(1.0, np.minimum(t, seconds - t) / 0.05)
+    return 5000 * signal * syllables * edges + 20 * generator.standard_normal(len(t))
+
+
+def silence(seconds, generator):
+    return 30 * generator.standard_normal(int(seconds * SAMPLE_RATE))
+
+
+def synthetic_room(path, phrases, seed):
+    """WAV of the phrases, each 1.2 s of 'speech' between silences."""
+    generator = np.random.RandomState(seed)
+    parts = [silence(1.0, generator)]
+    for phrase in phrases:
+        parts.append(voiced(BASE_PITCH + PHRASES.index(phrase) * PITCH_STEP, 1.2, generator))
+        parts.append(silence(1.6, generator))
+    samples = np.clip(np.concatenate(parts), -32768, 32767).astype(np.int16)
+    with wave.open(path, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        wav.writeframes(samples.tobytes())
+    return path
+
+
+def fake_decoder(seconds):
+    """The phrase of the pitch of the audio (None without one), after seconds, as if a decoder process took them."""
+    done = threading.Event()
+
+    def decode(raw_data):
+        samples = np.frombuffer(raw_data, np.int16).astype(np.float64)
+        spectrum = np.abs(np.fft.rfft(samples * np.hanning(len(samples))))
+        frequencies = np.fft.rfftfreq(len(samples), 1.0 / SAMPLE_RATE)
+        band = (frequencies > BASE_PITCH - PITCH_STEP / 2) & (frequencies < BASE_PITCH + len(PHRASES) * PITCH_STEP)
+        pitch = frequencies[band][spectrum[band].argmax()]
+        done.wait(seconds)
+        if spectrum[band].max() < VOICED_PEAK * np.median(spectrum[band]):
+            # No clear pitch: noise the VAD let through, not understood
+            return None
+        index = int(round((pitch - BASE_PITCH) / PITCH_STEP))
+        return PHRASES[index] if 0 <= index < len(PHRASES) else None
+    return decode
+
+
+# -----------------------------------------------------------------------------
+# CENTRAL
+
+class Hass(object):
+    """Only what voice_metrics.mark looks at."""
+    data = {}
+
+
+class Publisher(object):
+    """Keeps what each thread published, instead of sending it to a broker."""
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def publish(self, topic, payload):
+        self.published.append((topic, payload))
+
+    @property
+    def published(self):
+        if not hasattr(self._local, 'published'):
+            self._local.published = []
+        return self._local.published
+
+
+def run(codec, wavs, decode, workers):
+    """Satellites replaying wavs to a server on localhost, with codec. (results, server stats, clients)."""
+    grammar = jsgf.Grammar.load(GRAMMAR)
+    publisher = Publisher()
+    handler = IntentHandler(Hass(), IntentTable([], [], [], grammar, TEMPLATES), publisher, None,
+                            DEFAULT_MQTT_SUCCESS_TOPIC, DEFAULT_MQTT_COMMAND_NOT_FOUND_TOPIC)
+    topics = {}
+
+    def handle(text, correlation_id, room):
+        del publisher.published[:]
+        understood = handler.handle(text, correlation_id, room)
+        topics[correlation_id] = '%s %s' % publisher.published[0] if publisher.published else '-'
+        return understood
+
+    server = satellite.SatelliteServer(decode, handle, workers, '127.0.0.1', 0)
+    loop = asyncio.new_event_loop()
+    loop_thread = threading.Thread(target=loop.run_forever, daemon=True)
+    loop_thread.start()
+    asyncio.run_coroutine_threadsafe(server.start(), loop).result()
+    host, port = server.address
+
+    results = []
+    lock = threading.Lock()
+    clients = []
+    threads = []
+    for index, wav in enumerate(wavs):
+        room = ROOMS[index % len(ROOMS)]
+        capture = audio_capture.AudioCapture(audio_capture.WaveFileSource(wav, realtime=True),
+                                             vad={'aggressiveness': audio_capture.DEFAULT_VAD_AGGRESSIVENESS})
+        client = satellite.SatelliteClient(host, port, room, codec)
+
+        def on_result(result, room=room):
+            with lock:
+                results.append(dict(result, room=room))
+
+        node = satellite.Satellite(capture, client, on_result=on_result)
+        clients.append(client)
+        threads.append(threading.Thread(target=node.run, name=room, daemon=True))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    asyncio.run_coroutine_threadsafe(server.stop(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    loop_thread.join()
+    for result in results:
+        result['topic'] = topics.get(result['correlation_id'], '-')
+    return results, server.stats, clients
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('wavs', nargs='*')
+    parser.add_argument('--satellites', type=int, default=3)
+    parser.add_argument('--commands', type=int, default=4)
+    parser.add_argument('--workers', type=int, default=max(1, (os.cpu_count() or 2) - 1))
+    parser.add_argument('--decode-ms', type=float, default=400.0)
+    parser.add_argument('--sphinx', action='store_true', help='decodifica os WAVs com o DecoderPool')
+    parser.add_argument('--language-dir', help='modelo do pocketsphinx (padrão: pt-br-picado do speech_recognition)')
+    args = parser.parse_args()
+
+    pool = None
+    if args.sphinx:
+        assert args.wavs, 'com --sphinx, passe os WAVs dos comandos'
+        language_dir = args.language_dir
+        if language_dir is None:
+            language_dir = os.path.join(os.path.dirname(stt.speech_recognition().__file__), 'pocketsphinx-data',
+                                        stt.DEFAULT_LANGUAGE)
+        decoder_args = (os.path.join(language_dir, 'acoustic-model'),
+                        os.path.join(language_dir, 'language-model.lm.bin'),
+                        os.path.join(language_dir, 'pronounciation-dictionary.dict'),
+                        GRAMMAR)
+        pool = stt.DecoderPool(decoder_args, args.workers).start()
+        decode = pool.decode
+        wavs = [args.wavs[i % len(args.wavs)] for i in range(max(args.satellites, len(args.wavs)))]
+    else:
+        decode = fake_decoder(args.decode_ms / 1000.0)
+        directory = tempfile.mkdtemp(prefix='satellites_')
+        wavs = []
+        for index in range(args.satellites):
+            # Each room says a different sequence of the phrases
+            phrases = [PHRASES[(index + i) % len(PHRASES)] for i in range(args.commands)]
+            wavs.append(synthetic_room(os.path.join(directory, '%s.wav' % ROOMS[index % len(ROOMS)]),
+                                       phrases, index))
+
+    recorded = 0.0
+    for wav in wavs:
+        with wave.open(wav, 'rb') as audio:
+            recorded += audio.getnframes() / float(audio.getframerate())
+    print('%d satélites, %d workers, %d cpus' % (len(wavs), args.workers, os.cpu_count()))
+    for codec in satellite.CODECS:
+        results, stats, clients = run(codec, wavs, decode, args.workers)
+        print('\n%s' % codec)
+        print('  %-10s %-16s %-5s %-34s %8s' % ('cômodo', 'texto', 'ok', 'publicado', 'latência'))
+        for result in sorted(results, key=lambda r: r['room']):
+            print('  %-10s %-16s %-5s %-34s %6.0f ms' % (
+                result['room'], result['text'] or '-', result['understood'], result['topic'], 1000 * result['seconds']))
+        pcm = sum(client.stats['pcm_bytes'] for client in clients)
+        sent = sum(client.stats['sent_bytes'] for client in clients)
+        latencies = [result['seconds'] for result in results] or [math.nan]
+        print('  %d comandos, %d entendidos; %.1f s de %.1f s gravados enviados em %d kB (%.1f%% do PCM); '
+              'latência p50 %.0f ms, máx %.0f ms; até %d decodificando juntos' % (
+                  len(results), stats['understood'], pcm / float(2 * SAMPLE_RATE), recorded, sent // 1024,
+                  100.0 * sent / max(1, pcm), 1000 * percentile(latencies, 0.5), 1000 * max(latencies),
+                  stats['max_busy']))
+    if pool is not None:
+        pool.stop()
+
+
+if __name__ == '__main__':
+    main()